@@ -0,0 +1,86 @@
+import argparse
+import glob
+import json
+import logging
+import os
+
+import numpy as np
+import torch
+import yaml
+from easydict import EasyDict
+
+from autoattack import AutoAttack
+from autoattack.shards import merge_shards
+from eval_sweep import load_model
+from utils import create_dataloader
+from utils_test import load_test_set
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINTS = {'Best': 'model_best.pth.tar', 'Last': 'checkpoint.pth.tar'}
+
+
+def shard_dir(config, tag: str) -> str:
+    return os.path.join('./checkpoint', config.DATA.Data, config.Operation.Prefix, 'aa_shards', tag)
+
+
+def run(config, tag: str, shard_id: int, n_shards: int) -> None:
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    checkpoint_path = os.path.join('./checkpoint', config.DATA.Data, config.Operation.Prefix, CHECKPOINTS[tag])
+    net, _ = load_model(config.Sharding.Arch, checkpoint_path, config, device)
+    _, test_loader = create_dataloader(config.DATA.Data, Norm=config.Operation.Method != 'AT')
+    x_test, y_test = load_test_set(test_loader)
+
+    autoattack = AutoAttack(net, norm='Linf', eps=config.ADV.clip_eps/255., seed=config.Sharding.Seed,
+                            attacks_to_run=list(config.Sharding.Autoattack), version='custom', device=device)
+    autoattack.apgd.n_restarts = 2
+    autoattack.fab.n_restarts = 2
+
+    os.makedirs(shard_dir(config, tag), exist_ok=True)
+    path = os.path.join(shard_dir(config, tag), f'shard_{shard_id:03d}_of_{n_shards:03d}.pt')
+    shard = autoattack.run_shard(x_test, y_test, shard_id, n_shards, path, bs='auto',
+                                 chunk_size=config.Sharding.Chunk_size)
+    logger.info(f"shard {shard_id}/{n_shards} [{shard['start']}, {shard['end']}): robust accuracy "
+                f"{100. * shard['flags'].float().mean().item():.2f} in {sum(shard['timings'].values()):.0f}s")
+
+
+def merge(config, tag: str, paths) -> None:
+    if not paths:
+        paths = sorted(glob.glob(os.path.join(shard_dir(config, tag), 'shard_*.pt')))
+    merged = merge_shards(paths)
+    logger.info(f"{len(paths)} shards, {merged['n']} samples")
+    logger.info(f"Normal Acc: {100. * merged['clean_accuracy']:.2f}")
+    logger.info(f"Auto_attack:[eps:{config.ADV.clip_eps}]->acc: {100. * merged['robust_accuracy']: .2f}")
+
+    out_dir = os.path.dirname(shard_dir(config, tag))
+    with open(os.path.join(out_dir, f'{tag}_autoattack.json'), 'w') as f:
+        json.dump({'clean': 100. * merged['clean_accuracy'], 'robust': 100. * merged['robust_accuracy'],
+                   'attacks': merged['attacks'], 'eps': merged['eps'], 'timings': merged['timings']}, f, indent=2)
+    np.save(os.path.join(out_dir, f'{tag}_autoattack_adv.npy'), merged['x_adv'].numpy())
+    np.save(os.path.join(out_dir, f'{tag}_autoattack_flags.npy'), np.packbits(merged['flags'].numpy()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='AutoAttack split into independent shard jobs')
+    parser.add_argument('command', choices=['run', 'merge'])
+    parser.add_argument('--config', default='configs_test.yml')
+    parser.add_argument('--checkpoint', default='Best', choices=list(CHECKPOINTS))
+    parser.add_argument('--shard', type=int, help='index of the shard to run, in [0, num-shards)')
+    parser.add_argument('--num-shards', type=int)
+    parser.add_argument('paths', nargs='*', help='shard files to merge (default: all of the checkpoint)')
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        config = EasyDict(yaml.load(f, Loader=yaml.FullLoader))
+    logging.basicConfig(format='[%(asctime)s] - %(message)s', datefmt='%Y/%m/%d %H:%M:%S',
+                        level=logging.INFO)
+    if args.command == 'run':
+        assert args.shard is not None and args.num_shards is not None, '--shard and --num-shards are required'
+        assert 0 <= args.shard < args.num_shards
+        run(config, args.checkpoint, args.shard, args.num_shards)
+    else:
+        merge(config, args.checkpoint, args.paths)
+
+
+if __name__ == '__main__':
+    main()
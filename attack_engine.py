@@ -0,0 +1,180 @@
+from typing import Optional
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch import Tensor
+
+from autoattack.other_utils import input_grad_only
+
+def ce_loss(logits: Tensor, y: Tensor) -> Tensor:
+    return F.cross_entropy(logits, y, reduction='none')
+
+def cw_loss(logits: Tensor, y: Tensor) -> Tensor:
+    # max_{j != y} z_j - z_y, same as utils_test.CW_loss but per sample
+    z_y = logits.gather(1, y.unsqueeze(1)).squeeze(1)
+    z_other = logits.scatter(1, y.unsqueeze(1), -float('inf')).max(1)[0]
+    return z_other - z_y
+
+def dlr_loss(logits: Tensor, y: Tensor) -> Tensor:
+    z_sorted = logits.sort(dim=1)[0]
+    return cw_loss(logits, y) / (z_sorted[:, -1] - z_sorted[:, -3] + 1e-12)
+
+LOSSES = {'ce': ce_loss, 'cw': cw_loss, 'dlr': dlr_loss}
+
+class AttackEngine:
+    """
+    Batched gradient attack used for training and evaluation (pgd_attack, cw_Linf_attack).
+
+    :param loss:        loss to maximize ('ce', 'cw', 'dlr')
+    :param step:        'sign' (PGD), 'l2' (normalized gradient) or 'momentum' (sign of the
+                        accumulated L1-normalized gradient, decay `momentum`)
+    :param norm:        threat model of the projection ('Linf', 'L2')
+    :param n_restarts:  random restarts, each one only on the samples not fooled yet
+    :param early_stop:  retire a sample from the active batch as soon as it is misclassified
+
+    epsilon and alpha can be floats or per-sample tensors. perturb takes an optional
+    per-sample step budget and initial noise, and with return_steps=True also returns
+    the step at which each returned example fooled the model (iters + 1 if it did not).
+    The projection is done in place on work buffers owned by the engine (grown to the
+    largest batch it has seen and sliced to the current one, freed with it) and the
+    active batch is compacted whenever samples are retired.
+    """
+
+    def __init__(self, model: nn.Module, epsilon, alpha, iters: int, loss: str = 'ce', step: str = 'sign',
+                 norm: str = 'Linf', n_restarts: int = 1, momentum: float = 1.0, early_stop: bool = False):
+        assert loss in LOSSES
+        assert step in ['sign', 'l2', 'momentum']
+        assert norm in ['Linf', 'L2']
+        self.model = model
+        self.epsilon = epsilon
+        self.alpha = alpha
+        self.iters = iters
+        self.loss = loss
+        self.step = step
+        self.norm = norm
+        self.n_restarts = n_restarts
+        self.momentum = momentum
+        self.early_stop = early_stop
+        self._buffers = {}
+
+    def _buffer(self, name: str, like: Tensor) -> Tensor:
+        # first like.shape[0] rows of the work buffer `name`, reallocated if too small
+        buf = self._buffers.get(name)
+        if buf is None or buf.shape[0] < like.shape[0] or buf.shape[1:] != like.shape[1:] \
+                or buf.dtype != like.dtype or buf.device != like.device:
+            buf = self._buffers[name] = torch.empty_like(like)
+        return buf[:like.shape[0]]
+
+    def _per_row(self, v, x: Tensor) -> Tensor:
+        v = torch.as_tensor(v, dtype=x.dtype, device=x.device)
+        return v.expand(x.shape[0]).reshape(-1, *[1] * (x.dim() - 1))
+
+    def _random_init(self, x: Tensor, eps: Tensor) -> Tensor:
+        if self.norm == 'Linf':
+            return torch.empty_like(x).uniform_(-1., 1.).mul_(eps)
+        noise = torch.randn_like(x)
+        return noise.mul_(eps / (noise.flatten(1).norm(dim=1).view_as(eps) + 1e-12))
+
+    def _project(self, w: dict) -> None:
+        x_adv = w['x_adv']
+        if self.norm == 'Linf':
+            # the bounds already include the [0, 1] box
+            x_adv.clamp_(w['lower'], w['upper'])
+        else:
+            delta = x_adv.sub_(w['x'])
+            norms = delta.flatten(1).norm(dim=1).view_as(w['eps'])
+            delta.mul_(torch.clamp(w['eps'] / (norms + 1e-12), max=1.))
+            delta.add_(w['x']).clamp_(0., 1.)
+
+    def _step(self, w: dict, grad: Tensor) -> None:
+        if self.step == 'sign':
+            w['x_adv'].addcmul_(w['alpha'], grad.sign())
+        elif self.step == 'l2':
+            norms = grad.flatten(1).norm(dim=1).view_as(w['alpha'])
+            w['x_adv'].addcmul_(w['alpha'] / (norms + 1e-12), grad)
+        else:
+            l1 = grad.abs().flatten(1).mean(dim=1).view_as(w['alpha'])
+            w['g'].mul_(self.momentum).add_(grad / (l1 + 1e-12))
+            w['x_adv'].addcmul_(w['alpha'], w['g'].sign())
+
+    def _run(self, x: Tensor, y: Tensor, eps: Tensor, alpha: Tensor, budget: Optional[Tensor],
+             noise: Optional[Tensor], check: bool):
+        n = x.shape[0]
+        out = torch.empty_like(x)
+        steps = torch.full((n,), self.iters + 1, dtype=torch.long, device=x.device)
+        loss_fn = LOSSES[self.loss]
+
+        # working set, compacted when samples are retired
+        w = {'x': x, 'y': y, 'eps': eps, 'alpha': alpha, 'idx': torch.arange(n, device=x.device)}
+        if budget is not None:
+            w['budget'] = budget.to(x.device)
+        if self.norm == 'Linf':
+            w['lower'] = torch.sub(x, eps, out=self._buffer('lower', x)).clamp_(min=0.)
+            w['upper'] = torch.add(x, eps, out=self._buffer('upper', x)).clamp_(max=1.)
+        if noise is None:
+            noise = self._random_init(x, eps)
+        w['x_adv'] = torch.add(x, noise, out=self._buffer('x_adv', x))
+        self._project(w)
+        if self.step == 'momentum':
+            w['g'] = torch.zeros_like(x)
+
+        for t in range(self.iters + 1):
+            last = t == self.iters
+            if last and not check:
+                out[w['idx']] = w['x_adv']
+                break
+            x_in = w['x_adv'].detach().requires_grad_(not last)
+            with torch.set_grad_enabled(not last):
+                logits = self.model(x_in)
+            fooled = logits.detach().max(1)[1].ne(w['y']) if check else None
+
+            if last:
+                retire = torch.ones_like(w['y'], dtype=torch.bool)
+            else:
+                retire = fooled.clone() if self.early_stop else torch.zeros_like(w['y'], dtype=torch.bool)
+                if budget is not None:
+                    retire |= w['budget'] <= t
+            keep = None
+            if retire.any():
+                rows = w['idx'][retire]
+                out[rows] = w['x_adv'][retire]
+                if fooled is not None:
+                    steps[rows[fooled[retire]]] = t
+                keep = ~retire
+                w = {k: v[keep] for k, v in w.items()}
+            if last or w['idx'].numel() == 0:
+                break
+
+            if keep is not None:
+                logits = logits[keep]
+            loss = loss_fn(logits, w['y']).sum()
+            grad = torch.autograd.grad(loss, x_in)[0].detach()
+            if keep is not None:
+                grad = grad[keep]
+            self._step(w, grad)
+            self._project(w)
+
+        return out, steps
+
+    def perturb(self, x: Tensor, y: Tensor, budget: Optional[Tensor] = None, noise: Optional[Tensor] = None,
+                return_steps: bool = False):
+        x, y = x.detach(), y.detach()
+        eps, alpha = self._per_row(self.epsilon, x), self._per_row(self.alpha, x)
+        check = self.early_stop or self.n_restarts > 1 or return_steps
+
+        with input_grad_only(self.model):
+            x_out, steps = self._run(x, y, eps, alpha, budget, noise, check)
+            for _ in range(1, self.n_restarts):
+                todo = (steps > self.iters).nonzero().squeeze(1)
+                if todo.numel() == 0:
+                    break
+                adv, steps_curr = self._run(x[todo], y[todo], eps[todo], alpha[todo],
+                                            None if budget is None else budget[todo], None, check)
+                fooled = steps_curr <= self.iters
+                x_out[todo[fooled]] = adv[fooled]
+                steps[todo[fooled]] = steps_curr[fooled]
+
+        if return_steps:
+            return x_out, steps
+        return x_out
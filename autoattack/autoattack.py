@@ -1,18 +1,22 @@
 import math
 import time
+from contextlib import contextmanager
 
 import numpy as np
 import torch
 
 from .other_utils import Logger
-from autoattack import checks
+from autoattack import autotune, checks
+from autoattack.pool import RobustPool, Occupancy
 from autoattack.state import EvaluationState
+from autoattack.streaming import run_streaming_evaluation
+from autoattack.shards import run_shard
 
 
 class AutoAttack():
     def __init__(self, model, norm='Linf', eps=.3, seed=None, verbose=True,
                  attacks_to_run=[], version='standard', is_tf_model=False,
-                 device='cuda', log_path=None):
+                 device='cuda', log_path=None, skip_checks=False):
         self.model = model
         self.norm = norm
         assert norm in ['Linf', 'L2', 'L1']
@@ -24,6 +28,7 @@ class AutoAttack():
         self.is_tf_model = is_tf_model
         self.device = device
         self.logger = Logger(log_path)
+        self.skip_checks = skip_checks
 
         if version in ['standard', 'plus', 'rand'] and attacks_to_run != []:
             raise ValueError("attacks_to_run will be overridden unless you use version='custom'")
@@ -77,7 +82,105 @@ class AutoAttack():
     
     def get_seed(self):
         return time.time() if self.seed is None else self.seed
-    
+
+    def _run_attack(self, attack, x, y):
+        if attack == 'apgd-ce':
+            # apgd on cross-entropy loss
+            self.apgd.loss = 'ce'
+            self.apgd.seed = self.get_seed()
+            return self.apgd.perturb(x, y) #cheap=True
+
+        elif attack == 'apgd-dlr':
+            # apgd on dlr loss
+            self.apgd.loss = 'dlr'
+            self.apgd.seed = self.get_seed()
+            return self.apgd.perturb(x, y) #cheap=True
+
+        elif attack == 'fab':
+            # fab
+            self.fab.targeted = False
+            self.fab.seed = self.get_seed()
+            return self.fab.perturb(x, y)
+
+        elif attack == 'square':
+            # square
+            self.square.seed = self.get_seed()
+            return self.square.perturb(x, y)
+
+        elif attack == 'apgd-t':
+            # targeted apgd
+            self.apgd_targeted.seed = self.get_seed()
+            return self.apgd_targeted.perturb(x, y) #cheap=True
+
+        elif attack == 'fab-t':
+            # fab targeted
+            self.fab.targeted = True
+            self.fab.n_restarts = 1
+            self.fab.seed = self.get_seed()
+            return self.fab.perturb(x, y)
+
+        else:
+            raise ValueError('Attack not supported')
+
+    @contextmanager
+    def _probe_settings(self):
+        # a couple of iterations of each attack, to measure its memory and speed
+        # (but all the target classes of a multi-target APGD-T and all the parallel
+        # restarts, which share the batch)
+        saved = [(a, k, getattr(a, k)) for a in [self.apgd, self.apgd_targeted, self.fab, self.square]
+                 for k in ['n_iter', 'n_queries', 'n_restarts', 'n_target_classes', 'verbose'] if hasattr(a, k)
+                 and not (k == 'n_target_classes' and getattr(a, 'multi_target', False))
+                 and not (k == 'n_restarts' and getattr(a, 'parallel_restarts', False))]
+        try:
+            for a, k, _ in saved:
+                # one iteration of Square evaluates n_proposals queries at once
+                setattr(a, k, {'n_iter': 2, 'n_queries': 2 * getattr(a, 'n_proposals', 1),
+                               'verbose': False}.get(k, 1))
+            yield
+        finally:
+            for a, k, v in saved:
+                setattr(a, k, v)
+
+    def batch_sizes(self, x_orig, y_orig, attacks_to_run=None, tuner=None):
+        """
+        Batch size of the clean pass and of each attack, tuned on the first correctly
+        classified samples of x_orig, i.e. the ones the attacks run on (see
+        autotune.BatchSizeTuner), and cached on disk.
+        """
+        tuner = autotune.get_tuner() if tuner is None else tuner
+        attacks_to_run = self.attacks_to_run if attacks_to_run is None else attacks_to_run
+        x, y = x_orig[:4 * tuner.min_bs], y_orig[:4 * tuner.min_bs]
+        with torch.no_grad():
+            correct = self.get_logits(x.to(self.device)).max(1)[1].eq(y.to(self.device)).to(x.device)
+        if correct.any():
+            x, y = x[correct], y[correct]
+        x, y = x[:tuner.min_bs], y[:tuner.min_bs]
+
+        def forward(x, y):
+            with torch.no_grad():
+                self.get_logits(x)
+
+        bs = {'clean': tuner.batch_size(self.model, 'clean', forward, x, y, self.device)}
+        with self._probe_settings():
+            for attack in attacks_to_run:
+                key = '{}-{}-{}'.format(attack, self.norm, self.version)
+                if attack == 'apgd-t' and self.apgd_targeted.multi_target:
+                    key += '-{}targets'.format(self.apgd_targeted.n_target_classes)
+                a = {'apgd-ce': self.apgd, 'apgd-dlr': self.apgd, 'fab': self.fab}.get(attack)
+                if getattr(a, 'parallel_restarts', False):
+                    key += '-{}restarts'.format(a.n_restarts)
+                if attack == 'square' and self.square.n_proposals > 1:
+                    key += '-{}proposals'.format(self.square.n_proposals)
+                if attack == 'square' and self.square.screen is not None:
+                    key += '-{}'.format(self.square.screen)
+                if attack.startswith('fab') and getattr(self.fab, 'jacobian', 'loop') == 'batched':
+                    key += '-batched{}'.format(self.fab.grad_chunk or '')
+                bs[attack] = tuner.batch_size(self.model, key,
+                    lambda x, y, attack=attack: self._run_attack(attack, x, y), x, y, self.device)
+        if self.verbose:
+            self.logger.log('batch sizes: {}'.format(', '.join('{} {}'.format(k, v) for k, v in bs.items())))
+        return bs
+
     def run_standard_evaluation(self,
                                 x_orig,
                                 y_orig,
@@ -89,11 +192,11 @@ class AutoAttack():
             if set(self.attacks_to_run) != state.attacks_to_run:
                 raise ValueError("The state was created with a different set of attacks "
                                  "to run. You are probably using the wrong state file.")
+            if state.n is not None and state.n != x_orig.shape[0]:
+                raise ValueError("The state was created for {} points, not {}. You are "
+                                 "probably using the wrong state file.".format(state.n, x_orig.shape[0]))
             if self.verbose:
                 self.logger.log("Restored state from {}".format(state_path))
-                self.logger.log("Since the state has been restored, **only** "
-                                "the adversarial examples from the current run "
-                                "are going to be returned.")
         else:
             state = EvaluationState(set(self.attacks_to_run), path=state_path)
             state.to_disk()
@@ -107,26 +210,45 @@ class AutoAttack():
             if state.run_attacks:
                 self.logger.log('{} was/were already run.'.format(', '.join(state.run_attacks)))
 
-        # checks on type of defense
-        if self.version != 'rand':
-            checks.check_randomized(self.get_logits, x_orig[:bs].to(self.device),
-                y_orig[:bs].to(self.device), bs=bs, logger=self.logger)
-        n_cls = checks.check_range_output(self.get_logits, x_orig[:bs].to(self.device),
-            logger=self.logger)
-        checks.check_dynamic(self.model, x_orig[:bs].to(self.device), self.is_tf_model,
-            logger=self.logger)
-        checks.check_n_classes(n_cls, self.attacks_to_run, self.apgd_targeted.n_target_classes,
-            self.fab.n_target_classes, logger=self.logger)
+        if 'square' in attacks_to_run and self.square.screen is not None:
+            self.logger.log('Warning: the Square queries are screened with a {} model, the robust '
+                            'accuracy may differ from the standard evaluation.'.format(self.square.screen))
+
+        # per-attack batch sizes, the ones of a restored state being kept with 'auto'
+        if bs == 'auto':
+            attack_bs = self.batch_sizes(x_orig, y_orig,
+                [attack for attack in attacks_to_run if attack not in state.batch_sizes])
+            attack_bs.update(state.batch_sizes)
+        elif isinstance(bs, dict):
+            # already resolved, e.g. by run_shard
+            attack_bs = dict(bs)
+        else:
+            attack_bs = {attack: bs for attack in ['clean'] + attacks_to_run}
+        # the batches done before a restore are indices for the batch size they were made with
+        for attack in attacks_to_run:
+            saved_bs = state.batch_sizes.get(attack)
+            if saved_bs is not None and state.done_batches(attack) and attack_bs[attack] != saved_bs:
+                raise ValueError("{} was interrupted with batch size {}, it cannot be resumed with "
+                                 "batch size {}.".format(attack, saved_bs, attack_bs[attack]))
+        state.set_batch_sizes(attack_bs)
+
+        # checks on type of defense, once per model
+        if not self.skip_checks:
+            checks.preflight(self.model, self.get_logits, x_orig[:bs if isinstance(bs, int) else 250].to(self.device),
+                self.attacks_to_run, self.apgd_targeted.n_target_classes,
+                self.fab.n_target_classes, check_rand=self.version != 'rand',
+                is_tf_model=self.is_tf_model, logger=self.logger)
         
         with torch.no_grad():
             # calculate accuracy
-            n_batches = int(np.ceil(x_orig.shape[0] / bs))
+            bs_clean = attack_bs['clean']
+            n_batches = int(np.ceil(x_orig.shape[0] / bs_clean))
             if state.robust_flags is None:
                 robust_flags = torch.zeros(x_orig.shape[0], dtype=torch.bool, device=x_orig.device)
                 y_adv = torch.empty_like(y_orig)
                 for batch_idx in range(n_batches):
-                    start_idx = batch_idx * bs
-                    end_idx = min( (batch_idx + 1) * bs, x_orig.shape[0])
+                    start_idx = batch_idx * bs_clean
+                    end_idx = min( (batch_idx + 1) * bs_clean, x_orig.shape[0])
 
                     x = x_orig[start_idx:end_idx, :].clone().to(self.device)
                     y = y_orig[start_idx:end_idx].clone().to(self.device)
@@ -135,94 +257,48 @@ class AutoAttack():
                     correct_batch = y.eq(output)
                     robust_flags[start_idx:end_idx] = correct_batch.detach().to(robust_flags.device)
 
-                state.robust_flags = robust_flags
+                state.start(robust_flags, y_adv, x_orig.shape[1:])
+                x_adv = x_orig.clone().detach()
                 robust_accuracy = torch.sum(robust_flags).item() / x_orig.shape[0]
                 robust_accuracy_dict = {'clean': robust_accuracy}
-                state.clean_accuracy = robust_accuracy
                 
                 if self.verbose:
                     self.logger.log('initial accuracy: {:.2%}'.format(robust_accuracy))
             else:
                 robust_flags = state.robust_flags.to(x_orig.device)
+                x_adv, y_adv = state.restore_adv(x_orig, y_orig)
                 robust_accuracy = torch.sum(robust_flags).item() / x_orig.shape[0]
                 robust_accuracy_dict = {'clean': state.clean_accuracy}
                 if self.verbose:
                     self.logger.log('initial clean accuracy: {:.2%}'.format(state.clean_accuracy))
                     self.logger.log('robust accuracy at the time of restoring the state: {:.2%}'.format(robust_accuracy))
                     
-            x_adv = x_orig.clone().detach()
             startt = time.time()
+            # the samples still robust; the batches of an attack are defined on the flags at
+            # its start, so that the ones finished before a restore can be skipped
+            pool = RobustPool(x_orig, y_orig, state.start_flags, self.device)
+            self.batch_occupancy = {}
             for attack in attacks_to_run:
-                # item() is super important as pytorch int division uses floor rounding
-                num_robust = torch.sum(robust_flags).item()
-
-                if num_robust == 0:
+                pool.compact(state.start_flags)
+                if len(pool) == 0:
                     break
 
-                n_batches = int(np.ceil(num_robust / bs))
+                bs = attack_bs[attack]
+                n_batches = int(np.ceil(len(pool) / bs))
+                occupancy = Occupancy()
+                for a in (self.apgd, self.apgd_targeted, self.square):
+                    a.occupancy = occupancy
 
-                robust_lin_idcs = torch.nonzero(robust_flags, as_tuple=False)
-                if num_robust > 1:
-                    robust_lin_idcs.squeeze_()
-                
-                for batch_idx in range(n_batches):
-                    start_idx = batch_idx * bs
-                    end_idx = min((batch_idx + 1) * bs, num_robust)
-
-                    batch_datapoint_idcs = robust_lin_idcs[start_idx:end_idx]
-                    if len(batch_datapoint_idcs.shape) > 1:
-                        batch_datapoint_idcs.squeeze_(-1)
-                    x = x_orig[batch_datapoint_idcs, :].clone().to(self.device)
-                    y = y_orig[batch_datapoint_idcs].clone().to(self.device)
+                for batch_idx, batch_datapoint_idcs, x, y in pool.batches(bs, state.done_batches(attack)):
+                    adv_curr = self._run_attack(attack, x.clone(), y)
 
-                    # make sure that x is a 4d tensor even if there is only a single datapoint left
-                    if len(x.shape) == 3:
-                        x.unsqueeze_(dim=0)
-                    
-                    # run attack
-                    if attack == 'apgd-ce':
-                        # apgd on cross-entropy loss
-                        self.apgd.loss = 'ce'
-                        self.apgd.seed = self.get_seed()
-                        adv_curr = self.apgd.perturb(x, y) #cheap=True
-                    
-                    elif attack == 'apgd-dlr':
-                        # apgd on dlr loss
-                        self.apgd.loss = 'dlr'
-                        self.apgd.seed = self.get_seed()
-                        adv_curr = self.apgd.perturb(x, y) #cheap=True
-                    
-                    elif attack == 'fab':
-                        # fab
-                        self.fab.targeted = False
-                        self.fab.seed = self.get_seed()
-                        adv_curr = self.fab.perturb(x, y)
-                    
-                    elif attack == 'square':
-                        # square
-                        self.square.seed = self.get_seed()
-                        adv_curr = self.square.perturb(x, y)
-                    
-                    elif attack == 'apgd-t':
-                        # targeted apgd
-                        self.apgd_targeted.seed = self.get_seed()
-                        adv_curr = self.apgd_targeted.perturb(x, y) #cheap=True
-                    
-                    elif attack == 'fab-t':
-                        # fab targeted
-                        self.fab.targeted = True
-                        self.fab.n_restarts = 1
-                        self.fab.seed = self.get_seed()
-                        adv_curr = self.fab.perturb(x, y)
-                    
-                    else:
-                        raise ValueError('Attack not supported')
-                
                     output = self.get_logits(adv_curr).max(dim=1)[1]
-                    false_batch = ~y.eq(output).to(robust_flags.device)
-                    non_robust_lin_idcs = batch_datapoint_idcs[false_batch]
+                    false_batch = ~y.eq(output)
+                    non_robust_lin_idcs = batch_datapoint_idcs[false_batch.to(batch_datapoint_idcs.device)
+                        ].to(robust_flags.device)
                     robust_flags[non_robust_lin_idcs] = False
-                    state.robust_flags = robust_flags
+                    state.record_batch(attack, batch_idx, non_robust_lin_idcs, adv_curr[false_batch],
+                        output[false_batch])
 
                     x_adv[non_robust_lin_idcs] = adv_curr[false_batch].detach().to(x_adv.device)
                     y_adv[non_robust_lin_idcs] = output[false_batch].detach().to(x_adv.device)
@@ -232,12 +308,19 @@ class AutoAttack():
                         self.logger.log('{} - {}/{} - {} out of {} successfully perturbed'.format(
                             attack, batch_idx + 1, n_batches, num_non_robust_batch, x.shape[0]))
                 
+                for a in (self.apgd, self.apgd_targeted, self.square):
+                    a.occupancy = None
+                if occupancy.value() is not None:
+                    self.batch_occupancy[attack] = occupancy.value()
                 robust_accuracy = torch.sum(robust_flags).item() / x_orig.shape[0]
                 robust_accuracy_dict[attack] = robust_accuracy
                 state.add_run_attack(attack)
                 if self.verbose:
                     self.logger.log('robust accuracy after {}: {:.2%} (total time {:.1f} s)'.format(
                         attack.upper(), robust_accuracy, time.time() - startt))
+                    if attack in self.batch_occupancy:
+                        self.logger.log('{} live batch occupancy: {:.1%}'.format(
+                            attack, self.batch_occupancy[attack]))
                     
             # check about square
             checks.check_square_sr(robust_accuracy_dict, logger=self.logger)
@@ -259,7 +342,26 @@ class AutoAttack():
         else:
             return x_adv, robust_accuracy
         
+    def run_streaming_evaluation(self, loader, chunk_size=1000, max_inflight=2,
+                                 bs=250, adv_path=None, adv_store=None):
+        """
+        run_standard_evaluation over a DataLoader in chunks of `chunk_size`
+        samples, with bounded memory. See streaming.run_streaming_evaluation.
+        """
+        return run_streaming_evaluation(self, loader, chunk_size=chunk_size,
+            max_inflight=max_inflight, bs=bs, adv_path=adv_path, adv_store=adv_store)
+
+    def run_shard(self, x_orig, y_orig, shard_id, n_shards, path, bs=250, chunk_size=1000):
+        """
+        Evaluates one of n_shards slices of (x_orig, y_orig) and writes it to a shard
+        file, see shards.run_shard and shards.merge_shards.
+        """
+        return run_shard(self, x_orig, y_orig, shard_id, n_shards, path, bs=bs,
+            chunk_size=chunk_size)
+
     def clean_accuracy(self, x_orig, y_orig, bs=250):
+        if bs == 'auto':
+            bs = self.batch_sizes(x_orig, y_orig, [])['clean']
         n_batches = math.ceil(x_orig.shape[0] / bs)
         acc = 0.
         for counter in range(n_batches):
@@ -12,7 +12,7 @@ import torch.nn.functional as F
 import math
 import random
 
-from autoattack.other_utils import L0_norm, L1_norm, L2_norm
+from autoattack.other_utils import L0_norm, L1_norm, L2_norm, attack_input_grad_only
 from autoattack.checks import check_zero_gradients
 
 
@@ -83,6 +83,44 @@ def L1_projection(x2, y2, eps1):
     return (sigma * d).view(x2.shape)
 
 
+def L1_projection_fast(x2, y2, eps1):
+    '''
+    Same as L1_projection, staying on the device of x2: the binary search runs on
+    all the points (without nonzero() or a host tensor) and the points which need
+    it are selected with torch.where at the end.
+    '''
+    x = x2.float().view(x2.shape[0], -1)
+    y = y2.float().view(y2.shape[0], -1)
+    if torch.is_tensor(eps1):
+        eps1 = eps1.reshape(-1)
+    sigma = y.sign()
+    u = torch.min(1 - x - y, x + y).clamp(max=0.)
+    l = -y.abs()
+
+    bs, indbs = torch.sort(-torch.cat((u, l), 1), dim=1)
+    bs2 = F.pad(bs[:, 1:], (0, 1))
+    size1 = (2 * (indbs < u.shape[1]).float() - 1).cumsum(dim=1)
+
+    s1 = -u.sum(dim=1)
+    c = eps1 - y.abs().sum(dim=1)
+    c5 = s1 + c < 0
+    s = s1.unsqueeze(-1) + torch.cumsum((bs2 - bs) * size1, dim=1)
+
+    lb = torch.zeros_like(c)
+    ub = torch.full_like(lb, bs.shape[1] - 1)
+    for counter in range(math.ceil(math.log2(bs.shape[1]))):
+        counter4 = torch.floor((lb + ub) / 2.)
+        c8 = s.gather(1, counter4.long().unsqueeze(1)).squeeze(1) + c < 0
+        lb = torch.where(c8, counter4, lb)
+        ub = torch.where(c8, ub, counter4)
+
+    lb2 = lb.long().unsqueeze(1)
+    alpha = (-s.gather(1, lb2) - c.unsqueeze(1)) / size1.gather(1, lb2 + 1) + bs2.gather(1, lb2)
+    d = torch.where(c5.unsqueeze(1), -torch.min(torch.max(-u, alpha), -l), u)
+
+    return (sigma * d).view(x2.shape)
+
+
 
 
 
@@ -95,11 +133,20 @@ class APGDAttack():
     :param norm:          Lp-norm of the attack ('Linf', 'L2', 'L0' supported)
     :param n_restarts:    number of random restarts
     :param n_iter:        number of iterations
-    :param eps:           bound on the norm of perturbations
+    :param eps:           bound on the norm of perturbations (attack_single_run also
+                          accepts a per-sample tensor of shape [n, 1, ..., 1])
     :param seed:          random seed for the starting point
     :param loss:          loss to optimize ('ce', 'dlr' supported)
     :param eot_iter:      iterations for Expectation over Trasformation
     :param rho:           parameter for decreasing the step size
+    :param shrink_active: drop the samples from the working batch of attack_single_run
+                          as soon as they are misclassified (the returned loss and
+                          highest-loss points are then those reached until then)
+    :param parallel_restarts: run the n_restarts random starts of a sample as rows of
+                          the same batch, each from its own generator, and keep the
+                          first one that succeeds
+    :param fast_l1:       L1 only, use L1_projection_fast and find the threshold of
+                          the sparse step with topk instead of a full sort
     """
 
     def __init__(
@@ -118,7 +165,10 @@ class APGDAttack():
             device=None,
             use_largereps=False,
             is_tf_model=False,
-            logger=None):
+            logger=None,
+            shrink_active=False,
+            parallel_restarts=False,
+            fast_l1=False):
         """
         AutoPGD implementation in PyTorch
         """
@@ -145,6 +195,11 @@ class APGDAttack():
         self.is_tf_model = is_tf_model
         self.y_target = None
         self.logger = logger
+        self.shrink_active = shrink_active
+        self.parallel_restarts = parallel_restarts
+        self.fast_l1 = fast_l1
+        # Occupancy accumulating the rows not fooled yet at every iteration, if any
+        self.occupancy = None
 
         assert self.norm in ['Linf', 'L2', 'L1']
         assert not self.eps is None
@@ -164,9 +219,10 @@ class APGDAttack():
             self.seed = time.time()
 
     def check_oscillation(self, x, j, k, y5, k3=0.75):
+        # x is a ring buffer of the losses, step j being at x[j % len(x)]
         t = torch.zeros(x.shape[1]).to(self.device)
         for counter5 in range(k):
-          t += (x[j - counter5] > x[j - counter5 - 1]).float()
+          t += (x[(j - counter5) % x.shape[0]] > x[(j - counter5 - 1) % x.shape[0]]).float()
 
         return (t <= k * k3 * torch.ones_like(t)).float()
 
@@ -198,22 +254,44 @@ class APGDAttack():
 
     #
     
-    def attack_single_run(self, x, y, x_init=None):
+    def l1_projection(self, x, y, eps):
+        if self.fast_l1:
+            return L1_projection_fast(x, y, eps)
+        return L1_projection(x, y, eps)
+
+    def random_noise(self, shape, generator=None):
+        # direction of the random starting point
+        if self.norm == 'Linf':
+            return 2 * torch.rand(shape, generator=generator, device=self.device) - 1
+        return torch.randn(shape, generator=generator, device=self.device)
+
+    def attack_single_run(self, x, y, x_init=None, group=None, noise=None):
+        """
+        :param group:   optional id of the sample each row attacks (e.g. one row per
+                        target class): the rows of a sample stop as soon as one of
+                        them fools the model
+        :param noise:   direction of the random start of each row (see random_noise),
+                        drawn from the global generator if None
+        """
         if len(x.shape) < self.ndims:
             x = x.unsqueeze(0)
             y = y.unsqueeze(0)
 
+        if noise is None:
+            if self.norm == 'Linf':
+                t = 2 * torch.rand(x.shape).to(self.device).detach() - 1
+            else:
+                t = torch.randn(x.shape).to(self.device).detach()
+        else:
+            t = noise.detach()
         if self.norm == 'Linf':
-            t = 2 * torch.rand(x.shape).to(self.device).detach() - 1
             x_adv = x + self.eps * torch.ones_like(x
                 ).detach() * self.normalize(t)
         elif self.norm == 'L2':
-            t = torch.randn(x.shape).to(self.device).detach()
             x_adv = x + self.eps * torch.ones_like(x
                 ).detach() * self.normalize(t)
         elif self.norm == 'L1':
-            t = torch.randn(x.shape).to(self.device).detach()
-            delta = L1_projection(x, t, self.eps)
+            delta = self.l1_projection(x, t, self.eps)
             x_adv = x + t + delta
             
         
@@ -230,9 +308,11 @@ class APGDAttack():
         x_adv = x_adv.clamp(0., 1.)
         x_best = x_adv.clone()
         x_best_adv = x_adv.clone()
-        loss_steps = torch.zeros([self.n_iter, x.shape[0]]
+        # histories as ring buffers over the window of the step size checks
+        n_window = min(self.n_iter_2, self.n_iter) + 1
+        loss_steps = torch.zeros([n_window, x.shape[0]]
             ).to(self.device)
-        loss_best_steps = torch.zeros([self.n_iter + 1, x.shape[0]]
+        loss_best_steps = torch.zeros([n_window, x.shape[0]]
             ).to(self.device)
         acc_steps = torch.zeros_like(loss_best_steps)
 
@@ -316,6 +396,14 @@ class APGDAttack():
         n_reduced = 0
 
         u = torch.arange(x.shape[0], device=self.device)
+        n_launch = x.shape[0]
+        retire_rows = group is not None or self.shrink_active
+        if retire_rows:
+            # rows still attacked, and the results of the retired ones
+            active = u.clone()
+            eps_orig, y_target_orig = self.eps, self.y_target
+            out_best, out_acc = x_best.clone(), acc.clone()
+            out_loss, out_best_adv = loss_best.clone(), x_best_adv.clone()
         for i in range(self.n_iter):
             ### gradient step
             with torch.no_grad():
@@ -344,15 +432,23 @@ class APGDAttack():
                         L2_norm(x_adv_1 - x, keepdim=True)), 0.0, 1.0)
 
                 elif self.norm == 'L1':
-                    grad_topk = grad.abs().view(x.shape[0], -1).sort(-1)[0]
                     topk_curr = torch.clamp((1. - topk) * n_fts, min=0, max=n_fts - 1).long()
-                    grad_topk = grad_topk[u, topk_curr].view(-1, *[1]*(len(x.shape) - 1))
+                    if not self.fast_l1:
+                        grad_topk = grad.abs().view(x.shape[0], -1).sort(-1)[0]
+                        grad_topk = grad_topk[u, topk_curr]
+                    else:
+                        # the topk_curr-th smallest entry is the (n_fts - 1 - topk_curr)-th largest,
+                        # so only the largest entries are needed
+                        n_largest = n_fts - topk_curr
+                        grad_topk = grad.abs().view(x.shape[0], -1).topk(int(n_largest.max()), dim=-1)[0]
+                        grad_topk = grad_topk.gather(1, (n_largest - 1).unsqueeze(1)).squeeze(1)
+                    grad_topk = grad_topk.view(-1, *[1]*(len(x.shape) - 1))
                     sparsegrad = grad * (grad.abs() >= grad_topk).float()
                     x_adv_1 = x_adv + step_size * sparsegrad.sign() / (
                         L1_norm(sparsegrad.sign(), keepdim=True) + 1e-10)
                     
                     delta_u = x_adv_1 - x
-                    delta_p = L1_projection(x, delta_u, self.eps)
+                    delta_p = self.l1_projection(x, delta_u, self.eps)
                     x_adv_1 = x + delta_u + delta_p
                     
                     
@@ -380,7 +476,9 @@ class APGDAttack():
 
             pred = logits.detach().max(1)[1] == y
             acc = torch.min(acc, pred)
-            acc_steps[i + 1] = acc + 0
+            acc_steps[(i + 1) % n_window] = acc + 0
+            if self.occupancy is not None:
+                self.occupancy.update(acc.sum(), n_launch)
             ind_pred = (pred == 0).nonzero().squeeze()
             x_best_adv[ind_pred] = x_adv[ind_pred] + 0.
             if self.verbose:
@@ -393,12 +491,12 @@ class APGDAttack():
             ### check step size
             with torch.no_grad():
               y1 = loss_indiv.detach().clone()
-              loss_steps[i] = y1 + 0
+              loss_steps[i % n_window] = y1 + 0
               ind = (y1 > loss_best).nonzero().squeeze()
               x_best[ind] = x_adv[ind].clone()
               grad_best[ind] = grad[ind].clone()
               loss_best[ind] = y1[ind] + 0
-              loss_best_steps[i + 1] = loss_best + 0
+              loss_best_steps[(i + 1) % n_window] = loss_best + 0
 
               counter3 += 1
 
@@ -438,10 +536,52 @@ class APGDAttack():
                   counter3 = 0
                   #k = max(k - self.size_decr, self.n_iter_min)
 
+            if retire_rows:
+                if group is not None:
+                    fooled_groups = torch.zeros(int(group.max()) + 1, dtype=torch.bool, device=self.device)
+                    fooled_groups[group[~acc]] = True
+                    retire = fooled_groups[group]
+                else:
+                    retire = ~acc
+                if retire.any():
+                    ind_retire = active[retire]
+                    out_best[ind_retire] = x_best[retire]
+                    out_acc[ind_retire] = acc[retire]
+                    out_loss[ind_retire] = loss_best[retire]
+                    out_best_adv[ind_retire] = x_best_adv[retire]
+
+                    keep = ~retire
+                    (x, y, x_adv, x_adv_old, x_best, x_best_adv, grad, grad_best, loss_best, step_size,
+                        acc, loss_best_last_check, reduced_last_check, active) = [t[keep]
+                        for t in (x, y, x_adv, x_adv_old, x_best, x_best_adv, grad, grad_best, loss_best,
+                        step_size, acc, loss_best_last_check, reduced_last_check, active)]
+                    if group is not None:
+                        group = group[keep]
+                    loss_steps, loss_best_steps, acc_steps = loss_steps[:, keep], loss_best_steps[:, keep], \
+                        acc_steps[:, keep]
+                    if self.norm == 'L1':
+                        topk, sp_old = topk[keep], sp_old[keep]
+                    if torch.is_tensor(self.eps) and self.eps.dim() > 0:
+                        self.eps = self.eps[keep]
+                    if self.y_target is not None:
+                        self.y_target = self.y_target[keep]
+                    u = torch.arange(x.shape[0], device=self.device)
+                    if x.shape[0] == 0:
+                        break
+
         #
-        
+
+        if retire_rows:
+            out_best[active] = x_best
+            out_acc[active] = acc
+            out_loss[active] = loss_best
+            out_best_adv[active] = x_best_adv
+            self.eps, self.y_target = eps_orig, y_target_orig
+            return (out_best, out_acc, out_loss, out_best_adv)
+
         return (x_best, acc, loss_best, x_best_adv)
 
+    @attack_input_grad_only
     def perturb(self, x, y=None, best_loss=False, x_init=None):
         """
         :param x:           clean images
@@ -493,6 +633,33 @@ class APGDAttack():
                     ) for c in epss]), '+'.join([str(c) for c in iters])))
         
         startt = time.time()
+        if not best_loss and self.parallel_restarts and not self.use_largereps:
+            ind_to_fool = acc.nonzero().squeeze(1)
+            if ind_to_fool.numel() == 0:
+                return adv
+            # rows ordered by restart, then by sample
+            n_to_fool = ind_to_fool.numel()
+            rows = ind_to_fool.repeat(self.n_restarts)
+            group = torch.arange(n_to_fool, device=self.device).repeat(self.n_restarts)
+            noise = torch.cat([self.random_noise([n_to_fool, *x.shape[1:]],
+                torch.Generator(device=self.device).manual_seed(int(self.seed) + counter))
+                for counter in range(self.n_restarts)])
+            _, acc_curr, _, adv_curr = self.attack_single_run(x[rows], y[rows], group=group, noise=noise)
+
+            # for each sample, the adversarial example of the first restart that succeeded
+            fooled = ~acc_curr.view(self.n_restarts, n_to_fool)
+            ind_curr = fooled.any(0).nonzero().squeeze(1)
+            first = fooled.float().argmax(0)[ind_curr]
+            acc[ind_to_fool[ind_curr]] = 0
+            adv[ind_to_fool[ind_curr]] = adv_curr[first * n_to_fool + ind_curr].clone()
+            if self.verbose:
+                print('{} parallel restarts - robust accuracy: {:.2%}'.format(
+                    self.n_restarts, acc.float().mean()),
+                    '- cum. time: {:.1f} s'.format(
+                    time.time() - startt))
+
+            return adv
+
         if not best_loss:
             torch.random.manual_seed(self.seed)
             torch.cuda.random.manual_seed(self.seed)
@@ -547,7 +714,7 @@ class APGDAttack():
             x_init = None
         else:
             x_init = x + torch.randn_like(x)
-            x_init += L1_projection(x, x_init - x, 1. * float(epss[0]))
+            x_init += self.l1_projection(x, x_init - x, 1. * float(epss[0]))
         eps_target = float(epss[-1])
         if self.verbose:
             print('total iter: {}'.format(sum(iters)))
@@ -558,7 +725,7 @@ class APGDAttack():
             self.eps = eps + 0.
             #
             if not x_init is None:
-                x_init += L1_projection(x, x_init - x, 1. * eps)
+                x_init += self.l1_projection(x, x_init - x, 1. * eps)
             x_init, acc, loss, x_adv = self.attack_single_run(x, y, x_init=x_init)
 
         return (x_init, acc, loss, x_adv)
@@ -580,17 +747,26 @@ class APGDAttack_targeted(APGDAttack):
             device=None,
             use_largereps=False,
             is_tf_model=False,
-            logger=None):
+            logger=None,
+            multi_target=False,
+            shrink_active=False,
+            parallel_restarts=False,
+            fast_l1=False):
         """
         AutoPGD on the targeted DLR loss
+
+        :param multi_target:  attack all the target classes in one batch, with one row
+                              per (sample, target class), instead of one after the other
         """
         super(APGDAttack_targeted, self).__init__(predict, n_iter=n_iter, norm=norm,
             n_restarts=n_restarts, eps=eps, seed=seed, loss='dlr-targeted',
             eot_iter=eot_iter, rho=rho, topk=topk, verbose=verbose, device=device,
-            use_largereps=use_largereps, is_tf_model=is_tf_model, logger=logger)
+            use_largereps=use_largereps, is_tf_model=is_tf_model, logger=logger,
+            shrink_active=shrink_active, parallel_restarts=parallel_restarts, fast_l1=fast_l1)
 
         self.y_target = None
         self.n_target_classes = n_target_classes
+        self.multi_target = multi_target
 
     def dlr_loss_targeted(self, x, y):
         x_sorted, ind_sorted = x.sort(dim=1)
@@ -603,6 +779,7 @@ class APGDAttack_targeted(APGDAttack):
         return -1. * F.cross_entropy(x, self.y_target, reduction='none')
     
     
+    @attack_input_grad_only
     def perturb(self, x, y=None, x_init=None):
         """
         :param x:           clean images
@@ -652,6 +829,46 @@ class APGDAttack_targeted(APGDAttack):
                 print('using schedule [{}x{}]'.format('+'.join([str(c
                     ) for c in epss]), '+'.join([str(c) for c in iters])))
         
+        if self.multi_target:
+            # the target classes of every sample, from a single sort of the clean logits
+            if not self.is_tf_model:
+                output = self.model(x)
+            else:
+                output = self.model.predict(x)
+            ind_sorted = output.sort(dim=1)[1]
+            target_classes = list(range(2, self.n_target_classes + 2))
+
+            for counter in range(self.n_restarts):
+                ind_to_fool = acc.nonzero().squeeze(1)
+                if ind_to_fool.numel() == 0:
+                    break
+                # rows ordered by target class, then by sample
+                n_to_fool = ind_to_fool.numel()
+                rows = ind_to_fool.repeat(len(target_classes))
+                group = torch.arange(n_to_fool, device=self.device).repeat(len(target_classes))
+                self.y_target = ind_sorted[ind_to_fool][:, [-t for t in target_classes]].t().reshape(-1)
+
+                if not self.use_largereps:
+                    res_curr = self.attack_single_run(x[rows], y[rows], group=group)
+                else:
+                    res_curr = self.decr_eps_pgd(x[rows], y[rows], epss, iters)
+                best_curr, acc_curr, loss_curr, adv_curr = res_curr
+
+                # for each sample, the adversarial example of the first target class that succeeded
+                fooled = ~acc_curr.view(len(target_classes), n_to_fool)
+                ind_curr = fooled.any(0).nonzero().squeeze(1)
+                first = fooled.float().argmax(0)[ind_curr]
+                acc[ind_to_fool[ind_curr]] = 0
+                adv[ind_to_fool[ind_curr]] = adv_curr[first * n_to_fool + ind_curr].clone()
+                if self.verbose:
+                    print('target classes {}-{}'.format(target_classes[0], target_classes[-1]),
+                        '- restart {} - robust accuracy: {:.2%}'.format(
+                        counter, acc.float().mean()),
+                        '- cum. time: {:.1f} s'.format(
+                        time.time() - startt))
+
+            return adv
+
         for target_class in range(2, self.n_target_classes + 2):
             for counter in range(self.n_restarts):
                 ind_to_fool = acc.nonzero().squeeze()
@@ -0,0 +1,125 @@
+import json
+import os
+import time
+
+import torch
+
+
+def model_key(model):
+    # stable across processes, unlike checks.model_fingerprint
+    module = model if isinstance(model, torch.nn.Module) else getattr(model, '__self__', model)
+    if isinstance(module, torch.nn.Module):
+        module = getattr(module, 'module', module)
+        n_params = sum(p.numel() for p in module.parameters())
+        return '{}-{}'.format(type(module).__name__, n_params)
+    return type(module).__name__
+
+
+class BatchSizeTuner():
+    """
+    Picks the batch size of an attack for a given (model, attack, input shape,
+    device): among the powers of two from min_bs to max_bs, the one with the highest
+    throughput (samples/s) of a short `probe` run whose peak memory stays within
+    `memory_fraction` of the device memory (or that does not run out of memory).
+    The choices are cached in a json file shared by all the runs.
+
+    :param cache_path:       json file with the tuned batch sizes
+    :param memory_fraction:  share of the device memory the attack may use
+    :param cpu_max_bs:       largest batch size probed on cpu, where there is no
+                             memory budget to stop the search
+    """
+
+    def __init__(self, cache_path='./cache/batch_sizes.json', memory_fraction=0.8,
+                 min_bs=16, max_bs=4096, cpu_max_bs=256, verbose=False):
+        self.cache_path = cache_path
+        self.memory_fraction = memory_fraction
+        self.min_bs = min_bs
+        self.max_bs = max_bs
+        self.cpu_max_bs = cpu_max_bs
+        self.verbose = verbose
+        self.cache = self._load()
+
+    def _load(self):
+        if self.cache_path is None or not os.path.isfile(self.cache_path):
+            return {}
+        with open(self.cache_path) as f:
+            return json.load(f)
+
+    def _save(self, key, bs):
+        self.cache[key] = bs
+        if self.cache_path is None:
+            return
+        # merge with the entries written by other processes in the meantime
+        cache = dict(self._load(), **{key: bs})
+        os.makedirs(os.path.dirname(self.cache_path) or '.', exist_ok=True)
+        tmp_path = '{}.tmp-{}'.format(self.cache_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(cache, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.cache_path)
+
+    def key(self, model, attack, sample_shape, device):
+        device = torch.device(device)
+        if device.type == 'cuda':
+            device_name = torch.cuda.get_device_name(device)
+        else:
+            # not the thread count, which depends on how many processes share the node
+            device_name = device.type
+        return '|'.join([model_key(model), attack, 'x'.join(map(str, sample_shape)), device_name])
+
+    def _measure(self, probe, x, y, device):
+        # samples/s of probe(x, y), None if it does not fit
+        use_cuda = torch.device(device).type == 'cuda'
+        try:
+            probe(x, y)  # warm-up, e.g. cudnn.benchmark
+            if use_cuda:
+                torch.cuda.synchronize(device)
+                torch.cuda.reset_peak_memory_stats(device)
+            startt = time.time()
+            probe(x, y)
+            if use_cuda:
+                torch.cuda.synchronize(device)
+                budget = self.memory_fraction * torch.cuda.get_device_properties(device).total_memory
+                if torch.cuda.max_memory_allocated(device) > budget:
+                    return None
+            return x.shape[0] / max(time.time() - startt, 1e-6)
+        except torch.cuda.OutOfMemoryError:
+            return None
+        finally:
+            if use_cuda:
+                torch.cuda.empty_cache()
+
+    def batch_size(self, model, attack, probe, x, y, device):
+        """
+        :param probe:   callable(x, y) running a short version of the attack
+        :param x, y:    samples used for the probes, repeated to fill the batches
+        """
+        key = self.key(model, attack, x.shape[1:], device)
+        if key in self.cache:
+            return self.cache[key]
+
+        best_bs, best_rate = self.min_bs, 0.
+        bs = self.min_bs
+        max_bs = self.max_bs if torch.device(device).type == 'cuda' else min(self.max_bs, self.cpu_max_bs)
+        while bs <= max_bs:
+            idx = torch.arange(bs) % x.shape[0]
+            rate = self._measure(probe, x[idx].to(device), y[idx].to(device), device)
+            if self.verbose:
+                print('{} - bs {}: {}'.format(attack, bs, 'does not fit' if rate is None
+                    else '{:.1f} samples/s'.format(rate)))
+            if rate is None:
+                break
+            if rate > best_rate:
+                best_bs, best_rate = bs, rate
+            bs *= 2
+        self._save(key, best_bs)
+        return best_bs
+
+
+_default_tuner = None
+
+
+def get_tuner():
+    global _default_tuner
+    if _default_tuner is None:
+        _default_tuner = BatchSizeTuner()
+    return _default_tuner
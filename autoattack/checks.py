@@ -1,17 +1,12 @@
 import torch
 import warnings
 import math
-import sys
+import weakref
+from torch.utils._python_dispatch import TorchDispatchMode
 
-from autoattack.other_utils import L2_norm
+from autoattack.other_utils import L2_norm, input_grad_only
 
 
-funcs = {'grad': 0,
-    'backward': 0,
-    #'enable_grad': 0
-    '_make_grads': 0,
-    }
-
 checks_doc_path = 'flags_doc.md'
 
 
@@ -86,32 +81,118 @@ def check_square_sr(acc_dict, alpha=.002, logger=None):
                 logger.log(f'Warning: {msg}')
 
 
-''' from https://stackoverflow.com/questions/26119521/counting-function-calls-python '''
-def tracefunc(frame, event, args):
-    if event == 'call' and frame.f_code.co_name in funcs.keys():
-        funcs[frame.f_code.co_name] += 1
+class count_autograd_calls(TorchDispatchMode):
+    """
+    Counts the backward passes run while active, e.g. by a defense that runs an
+    optimization inside its forward pass: the distinct autograd graph tasks in which
+    operators are dispatched, however backward / torch.autograd.grad was reached
+    (including a function bound at import time). Dispatch modes are thread-local and
+    follow the backward to the autograd worker threads, so the other threads (e.g. a
+    BatchPrefetcher) are neither counted nor affected.
+    """
 
-        
-def check_dynamic(model, x, is_tf_model=False, logger=None):
+    def __enter__(self):
+        self.counts = {'backward': 0}
+        self._graph_tasks = set()
+        return super().__enter__()
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        graph_task = torch._C._current_graph_task_id()
+        if graph_task != -1 and graph_task not in self._graph_tasks:
+            self._graph_tasks.add(graph_task)
+            self.counts['backward'] += 1
+        return func(*args, **(kwargs or {}))
+
+
+def _warn_dynamic(counts, is_tf_model=False, logger=None):
     if is_tf_model:
         msg = 'the check for dynamic defenses is not currently supported'
+    elif any([c > 0 for c in counts.values()]):
+        msg = 'it seems to be a dynamic defense! The evaluation' + \
+            ' with AutoAttack might be insufficient.' + \
+            f' See {checks_doc_path} for details.'
     else:
-        msg = None
-        sys.settrace(tracefunc)
-        model(x)
-        sys.settrace(None)
-        #for k, v in funcs.items():
-        #    print(k, v)
-        if any([c > 0 for c in funcs.values()]):
-            msg = 'it seems to be a dynamic defense! The evaluation' + \
-                ' with AutoAttack might be insufficient.' + \
-                f' See {checks_doc_path} for details.'
-    if not msg is None:
-        if logger is None:
-            warnings.warn(Warning(msg))
+        return
+    if logger is None:
+        warnings.warn(Warning(msg))
+    else:
+        logger.log(f'Warning: {msg}')
+
+
+def check_dynamic(model, x, is_tf_model=False, logger=None):
+    counts = {}
+    if not is_tf_model:
+        with count_autograd_calls() as counter:
+            model(x)
+        counts = counter.counts
+    _warn_dynamic(counts, is_tf_model, logger)
+
+
+# model -> (fingerprint, number of classes) for the models already checked, dropped
+# with the model
+_preflight_cache = weakref.WeakKeyDictionary()
+
+
+def model_fingerprint(model):
+    """
+    Identifies the current weights and mode of an nn.Module without reading them:
+    the storage and version counter of every parameter and buffer change with any
+    in-place update (optimizer step, load_state_dict, ...). None for other models.
+    """
+    if not isinstance(model, torch.nn.Module):
+        return None
+    tensors = list(model.parameters()) + list(model.buffers())
+    return (model.training, tuple((t.data_ptr(), t._version) for t in tensors))
+
+
+def preflight(model, forward, x, attacks_to_run, apgd_targets, fab_targets, check_rand=True,
+    is_tf_model=False, logger=None, use_cache=True):
+    """
+    check_randomized, check_range_output and check_dynamic from two forward passes of
+    x (a single one without check_rand), plus check_n_classes. The passes are separate
+    calls so that randomness drawn once per call is detected as well. The result is
+    cached per model and model_fingerprint so that the same model is only checked once.
+    The dynamic check only sees backward passes started from this thread during the
+    first forward pass: an optimization without autograd (e.g. finite differences) or
+    run in another thread is not detected.
+
+    :return:    number of classes
+    """
+    key = model_fingerprint(model) if use_cache else None
+    cached = _preflight_cache.get(model) if key is not None else None
+    if cached is not None and cached[0] == key:
+        n_cls = cached[1]
+    else:
+        counts = {}
+        if is_tf_model:
+            with torch.no_grad():
+                output_1 = forward(x)
+                output_2 = forward(x) if check_rand else None
         else:
-            logger.log(f'Warning: {msg}')
-    #sys.settrace(None)
+            # grad mode is left on for defenses that differentiate inside the forward pass,
+            # but with frozen parameters no graph is kept for the model itself
+            with input_grad_only(model):
+                with count_autograd_calls() as counter:
+                    output_1 = forward(x).detach()
+                output_2 = forward(x).detach() if check_rand else None
+            counts = counter.counts
+        if check_rand:
+            diff = L2_norm(output_1 / (L2_norm(output_1, keepdim=True) + 1e-10) -
+                output_2 / (L2_norm(output_2, keepdim=True) + 1e-10))
+            if (output_1.max(1)[1] != output_2.max(1)[1]).any() or diff.max().item() > 1e-4:
+                msg = 'it seems to be a randomized defense! Please use version="rand".' + \
+                    f' See {checks_doc_path} for details.'
+                if logger is None:
+                    warnings.warn(Warning(msg))
+                else:
+                    logger.log(f'Warning: {msg}')
+        n_cls = check_range_output(lambda _: output_1, x, logger=logger)
+        _warn_dynamic(counts, is_tf_model, logger)
+        if key is not None:
+            # fingerprint after the forward pass, which updates BN statistics in train mode
+            _preflight_cache[model] = (model_fingerprint(model), n_cls)
+    check_n_classes(n_cls, attacks_to_run, apgd_targets, fab_targets, logger=logger)
+    return n_cls
 
 
 def check_n_classes(n_cls, attacks_to_run, apgd_targets, fab_targets,
@@ -14,8 +14,8 @@ import time
 
 import torch
 
-from autoattack.fab_projections import projection_linf, projection_l2,\
-    projection_l1
+from autoattack.fab_projections import get_projection
+from autoattack.other_utils import attack_input_grad_only
 
 DEFAULT_EPS_DICT_BY_NORM = {'Linf': .3, 'L2': 1., 'L1': 5.0}
 
@@ -32,6 +32,11 @@ class FABAttack():
     :param alpha_max:     alpha_max
     :param eta:           overshooting
     :param beta:          backward step
+    :param parallel_restarts: run the n_restarts starts of a sample as rows of the
+                          same batch, the random ones each from its own generator,
+                          and keep the first one that succeeds
+    :param projection:    implementation of the projections onto the hyperplanes,
+                          'reference', 'fused' or 'compiled' (see fab_projections)
     """
 
     def __init__(
@@ -48,7 +53,9 @@ class FABAttack():
             seed=0,
             targeted=False,
             device=None,
-            n_target_classes=9):
+            n_target_classes=9,
+            parallel_restarts=False,
+            projection='reference'):
         """ FAB-attack implementation in pytorch """
 
         self.norm = norm
@@ -64,6 +71,8 @@ class FABAttack():
         self.target_class = None
         self.device = device
         self.n_target_classes = n_target_classes
+        self.parallel_restarts = parallel_restarts
+        self.projection = projection
 
     def check_shape(self, x):
         return x if len(x.shape) > 0 else x.unsqueeze(0)
@@ -80,11 +89,14 @@ class FABAttack():
     def get_diff_logits_grads_batch_targeted(self, imgs, la, la_target):
        raise NotImplementedError("Virtual function.")
 
-    def attack_single_run(self, x, y=None, use_rand_start=False, is_targeted=False):
+    def attack_single_run(self, x, y=None, use_rand_start=False, is_targeted=False, noise=None):
         """
         :param x:             clean images
         :param y:             clean labels, if None we use the predicted labels
+        :param use_rand_start True, or a bool tensor with the samples to start at random
         :param is_targeted    True if we ise targeted version. Targeted class is assigned by `self.target_class`
+        :param noise          direction of the random start of each sample, drawn from
+                              the global generator if None
         """
 
         if self.device is None:
@@ -127,9 +139,17 @@ class FABAttack():
         x1 = im2.clone()
         x0 = im2.clone().reshape([bs, -1])
 
-        if use_rand_start:
-            if self.norm == 'Linf':
+        rand_rows = use_rand_start if torch.is_tensor(use_rand_start) else None
+        if rand_rows is not None or use_rand_start:
+            if noise is not None:
+                t = noise[pred]
+                if len(t.shape) == self.ndims:
+                    t = t.unsqueeze(0)
+            elif self.norm == 'Linf':
                 t = 2 * torch.rand(x1.shape).to(self.device) - 1
+            else:
+                t = torch.randn(x1.shape).to(self.device)
+            if self.norm == 'Linf':
                 x1 = im2 + (torch.min(res2,
                                         self.eps * torch.ones(res2.shape)
                                         .to(self.device)
@@ -138,7 +158,6 @@ class FABAttack():
                                         .max(dim=1, keepdim=True)[0]
                                         .reshape([-1, *[1]*self.ndims])) * .5
             elif self.norm == 'L2':
-                t = torch.randn(x1.shape).to(self.device)
                 x1 = im2 + (torch.min(res2,
                                         self.eps * torch.ones(res2.shape)
                                         .to(self.device)
@@ -149,7 +168,6 @@ class FABAttack():
                                         .sqrt()
                                         .view(t.shape[0], *[1]*self.ndims)) * .5
             elif self.norm == 'L1':
-                t = torch.randn(x1.shape).to(self.device)
                 x1 = im2 + (torch.min(res2,
                                         self.eps * torch.ones(res2.shape)
                                         .to(self.device)
@@ -159,6 +177,8 @@ class FABAttack():
                                         .view(t.shape[0], *[1]*self.ndims)) / 2
 
             x1 = x1.clamp(0.0, 1.0)
+            if rand_rows is not None:
+                x1 = torch.where(rand_rows[pred].view(-1, *[1]*self.ndims), x1, im2)
 
         counter_iter = 0
         while counter_iter < self.n_iter:
@@ -187,21 +207,10 @@ class FABAttack():
                                         .sum(dim=-1))
                 w = dg2.reshape([bs, -1])
 
-                if self.norm == 'Linf':
-                    d3 = projection_linf(
-                        torch.cat((x1.reshape([bs, -1]), x0), 0),
-                        torch.cat((w, w), 0),
-                        torch.cat((b, b), 0))
-                elif self.norm == 'L2':
-                    d3 = projection_l2(
-                        torch.cat((x1.reshape([bs, -1]), x0), 0),
-                        torch.cat((w, w), 0),
-                        torch.cat((b, b), 0))
-                elif self.norm == 'L1':
-                    d3 = projection_l1(
-                        torch.cat((x1.reshape([bs, -1]), x0), 0),
-                        torch.cat((w, w), 0),
-                        torch.cat((b, b), 0))
+                d3 = get_projection(self.norm, self.projection)(
+                    torch.cat((x1.reshape([bs, -1]), x0), 0),
+                    torch.cat((w, w), 0),
+                    torch.cat((b, b), 0))
                 d1 = torch.reshape(d3[:bs], x1.shape)
                 d2 = torch.reshape(d3[-bs:], x1.shape)
                 if self.norm == 'Linf':
@@ -262,6 +271,37 @@ class FABAttack():
 
         return adv_c
 
+    def _parallel_restarts(self, x, y, acc, adv, is_targeted):
+        # all the restarts of the samples still robust in one batch; updates acc and adv
+        ind_to_fool = acc.nonzero().squeeze(1)
+        if ind_to_fool.numel() == 0:
+            return
+        # rows ordered by restart, then by sample; the first restart is not random
+        n_to_fool = ind_to_fool.numel()
+        rows = ind_to_fool.repeat(self.n_restarts)
+        rand_rows = torch.arange(rows.shape[0], device=self.device) >= n_to_fool
+        noise = torch.zeros_like(x[rows])
+        for counter in range(1, self.n_restarts):
+            gen = torch.Generator(device=self.device).manual_seed(int(self.seed) + counter)
+            shape = [n_to_fool, *x.shape[1:]]
+            noise[counter * n_to_fool:(counter + 1) * n_to_fool] = 2 * torch.rand(shape, generator=gen,
+                device=self.device) - 1 if self.norm == 'Linf' else torch.randn(shape, generator=gen,
+                device=self.device)
+        x_to_fool, y_to_fool = x[rows].clone(), y[rows].clone()
+        adv_curr = self.attack_single_run(x_to_fool, y_to_fool, use_rand_start=rand_rows,
+            is_targeted=is_targeted, noise=noise)
+
+        acc_curr = self._predict_fn(adv_curr).max(1)[1] == y_to_fool
+        acc_curr = torch.max(acc_curr, self._lp_norm(x_to_fool - adv_curr) > self.eps)
+
+        # for each sample, the adversarial example of the first restart that succeeded
+        fooled = ~acc_curr.view(self.n_restarts, n_to_fool)
+        ind_curr = fooled.any(0).nonzero().squeeze(1)
+        first = fooled.float().argmax(0)[ind_curr]
+        acc[ind_to_fool[ind_curr]] = 0
+        adv[ind_to_fool[ind_curr]] = adv_curr[first * n_to_fool + ind_curr].clone()
+
+    @attack_input_grad_only
     def perturb(self, x, y):
         if self.device is None:
             self.device = x.device
@@ -274,7 +314,13 @@ class FABAttack():
             torch.random.manual_seed(self.seed)
             torch.cuda.random.manual_seed(self.seed)
 
-            if not self.targeted:
+            if not self.targeted and self.parallel_restarts:
+                self._parallel_restarts(x, y, acc, adv, is_targeted=False)
+                if self.verbose:
+                    print('{} parallel restarts - robust accuracy: {:.2%} at eps = {:.5f} - cum. time: {:.1f} s'.format(
+                        self.n_restarts, acc.float().mean(), self.eps, time.time() - startt))
+
+            elif not self.targeted:
                 for counter in range(self.n_restarts):
                     ind_to_fool = acc.nonzero().squeeze()
                     if len(ind_to_fool.shape) == 0: ind_to_fool = ind_to_fool.unsqueeze(0)
@@ -302,6 +348,12 @@ class FABAttack():
             else:
                 for target_class in range(2, self.n_target_classes + 2):
                     self.target_class = target_class
+                    if self.parallel_restarts:
+                        self._parallel_restarts(x, y, acc, adv, is_targeted=True)
+                        if self.verbose:
+                            print('{} parallel restarts - target_class {} - robust accuracy: {:.2%} at eps = {:.5f} - cum. time: {:.1f} s'.format(
+                                self.n_restarts, self.target_class, acc.float().mean(), self.eps, time.time() - startt))
+                        continue
                     for counter in range(self.n_restarts):
                         ind_to_fool = acc.nonzero().squeeze()
                         if len(ind_to_fool.shape) == 0: ind_to_fool = ind_to_fool.unsqueeze(0)
@@ -327,3 +379,57 @@ class FABAttack():
                                     counter, self.target_class, acc.float().mean(), self.eps, time.time() - startt))
 
         return adv
+
+    def _lp_norm(self, delta):
+        delta = delta.reshape(delta.shape[0], -1)
+        if self.norm == 'Linf':
+            return delta.abs().max(1)[0]
+        elif self.norm == 'L2':
+            return (delta ** 2).sum(dim=-1).sqrt()
+        elif self.norm == 'L1':
+            return delta.abs().sum(-1)
+
+    @attack_input_grad_only
+    def perturb_min_norm(self, x, y):
+        """
+        Minimal-norm mode: runs the untargeted attack and the targeted one for every
+        target class, n_restarts each, on all the points and keeps the smallest
+        successful perturbation, whatever self.eps (only used for the random starts).
+
+        :return:    (norms, adv) with norms 0 for misclassified points and inf for
+                    points never fooled, so that the robust accuracy at any eps is
+                    (norms > eps).float().mean()
+        """
+        if self.device is None:
+            self.device = x.device
+        adv = x.clone()
+        with torch.no_grad():
+            norms = torch.full([x.shape[0]], float('inf'), device=self.device)
+            norms[self._predict_fn(x).max(1)[1] != y] = 0.
+
+            startt = time.time()
+
+            torch.random.manual_seed(self.seed)
+            torch.cuda.random.manual_seed(self.seed)
+
+            runs = [(False, None)] + [(True, c) for c in range(2, self.n_target_classes + 2)]
+            for is_targeted, target_class in runs:
+                self.target_class = target_class
+                for counter in range(self.n_restarts):
+                    ind_to_fool = (norms > 0).nonzero().squeeze(1)
+                    if ind_to_fool.numel() == 0:
+                        break
+                    x_to_fool, y_to_fool = x[ind_to_fool].clone(), y[ind_to_fool].clone()
+                    adv_curr = self.attack_single_run(x_to_fool, y_to_fool, use_rand_start=(counter > 0), is_targeted=is_targeted)
+
+                    fooled = self._predict_fn(adv_curr).max(1)[1] != y_to_fool
+                    res = self._lp_norm(adv_curr - x_to_fool)
+                    ind_curr = (fooled & (res < norms[ind_to_fool])).nonzero().squeeze(1)
+                    norms[ind_to_fool[ind_curr]] = res[ind_curr]
+                    adv[ind_to_fool[ind_curr]] = adv_curr[ind_curr].clone()
+
+                    if self.verbose:
+                        print('restart {} - target_class {} - median norm: {:.5f} - cum. time: {:.1f} s'.format(
+                            counter, target_class, norms.median(), time.time() - startt))
+
+        return norms, adv
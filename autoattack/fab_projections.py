@@ -1,4 +1,5 @@
 import math
+import warnings
 
 import torch
 from torch.nn import functional as F
@@ -160,3 +161,167 @@ def projection_l1(points_to_project, w_hyperplane, b_hyperplane):
         d[c2, indr] = alpha
 
     return d * (w.abs() > 1e-8).float()
+
+
+# Fused versions of the projections above: no clones of the inputs and no boolean
+# indexing, i.e. the binary search runs on all the rows and the cases are merged
+# with torch.where at the end. The shapes do not depend on the data, so they can be
+# compiled with torch.compile (see get_projection).
+
+def _binary_search(lb, ub, nitermax, pred):
+    # largest index in [lb, ub) with pred(index) True, for all the rows at once
+    for counter in range(nitermax):
+        counter4 = torch.floor((lb + ub) / 2)
+        c = pred(counter4.long().unsqueeze(1))
+        lb = torch.where(c, counter4, lb)
+        ub = torch.where(c, ub, counter4)
+    return lb.long()
+
+
+def projection_linf_fused(points_to_project, w_hyperplane, b_hyperplane):
+    t = points_to_project
+    sign = torch.where((w_hyperplane * t).sum(1) - b_hyperplane >= 0, 1., -1.).to(t.dtype)
+    w = w_hyperplane * sign.unsqueeze(1)
+    nz = (w != 0).to(t.dtype)
+
+    a = (w < 0).to(t.dtype)
+    d = (a - t) * nz
+    p = a - t * (2 * a - 1)
+    indp = torch.argsort(p, dim=1)
+
+    b = b_hyperplane * sign - (w * t).sum(1)
+    b0 = (w * d).sum(1)
+
+    indp2 = indp.flip((1,))
+    ws = w.gather(1, indp2)
+    bs2 = - ws * d.gather(1, indp2)
+    s = torch.cumsum(ws.abs(), dim=1)
+    sb = torch.cumsum(bs2, dim=1) + b0.unsqueeze(1)
+
+    b2 = sb[:, -1] - s[:, -1] * p.gather(1, indp[:, 0:1]).squeeze(1)
+    c_l = b - b2 > 0
+    c2 = (b - b0 > 0) & (~c_l)
+
+    def pred(counter2):
+        indcurr = indp.gather(1, indp.size(1) - 1 - counter2)
+        return b - (sb.gather(1, counter2) - s.gather(1, counter2) * p.gather(1, indcurr)).squeeze(1) > 0
+
+    lb = torch.zeros_like(b)
+    lb = _binary_search(lb, torch.full_like(lb, w.shape[1] - 1), math.ceil(math.log2(w.shape[1])), pred)
+
+    lmbd_l = torch.clamp_min((b - sb[:, -1]) / (-s[:, -1]), min=0).unsqueeze(-1)
+    lmbd_2 = torch.clamp_min((b - sb.gather(1, lb.unsqueeze(1)).squeeze(1))
+                             / (-s.gather(1, lb.unsqueeze(1)).squeeze(1)), min=0).unsqueeze(-1)
+    d = torch.where(c_l.unsqueeze(1), (2 * a - 1) * lmbd_l,
+                    torch.where(c2.unsqueeze(1), torch.min(lmbd_2, d) * a + torch.max(-lmbd_2, d) * (1 - a), d))
+
+    return d * nz
+
+
+def projection_l2_fused(points_to_project, w_hyperplane, b_hyperplane):
+    t = points_to_project
+    c = (w_hyperplane * t).sum(1) - b_hyperplane
+    sign = torch.where(c >= 0, 1., -1.).to(t.dtype)
+    w = w_hyperplane * sign.unsqueeze(1)
+    c = c * sign
+    small = w.abs() < 1e-8
+
+    r = torch.max(t / w, (t - 1) / w).clamp(min=-1e12, max=1e12)
+    r = r.masked_fill(small | (r == -1e12), 1e12)
+    rs, indr = torch.sort(r, dim=1)
+    rs2 = F.pad(rs[:, 1:], (0, 1))
+    rs = rs.masked_fill(rs == 1e12, 0)
+    rs2 = rs2.masked_fill(rs2 == 1e12, 0)
+
+    w3s = (w ** 2).gather(1, indr)
+    w5 = w3s.sum(dim=1, keepdim=True)
+    ws = w5 - torch.cumsum(w3s, dim=1)
+    d = -(r * w) * (~small).to(t.dtype)
+    s = torch.cat((-w5 * rs[:, 0:1], torch.cumsum((-rs2 + rs) * ws, dim=1) - w5 * rs[:, 0:1]), 1)
+
+    c4 = s[:, 0] + c < 0
+    c3 = (d * w).sum(dim=1) + c > 0
+    c2 = ~(c4 | c3)
+
+    lb = torch.zeros_like(c)
+    lb = _binary_search(lb, torch.full_like(lb, w.shape[1] - 1), math.ceil(math.log2(w.shape[1])),
+                        lambda counter2: s.gather(1, counter2).squeeze(1) + c > 0).unsqueeze(1)
+
+    alpha4 = (c / w5.squeeze(-1)).unsqueeze(-1)
+    ws_lb = ws.gather(1, lb)
+    alpha2 = (s.gather(1, lb) + c.unsqueeze(1)) / ws_lb + rs.gather(1, lb)
+    alpha2 = torch.where(ws_lb == 0, torch.zeros_like(alpha2), alpha2)
+    c5 = (alpha2 > r).to(t.dtype)
+    d = torch.where(c4.unsqueeze(1), -alpha4 * w,
+                    torch.where(c2.unsqueeze(1), d * c5 - alpha2 * w * (1 - c5), d))
+
+    return d * (~small).to(t.dtype)
+
+
+def projection_l1_fused(points_to_project, w_hyperplane, b_hyperplane):
+    t = points_to_project
+    c = (w_hyperplane * t).sum(1) - b_hyperplane
+    sign = torch.where(c >= 0, 1., -1.).to(t.dtype)
+    w = w_hyperplane * sign.unsqueeze(1)
+    c = c * sign
+
+    r = (1 / w).abs().clamp_max(1e12)
+    indr = torch.argsort(r, dim=1)
+    indr_rev = torch.argsort(indr)
+
+    c6 = (w < 0).to(t.dtype)
+    d = (-t + c6) * (w != 0).to(t.dtype)
+    ds = torch.min(-w * t, w * (1 - t)).gather(1, indr)
+    s = torch.cumsum(torch.cat((c.unsqueeze(-1), ds), 1), dim=1)
+
+    c2 = s[:, -1] < 0
+
+    lb = torch.zeros_like(c)
+    lb = _binary_search(lb, torch.full_like(lb, s.shape[1]), math.ceil(math.log2(w.shape[1])),
+                        lambda counter2: s.gather(1, counter2).squeeze(1) > 0).unsqueeze(1)
+
+    # lb can reach w.shape[1] on the rows without a solution (~c2), which are discarded
+    ind = indr.gather(1, lb.clamp(max=w.shape[1] - 1))
+    alpha = -s.gather(1, lb) / w.gather(1, ind)
+    u2 = torch.arange(0, w.shape[1], device=t.device).unsqueeze(0)
+    u3 = (u2 < lb).gather(1, indr_rev)
+    d2 = (d * u3.to(t.dtype)).scatter(1, ind, alpha)
+    d = torch.where(c2.unsqueeze(1), d2, d)
+
+    return d * (w.abs() > 1e-8).to(t.dtype)
+
+
+PROJECTIONS = {
+    'reference': {'Linf': projection_linf, 'L2': projection_l2, 'L1': projection_l1},
+    'fused': {'Linf': projection_linf_fused, 'L2': projection_l2_fused, 'L1': projection_l1_fused},
+}
+_compiled = {}
+
+
+def _compile(fn):
+    # torch.compile of fn, falling back to fn if the compilation fails on the first call
+    compiled = torch.compile(fn, dynamic=True)
+    state = {'fn': compiled}
+
+    def projection(*args):
+        if state['fn'] is compiled:
+            try:
+                return compiled(*args)
+            except Exception as e:
+                warnings.warn('torch.compile of {} failed ({}), using the eager version'.format(
+                    fn.__name__, e))
+                state['fn'] = fn
+        return state['fn'](*args)
+    return projection
+
+
+def get_projection(norm, implementation='reference'):
+    """
+    :param implementation:  'reference', 'fused', or 'compiled' (the fused version
+                            through torch.compile)
+    """
+    if implementation != 'compiled':
+        return PROJECTIONS[implementation][norm]
+    if norm not in _compiled:
+        _compiled[norm] = _compile(PROJECTIONS['fused'][norm])
+    return _compiled[norm]
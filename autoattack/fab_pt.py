@@ -11,8 +11,10 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import time
+import warnings
 
 import torch
+import torch.nn.functional as F
 
 from autoattack.other_utils import zero_gradients
 from autoattack.fab_base import FABAttack
@@ -30,6 +32,12 @@ class FABAttack_PT(FABAttack):
     :param alpha_max:     alpha_max
     :param eta:           overshooting
     :param beta:          backward step
+    :param jacobian:      'loop' (one backward pass per class) or 'batched' (the
+                          backward passes of grad_chunk classes at once, with
+                          batched grad_outputs)
+    :param topk:          if given, the untargeted attack only considers the topk
+                          classes with the highest logits besides the true one
+    :param grad_chunk:    classes per batched backward pass (all if None)
     """
 
     def __init__(
@@ -47,10 +55,20 @@ class FABAttack_PT(FABAttack):
             seed=0,
             targeted=False,
             device=None,
-            n_target_classes=9):
+            n_target_classes=9,
+            parallel_restarts=False,
+            projection='reference',
+            jacobian='loop',
+            topk=None,
+            grad_chunk=None):
         """ FAB-attack implementation in pytorch """
 
         self.predict = predict
+        assert jacobian in ['loop', 'batched']
+        self.jacobian = jacobian
+        self.topk = topk
+        self.grad_chunk = grad_chunk
+        self._batched_grads = True
         super().__init__(norm,
                          n_restarts,
                          n_iter,
@@ -63,7 +81,9 @@ class FABAttack_PT(FABAttack):
                          seed,
                          targeted,
                          device,
-                         n_target_classes)
+                         n_target_classes,
+                         parallel_restarts,
+                         projection)
 
     def _predict_fn(self, x):
         return self.predict(x)
@@ -74,7 +94,31 @@ class FABAttack_PT(FABAttack):
         _, y = torch.max(outputs, dim=1)
         return y
 
+    def _class_grads(self, im, y, classes):
+        # gradients of y[i, classes[i, j]] w.r.t. im[i], as a [n_classes, bs, ...] tensor
+        g2 = torch.zeros([classes.shape[1], *im.shape], device=self.device)
+        chunk = classes.shape[1] if self.grad_chunk is None else self.grad_chunk
+        for start in range(0, classes.shape[1], chunk):
+            end = min(start + chunk, classes.shape[1])
+            grad_mask = F.one_hot(classes[:, start:end].t(), y.shape[-1]).to(y.dtype)
+            if self.jacobian == 'batched' and self._batched_grads:
+                try:
+                    g2[start:end] = torch.autograd.grad(y, im, grad_mask, retain_graph=True,
+                        is_grads_batched=True)[0].detach()
+                    continue
+                except RuntimeError as e:
+                    # an op of the model without a batching rule
+                    warnings.warn('batched backward not supported ({}), using a loop over the classes'.format(e))
+                    self._batched_grads = False
+            for counter in range(start, end):
+                g2[counter] = torch.autograd.grad(y, im, grad_mask[counter - start],
+                    retain_graph=True)[0].detach()
+        return g2
+
     def get_diff_logits_grads_batch(self, imgs, la):
+        if self.jacobian == 'batched' or self.topk is not None:
+            return self._get_diff_logits_grads_batch_vec(imgs, la)
+
         im = imgs.clone().requires_grad_()
         with torch.enable_grad():
             y = self.predict(im)
@@ -97,6 +141,37 @@ class FABAttack_PT(FABAttack):
 
         return df, dg
 
+    def _get_diff_logits_grads_batch_vec(self, imgs, la):
+        u = torch.arange(imgs.shape[0])
+        im = imgs.clone().requires_grad_()
+        with torch.enable_grad():
+            y = self.predict(im)
+        y2 = y.detach()
+
+        if self.topk is None:
+            # all the classes, the true one included
+            classes = torch.arange(y.shape[-1], device=y.device).repeat(imgs.shape[0], 1)
+        else:
+            # the true class first, then the topk competing ones
+            y_other = y2.clone()
+            y_other[u, la] = -float('inf')
+            competitors = y_other.topk(min(self.topk, y.shape[-1] - 1), dim=1)[1]
+            classes = torch.cat((la.unsqueeze(1), competitors), 1)
+
+        with torch.enable_grad():
+            g2 = self._class_grads(im, y, classes)
+        g2 = torch.transpose(g2, 0, 1)
+
+        if self.topk is None:
+            df = y2 - y2[u, la].unsqueeze(1)
+            dg = g2 - g2[u, la].unsqueeze(1)
+            df[u, la] = 1e10
+        else:
+            df = y2.gather(1, classes[:, 1:]) - y2[u, la].unsqueeze(1)
+            dg = g2[:, 1:] - g2[:, :1]
+
+        return df, dg
+
     def get_diff_logits_grads_batch_targeted(self, imgs, la, la_target):
         u = torch.arange(imgs.shape[0])
         im = imgs.clone().requires_grad_()
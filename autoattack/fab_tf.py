@@ -44,7 +44,9 @@ class FABAttack_TF(FABAttack):
             seed=0,
             targeted=False,
             device=None,
-            n_target_classes=9):
+            n_target_classes=9,
+            parallel_restarts=False,
+            projection='reference'):
         """ FAB-attack implementation in TF2 """
 
         self.model = model
@@ -60,7 +62,9 @@ class FABAttack_TF(FABAttack):
                          seed,
                          targeted,
                          device,
-                         n_target_classes)
+                         n_target_classes,
+                         parallel_restarts,
+                         projection)
     
     def _predict_fn(self, x):
         return self.model.predict(x)
@@ -1,7 +1,9 @@
 import os
+import functools
 import collections.abc as container_abcs
 
 import torch
+import torch.nn as nn
 
 class Logger():
     def __init__(self, log_path):
@@ -56,3 +58,38 @@ def zero_gradients(x):
     elif isinstance(x, container_abcs.Iterable):
         for elem in x:
             zero_gradients(elem)
+
+
+class input_grad_only():
+    """
+    Context manager setting requires_grad=False on the parameters of `model` (a
+    nn.Module or a bound method of one, anything else is left untouched) and
+    restoring the flags on exit: backward passes then compute only the gradient
+    w.r.t. the input and nothing is accumulated in the parameters' .grad.
+    """
+
+    def __init__(self, model):
+        module = model if isinstance(model, nn.Module) else getattr(model, '__self__', None)
+        self.params = list(module.parameters()) if isinstance(module, nn.Module) else []
+
+    def __enter__(self):
+        self.flags = [p.requires_grad for p in self.params]
+        for p in self.params:
+            p.requires_grad_(False)
+        return self
+
+    def __exit__(self, *args):
+        for p, flag in zip(self.params, self.flags):
+            p.requires_grad_(flag)
+
+
+def attack_input_grad_only(f):
+    """ decorator for the attacks' methods, the model is `self.model` or `self.predict` """
+    @functools.wraps(f)
+    def wrapper(self, *args, **kwargs):
+        model = getattr(self, 'model', None)
+        if model is None:
+            model = getattr(self, 'predict', None)
+        with input_grad_only(model):
+            return f(self, *args, **kwargs)
+    return wrapper
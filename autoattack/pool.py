@@ -0,0 +1,68 @@
+class RobustPool():
+    """
+    The samples still robust during run_standard_evaluation, gathered once and
+    compacted after every attack, so that the batches are slices of contiguous
+    tensors instead of a nonzero() and a gather each. The pool stays on the device
+    of x_orig (the host in general) and each batch is moved to the attack device
+    when it is launched.
+
+    The pool keeps the order of the global indices, i.e. its batches are the ones
+    defined on the robust flags at the start of the attack (see EvaluationState).
+    It is not refilled: the batches are full when they are launched (the last one
+    excepted), but the rows an attack retires during its iterations are not
+    replaced, since the attacks run one iteration schedule for the whole batch and
+    the batch indices must stay the same for a resume. The occupancy recorded per
+    attack (see Occupancy) measures the rows left.
+
+    :param x_orig, y_orig:  the whole set
+    :param flags:           robust flags the pool starts from
+    :param device:          device the batches are moved to
+    """
+
+    def __init__(self, x_orig, y_orig, flags, device):
+        self.device = device
+        self.idcs = flags.nonzero().squeeze(1).to(x_orig.device)
+        self.x = x_orig[self.idcs]
+        self.y = y_orig[self.idcs.to(y_orig.device)]
+
+    def __len__(self):
+        return self.idcs.shape[0]
+
+    def compact(self, robust_flags):
+        # keeps the samples not fooled by the last attack
+        keep = robust_flags.to(self.idcs.device)[self.idcs]
+        self.idcs, self.x, self.y = self.idcs[keep], self.x[keep], self.y[keep.to(self.y.device)]
+
+    def batches(self, bs, skip=()):
+        """
+        Yields (batch index, global indices, x, y) for full-width batches of bs samples
+        of the pool (the last one excepted), skipping the batch indices in `skip`, with
+        x and y on the device.
+        """
+        n_batches = (len(self) + bs - 1) // bs
+        for batch_idx in range(n_batches):
+            if batch_idx in skip:
+                continue
+            batch = slice(batch_idx * bs, min((batch_idx + 1) * bs, len(self)))
+            yield batch_idx, self.idcs[batch], self.x[batch].to(self.device), \
+                self.y[batch].to(self.device)
+
+
+class Occupancy():
+    """
+    Average live occupancy of the launched batches: the rows an attack still works
+    on (not fooled yet) over the rows it was launched with, accumulated at every
+    iteration by the attacks given one (APGD and Square). The live counts may be
+    device tensors, they are only read by value().
+    """
+
+    def __init__(self):
+        self.live = 0
+        self.slots = 0
+
+    def update(self, live, width):
+        self.live = self.live + live
+        self.slots += width
+
+    def value(self):
+        return float(self.live) / self.slots if self.slots > 0 else None
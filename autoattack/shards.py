@@ -0,0 +1,147 @@
+import os
+import socket
+import time
+from pathlib import Path
+
+import torch
+
+from autoattack.state import EvaluationState
+
+SHARD_VERSION = 1
+
+
+def shard_range(n, shard_id, n_shards):
+    return shard_id * n // n_shards, (shard_id + 1) * n // n_shards
+
+
+def save_shard(shard, path):
+    tmp_path = path.with_name(path.name + '.tmp')
+    torch.save(shard, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_shard(path):
+    shard = torch.load(path, map_location='cpu')
+    if shard.get('version') != SHARD_VERSION:
+        raise ValueError('{} is not a shard file of version {}'.format(path, SHARD_VERSION))
+    return shard
+
+
+def run_shard(adversary, x_orig, y_orig, shard_id, n_shards, path, bs=250, chunk_size=1000):
+    """
+    Evaluates the samples [shard_id * n / n_shards, (shard_id + 1) * n / n_shards)
+    of the whole set (x_orig, y_orig) and writes a self-describing shard file with
+    their robust flags, adversarial examples and labels, the attack settings and
+    the timings, to be combined by merge_shards.
+
+    The shard is run in chunks of chunk_size samples whose seed is derived from the
+    global index of their first sample. The shard file is updated after every chunk
+    and the chunk in progress keeps an EvaluationState next to it, so a job that is
+    interrupted resumes from the last finished batch. With bs='auto' the batch sizes
+    are tuned once and kept in the shard file: a job rescheduled on another node
+    resumes with the batch sizes its finished batches were defined with.
+    """
+    path = Path(path)
+    n = x_orig.shape[0]
+    start, end = shard_range(n, shard_id, n_shards)
+    settings = {'n': n, 'shard_id': shard_id, 'n_shards': n_shards, 'start': start, 'end': end,
+                'attacks': list(adversary.attacks_to_run), 'norm': adversary.norm,
+                'eps': float(adversary.epsilon), 'version_aa': adversary.version, 'chunk_size': chunk_size}
+
+    if path.exists():
+        shard = load_shard(path)
+        for key, value in settings.items():
+            if shard[key] != value:
+                raise ValueError('{} was created with {}={}, not {}'.format(path, key, shard[key], value))
+        if shard['complete']:
+            return shard
+        base_seed = shard['seed']
+    else:
+        base_seed = int(adversary.get_seed())
+        shard = dict(settings, version=SHARD_VERSION, seed=base_seed, host=socket.gethostname(),
+                     flags=torch.zeros(end - start, dtype=torch.bool), clean_correct=0,
+                     x_adv=x_orig[start:end].clone().cpu(), y_adv=y_orig[start:end].clone().cpu(),
+                     done=[], timings={}, complete=False)
+    if 'batch_sizes' not in shard:
+        # resolved once and saved before any chunk is run
+        if bs == 'auto':
+            shard['batch_sizes'] = adversary.batch_sizes(x_orig[start:end], y_orig[start:end])
+        else:
+            shard['batch_sizes'] = {attack: bs for attack in ['clean'] + list(adversary.attacks_to_run)}
+        save_shard(shard, path)
+
+    try:
+        for c_start in range(start, end, chunk_size):
+            if c_start in shard['done']:
+                continue
+            c_end = min(c_start + chunk_size, end)
+            adversary.seed = base_seed + c_start
+            state_path = path.with_name('{}.chunk{}.state'.format(path.name, c_start))
+            startt = time.time()
+            x_adv, y_adv = adversary.run_standard_evaluation(x_orig[c_start:c_end], y_orig[c_start:c_end],
+                bs=shard['batch_sizes'], return_labels=True, state_path=state_path)
+            state = EvaluationState.from_disk(state_path)
+
+            rel = slice(c_start - start, c_end - start)
+            shard['flags'][rel] = state.robust_flags.cpu()
+            shard['x_adv'][rel] = x_adv.cpu()
+            shard['y_adv'][rel] = y_adv.cpu()
+            shard['clean_correct'] += round(state.clean_accuracy * (c_end - c_start))
+            shard['timings'][c_start] = time.time() - startt
+            shard['done'].append(c_start)
+            save_shard(shard, path)
+            state.delete()
+    finally:
+        adversary.seed = base_seed
+
+    shard['complete'] = True
+    save_shard(shard, path)
+    return shard
+
+
+def merge_shards(paths):
+    """
+    Combines the shard files written by run_shard after checking that they come from
+    the same evaluation, are complete and cover [0, n) exactly once.
+
+    :return:    dict with clean and robust accuracy, robust flags, adversarial
+                examples and labels of the whole set, and the timings
+    """
+    shards = sorted((load_shard(p) for p in paths), key=lambda s: s['start'])
+    if not shards:
+        raise ValueError('no shard to merge')
+    keys = ['n', 'attacks', 'norm', 'eps', 'version_aa', 'seed']
+    errors = []
+    for s in shards:
+        for key in keys:
+            if s[key] != shards[0][key]:
+                errors.append('shard [{}, {}) has {}={}, expected {}'.format(s['start'], s['end'], key, s[key],
+                                                                            shards[0][key]))
+        if not s['complete']:
+            errors.append('shard [{}, {}) is incomplete ({} of {} chunks done)'.format(
+                s['start'], s['end'], len(s['done']), len(range(s['start'], s['end'], s['chunk_size']))))
+    covered = 0
+    for s in shards:
+        if s['start'] > covered:
+            errors.append('samples [{}, {}) are missing'.format(covered, s['start']))
+        elif s['start'] < covered:
+            errors.append('samples [{}, {}) are in more than one shard'.format(s['start'], min(covered, s['end'])))
+        covered = max(covered, s['end'])
+    if covered < shards[0]['n']:
+        errors.append('samples [{}, {}) are missing'.format(covered, shards[0]['n']))
+    if errors:
+        raise ValueError('cannot merge the shards:\n' + '\n'.join(errors))
+
+    n = shards[0]['n']
+    flags = torch.cat([s['flags'] for s in shards])
+    return {
+        'n': n,
+        'attacks': shards[0]['attacks'],
+        'eps': shards[0]['eps'],
+        'clean_accuracy': sum(s['clean_correct'] for s in shards) / n,
+        'robust_accuracy': flags.float().mean().item(),
+        'flags': flags,
+        'x_adv': torch.cat([s['x_adv'] for s in shards]),
+        'y_adv': torch.cat([s['y_adv'] for s in shards]),
+        'timings': {'[{}, {})'.format(s['start'], s['end']): sum(s['timings'].values()) for s in shards},
+    }
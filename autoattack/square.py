@@ -10,12 +10,14 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import copy
 import torch
 import time
 import math
 import torch.nn.functional as F
 
 from autoattack.autopgd_base import L1_projection
+from autoattack.other_utils import attack_input_grad_only
 
 class SquareAttack():
     """
@@ -31,6 +33,18 @@ class SquareAttack():
     :param p_init:        parameter to control size of squares
     :param loss:          loss function optimized ('margin', 'ce' supported)
     :param resc_schedule  adapt schedule of p to n_queries
+    :param n_proposals    Linf only, number of candidate squares evaluated per sample
+                          and iteration, in one forward pass (the best one is kept)
+    :param repack_every   with n_proposals, iterations between two compactions of the
+                          samples still to fool
+    :param screen         None, 'bf16' (autocast) or 'int8' (copy of the model with
+                          dynamically quantized nn.Linear layers, cpu only, rejected
+                          for models with convolutions which it would leave in fp32):
+                          low-precision model used to screen the queries, the ones it
+                          accepts being re-evaluated with the full-precision model
+                          before being accepted. Off by default, since it can change
+                          which proposals are accepted
+    :param inference_mode run the queries under torch.inference_mode
     """
 
     def __init__(
@@ -46,7 +60,11 @@ class SquareAttack():
             targeted=False,
             loss='margin',
             resc_schedule=True,
-            device=None):
+            device=None,
+            n_proposals=1,
+            repack_every=10,
+            screen=None,
+            inference_mode=False):
         """
         Square Attack implementation in PyTorch
         """
@@ -64,13 +82,23 @@ class SquareAttack():
         self.rescale_schedule = resc_schedule
         self.device = device
         self.return_all = False
+        self.n_proposals = n_proposals
+        self.repack_every = repack_every
+        assert screen in [None, 'bf16', 'int8']
+        self.screen = screen
+        self.inference_mode = inference_mode
+        self._screen_predict = None
+        self.query_counts = {'screened': 0, 'verified': 0, 'full': 0}
+        # Occupancy accumulating the rows not fooled yet at every iteration, if any
+        self.occupancy = None
     
-    def margin_and_loss(self, x, y):
+    def margin_and_loss(self, x, y, predict=None):
         """
         :param y:        correct labels if untargeted else target labels
+        :param predict:  model to query instead of self.predict
         """
 
-        logits = self.predict(x)
+        logits = (self.predict if predict is None else predict)(x).float()
         xent = F.cross_entropy(logits, y, reduction='none')
         u = torch.arange(x.shape[0])
         y_corr = logits[u, y].clone()
@@ -85,6 +113,51 @@ class SquareAttack():
         else:
             return y_others - y_corr, xent
 
+    def build_screen(self):
+        # low-precision version of self.predict used to screen the queries
+        if self.screen == 'bf16':
+            device_type = torch.device(self.device).type
+
+            def predict(x):
+                with torch.autocast(device_type=device_type, dtype=torch.bfloat16):
+                    return self.predict(x)
+            return predict
+
+        if not isinstance(self.predict, torch.nn.Module):
+            raise ValueError('int8 screening needs predict to be a torch.nn.Module')
+        if torch.device(self.device).type != 'cpu':
+            raise ValueError('int8 screening is only available on cpu')
+        if any(isinstance(m, torch.nn.modules.conv._ConvNd) for m in self.predict.modules()):
+            raise ValueError("int8 screening only quantizes the nn.Linear layers, use "
+                             "screen='bf16' for models with convolutions")
+        return torch.ao.quantization.quantize_dynamic(copy.deepcopy(self.predict),
+            {torch.nn.Linear}, dtype=torch.qint8)
+
+    def query(self, x, y, loss_min=None):
+        """
+        margin and loss of the proposals x. With a screening model, only the ones that
+        it finds better than loss_min (or misclassified) are evaluated, and accepted
+        or not, with the full-precision model. Without loss_min (the initial points,
+        which the later proposals are compared to) all are in full precision.
+        """
+        if self.screen is None or loss_min is None:
+            self.query_counts['full'] += x.shape[0]
+            return self.margin_and_loss(x, y)
+
+        if self._screen_predict is None:
+            self._screen_predict = self.build_screen()
+        margin, loss = self.margin_and_loss(x, y, predict=self._screen_predict)
+        self.query_counts['screened'] += x.shape[0]
+        candidates = ((loss < loss_min) | (margin <= 0.)).nonzero().squeeze(1)
+        if candidates.numel() > 0:
+            margin_full, loss_full = self.margin_and_loss(x[candidates], y[candidates])
+            margin[candidates], loss[candidates] = margin_full, loss_full
+            self.query_counts['verified'] += candidates.numel()
+        return margin, loss
+
+    def no_grad(self):
+        return torch.inference_mode() if self.inference_mode else torch.no_grad()
+
     def init_hyperparam(self, x):
         assert self.norm in ['Linf', 'L2', 'L1']
         assert not self.eps is None
@@ -218,8 +291,109 @@ class SquareAttack():
 
         return p
 
+    def attack_single_run_proposals(self, x, y):
+        """
+        Linf attack_single_run evaluating n_proposals squares per sample and iteration,
+        each with its own location and signs, in a single forward pass. Every proposal
+        counts as one query of its sample, and the queries of a sample stop at the
+        first proposal that fools the model. The samples still to fool are compacted
+        every repack_every iterations only, i.e. without a sync at every iteration.
+        """
+        with self.no_grad():
+            c, h, w = x.shape[1:]
+            n_features = c * h * w
+            n_ex_total = x.shape[0]
+            u_h = torch.arange(h, device=self.device)
+            u_w = torch.arange(w, device=self.device)
+
+            x_best = torch.clamp(x + self.eps * self.random_choice(
+                [x.shape[0], c, 1, w]), 0., 1.)
+            margin_min, loss_min = self.query(x_best, y)
+            n_queries = torch.ones(x.shape[0]).to(self.device)
+
+            # working set
+            active = torch.arange(n_ex_total, device=self.device)
+            x_curr, x_best_curr, y_curr = x, x_best.clone(), y
+            margin_min_curr, loss_min_curr = margin_min.clone(), loss_min.clone()
+
+            i_iter, q = 0, 0
+            while q < self.n_queries:
+                if i_iter % self.repack_every == 0:
+                    x_best[active], margin_min[active], loss_min[active] = x_best_curr, \
+                        margin_min_curr, loss_min_curr
+                    keep = margin_min_curr > 0.
+                    active = active[keep]
+                    if active.numel() == 0:
+                        break
+                    x_curr, x_best_curr, y_curr = x_curr[keep], x_best_curr[keep], y_curr[keep]
+                    margin_min_curr, loss_min_curr = margin_min_curr[keep], loss_min_curr[keep]
+                    if self.verbose:
+                        print('{}'.format(q),
+                            '- success rate={}/{} ({:.2%})'.format(
+                            n_ex_total - active.numel(), n_ex_total,
+                            1. - active.numel() / n_ex_total),
+                            '- loss={:.3f}'.format(loss_min.mean()))
+
+                n_curr = x_curr.shape[0]
+                n_prop = min(self.n_proposals, self.n_queries - q)
+                p = self.p_selection(q)
+                s = max(int(round(math.sqrt(p * n_features / c))), 1)
+                s = min(s, min(h, w))
+
+                # proposals ordered by proposal, then by sample
+                x_rep = x_curr.repeat(n_prop, 1, 1, 1)
+                x_best_rep = x_best_curr.repeat(n_prop, 1, 1, 1)
+                x_new = x_best_rep.clone()
+                redo = torch.arange(n_prop * n_curr, device=self.device)
+                while redo.numel() > 0:
+                    vh = self.random_int(0, h - s, [redo.numel(), 1])
+                    vw = self.random_int(0, w - s, [redo.numel(), 1])
+                    in_h = (u_h >= vh) & (u_h < vh + s)
+                    in_w = (u_w >= vw) & (u_w < vw + s)
+                    new_deltas = 2. * self.eps * self.random_choice([redo.numel(), c, 1, 1]) * (
+                        in_h[:, None, :, None] & in_w[:, None, None, :]).float()
+                    x_prop = torch.min(torch.max(x_best_rep[redo] + new_deltas, x_rep[redo] - self.eps),
+                        x_rep[redo] + self.eps)
+                    x_new[redo] = torch.clamp(x_prop, 0., 1.)
+                    # a square identical to the current window is resampled, it would be
+                    # a query for nothing
+                    redo = redo[(x_new[redo] - x_best_rep[redo]).abs().flatten(1).max(1)[0] < 1e-7]
+
+                margin, loss = self.query(x_new, y_curr.repeat(n_prop), loss_min_curr.repeat(n_prop))
+                margin, loss = margin.view(n_prop, n_curr), loss.view(n_prop, n_curr)
+
+                # per sample, the first misclassifying proposal, else the lowest loss
+                miscl = margin <= 0.
+                first_miscl = miscl.float().argmax(0)
+                best = torch.where(miscl.any(0), first_miscl, loss.argmin(0))
+                u = torch.arange(n_curr, device=self.device)
+                margin_best, loss_best = margin[best, u], loss[best, u]
+
+                live = margin_min_curr > 0.
+                if self.occupancy is not None:
+                    self.occupancy.update(live.sum(), n_ex_total)
+                idx_improved = (loss_best < loss_min_curr) & live
+                loss_min_curr = torch.where(idx_improved, loss_best, loss_min_curr)
+                idx_improved = idx_improved | (miscl.any(0) & live)
+                margin_min_curr = torch.where(idx_improved, margin_best, margin_min_curr)
+                x_best_curr = torch.where(idx_improved.view(-1, 1, 1, 1),
+                    x_new.view(n_prop, n_curr, c, h, w)[best, u], x_best_curr)
+                n_queries[active] += live.float() * torch.where(miscl.any(0), first_miscl + 1,
+                    torch.full_like(first_miscl, n_prop)).float()
+
+                i_iter += 1
+                q += n_prop
+
+            x_best[active], margin_min[active], loss_min[active] = x_best_curr, \
+                margin_min_curr, loss_min_curr
+
+        return n_queries, x_best
+
     def attack_single_run(self, x, y):
-        with torch.no_grad():
+        if self.norm == 'Linf' and self.n_proposals > 1:
+            return self.attack_single_run_proposals(x, y)
+
+        with self.no_grad():
             adv = x.clone()
             c, h, w = x.shape[1:]
             n_features = c * h * w
@@ -233,7 +407,7 @@ class SquareAttack():
             if self.norm == 'Linf':
                 x_best = torch.clamp(x + self.eps * self.random_choice(
                     [x.shape[0], c, 1, w]), 0., 1.)
-                margin_min, loss_min = self.margin_and_loss(x_best, y)
+                margin_min, loss_min = self.query(x_best, y)
                 n_queries = torch.ones(x.shape[0]).to(self.device)
                 s_init = int(math.sqrt(self.p_init * n_features / c))
                 
@@ -242,6 +416,8 @@ class SquareAttack():
                 
                 for i_iter in range(self.n_queries):
                     idx_to_fool = (margin_min > 0.0).nonzero().squeeze()
+                    if self.occupancy is not None:
+                        self.occupancy.update(idx_to_fool.numel(), x.shape[0])
                     
                     x_curr = self.check_shape(x[idx_to_fool])
                     x_best_curr = self.check_shape(x_best[idx_to_fool])
@@ -266,7 +442,7 @@ class SquareAttack():
                     x_new = torch.clamp(x_new, 0., 1.)
                     x_new = self.check_shape(x_new)
                     
-                    margin, loss = self.margin_and_loss(x_new, y_curr)
+                    margin, loss = self.query(x_new, y_curr, loss_min_curr)
 
                     # update loss if new loss is better
                     idx_improved = (loss < loss_min_curr).float()
@@ -318,7 +494,7 @@ class SquareAttack():
 
                 x_best = torch.clamp(x + self.normalize(delta_init
                     ) * self.eps, 0., 1.)
-                margin_min, loss_min = self.margin_and_loss(x_best, y)
+                margin_min, loss_min = self.query(x_best, y)
                 n_queries = torch.ones(x.shape[0]).to(self.device)
                 s_init = int(math.sqrt(self.p_init * n_features / c))
                 
@@ -327,6 +503,8 @@ class SquareAttack():
 
                 for i_iter in range(self.n_queries):
                     idx_to_fool = (margin_min > 0.0).nonzero().squeeze()
+                    if self.occupancy is not None:
+                        self.occupancy.update(idx_to_fool.numel(), x.shape[0])
 
                     x_curr = self.check_shape(x[idx_to_fool])
                     x_best_curr = self.check_shape(x_best[idx_to_fool])
@@ -380,7 +558,7 @@ class SquareAttack():
                     x_new = self.check_shape(x_new)
                     norms_image = self.lp_norm(x_new - x_curr)
 
-                    margin, loss = self.margin_and_loss(x_new, y_curr)
+                    margin, loss = self.query(x_new, y_curr, loss_min_curr)
 
                     # update loss if new loss is better
                     idx_improved = (loss < loss_min_curr).float()
@@ -437,7 +615,7 @@ class SquareAttack():
                 #    ) * self.eps, 0., 1.)
                 r_best = L1_projection(x, delta_init, self.eps * (1. - 1e-6))
                 x_best = x + delta_init + r_best
-                margin_min, loss_min = self.margin_and_loss(x_best, y)
+                margin_min, loss_min = self.query(x_best, y)
                 n_queries = torch.ones(x.shape[0]).to(self.device)
                 s_init = int(math.sqrt(self.p_init * n_features / c))
                 
@@ -446,6 +624,8 @@ class SquareAttack():
 
                 for i_iter in range(self.n_queries):
                     idx_to_fool = (margin_min > 0.0).nonzero().squeeze()
+                    if self.occupancy is not None:
+                        self.occupancy.update(idx_to_fool.numel(), x.shape[0])
 
                     x_curr = self.check_shape(x[idx_to_fool])
                     x_best_curr = self.check_shape(x_best[idx_to_fool])
@@ -502,7 +682,7 @@ class SquareAttack():
                     x_new = self.check_shape(x_new)
                     norms_image = self.lp_norm(x_new - x_curr)
 
-                    margin, loss = self.margin_and_loss(x_new, y_curr)
+                    margin, loss = self.query(x_new, y_curr, loss_min_curr)
 
                     # update loss if new loss is better
                     idx_improved = (loss < loss_min_curr).float()
@@ -546,6 +726,7 @@ class SquareAttack():
         
         return n_queries, x_best
 
+    @attack_input_grad_only
     def perturb(self, x, y=None):
         """
         :param x:           clean images
@@ -580,6 +761,7 @@ class SquareAttack():
             acc = self.predict(x).max(1)[1] != y
 
         startt = time.time()
+        self.query_counts = {'screened': 0, 'verified': 0, 'full': 0}
 
         torch.random.manual_seed(self.seed)
         torch.cuda.random.manual_seed(self.seed)
@@ -610,6 +792,11 @@ class SquareAttack():
                         '- cum. time: {:.1f} s'.format(
                         time.time() - startt))
 
+        if self.verbose and self.screen is not None:
+            print('queries - {} screened ({}), {} verified and {} initial in full precision'.format(
+                self.query_counts['screened'], self.screen, self.query_counts['verified'],
+                self.query_counts['full']))
+
         if not self.return_all:
             return adv
         else:
@@ -1,59 +1,200 @@
+import io
 import json
-from dataclasses import dataclass, field, asdict
-from datetime import datetime
+import os
+import struct
 from pathlib import Path
 from typing import Optional, Set
 import warnings
 
+import numpy as np
 import torch
 
+# journal record header: attack, batch index, number of points fooled in the batch
+_RECORD = struct.Struct('<32sii')
+
+
+def _pack(flags: torch.Tensor) -> np.ndarray:
+    return np.packbits(flags.cpu().numpy().astype(np.uint8))
+
+
+def _unpack(bits: np.ndarray, n: int) -> torch.Tensor:
+    return torch.from_numpy(np.unpackbits(bits)[:n].astype(bool))
+
 
-@dataclass
 class EvaluationState:
-    _attacks_to_run: Set[str]
-    path: Optional[Path] = None
-    _run_attacks: Set[str] = field(default_factory=set)
-    _robust_flags: Optional[torch.Tensor] = None
-    _last_saved: datetime = datetime(1, 1, 1)
-    _SAVE_TIMEOUT: int = 60
-    _clean_accuracy: float = float("nan")
+    """
+    Progress of run_standard_evaluation. If `path` is given it is kept on disk as:
+
+    - `path`: the committed state, i.e. the attacks already run, the clean accuracy
+      and, as packed bitsets, the clean flags and the robust flags at the start of
+      the current attack. It is replaced atomically after the clean pass and after
+      every attack.
+    - `path`.journal: one record per finished batch of the current attack (attack,
+      batch index, indices and labels of the points it fooled), append-only.
+    - `path`.adv.npy, `path`.yadv.npy: memory-mapped adversarial examples and labels.
+
+    The current robust flags are the committed ones minus the points in the journal.
+    The batches of an attack are defined on the committed flags and on its batch size,
+    which is committed as well (see set_batch_sizes), so a restored evaluation skips
+    the batches already done and still returns the full x_adv.
+    """
+
+    def __init__(self, attacks_to_run: Set[str], path: Optional[Path] = None):
+        self._attacks_to_run = set(attacks_to_run)
+        self.path = None if path is None else Path(path)
+        self._run_attacks = set()
+        self._clean_accuracy = float("nan")
+        self._clean_flags = None
+        self._start_flags = None
+        self._robust_flags = None
+        self._done_batches = {}
+        self._batch_sizes = {}
+        self._adv = None
+        self._y_adv = None
+
+    def _side_path(self, suffix: str) -> Path:
+        return self.path.with_name(self.path.name + suffix)
+
+    def start(self, robust_flags: torch.Tensor, y_pred: torch.Tensor, sample_shape) -> None:
+        # called after the clean pass
+        n = robust_flags.shape[0]
+        self._clean_flags = robust_flags.cpu().clone()
+        self._start_flags = self._clean_flags.clone()
+        self._robust_flags = self._clean_flags.clone()
+        self._clean_accuracy = self._clean_flags.float().mean().item()
+        if self.path is not None:
+            self._adv = np.lib.format.open_memmap(str(self._side_path('.adv.npy')), mode='w+',
+                dtype=np.float32, shape=(n, *sample_shape))
+            self._y_adv = np.lib.format.open_memmap(str(self._side_path('.yadv.npy')), mode='w+',
+                dtype=np.int64, shape=(n,))
+            self._y_adv[:] = y_pred.cpu().numpy()
+            self._y_adv.flush()
+        self.to_disk()
+
+    def record_batch(self, attack: str, batch_idx: int, idcs: torch.Tensor, x_adv: torch.Tensor,
+                     y_adv: torch.Tensor) -> None:
+        # idcs: indices of the points fooled in the batch, x_adv / y_adv their examples and labels
+        idcs = idcs.cpu().reshape(-1)
+        self._robust_flags[idcs] = False
+        self._done_batches.setdefault(attack, set()).add(batch_idx)
+        if self.path is None:
+            return
+        idcs_np = idcs.numpy().astype(np.int64)
+        if idcs_np.size > 0:
+            self._adv[idcs_np] = x_adv.detach().float().cpu().numpy()
+            self._y_adv[idcs_np] = y_adv.cpu().numpy()
+            self._adv.flush()
+            self._y_adv.flush()
+        record = _RECORD.pack(attack.encode(), batch_idx, idcs_np.size) + idcs_np.tobytes() \
+            + y_adv.cpu().numpy().astype(np.int64).tobytes()
+        with self._side_path('.journal').open('ab') as f:
+            f.write(record)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def set_batch_sizes(self, batch_sizes: dict) -> None:
+        # committed without touching the journal of the current attack
+        self._batch_sizes = dict(self._batch_sizes, **batch_sizes)
+        self._write()
 
     def to_disk(self, force: bool = False) -> None:
-        seconds_since_last_save = (datetime.now() -
-                                   self._last_saved).total_seconds()
-        if self.path is None or (seconds_since_last_save < self._SAVE_TIMEOUT
-                                 and not force):
+        if self.path is None:
             return
-        self._last_saved = datetime.now()
-        d = asdict(self)
-        if self.robust_flags is not None:
-            d["_robust_flags"] = d["_robust_flags"].cpu().tolist()
-        d["_run_attacks"] = list(self._run_attacks)
-        with self.path.open("w", ) as f:
-            json.dump(d, f, default=str)
+        self._write()
+        # the records of the attacks committed above are ignored when restoring anyway
+        self._side_path('.journal').open('wb').close()
+
+    def _write(self) -> None:
+        if self.path is None:
+            return
+        meta = {'attacks_to_run': sorted(self._attacks_to_run), 'run_attacks': sorted(self._run_attacks),
+                'clean_accuracy': self._clean_accuracy, 'n': self.n, 'batch_sizes': self._batch_sizes}
+        buffer = io.BytesIO()
+        np.savez(buffer, meta=np.frombuffer(json.dumps(meta).encode(), dtype=np.uint8),
+                 clean_flags=np.zeros(0, np.uint8) if self._clean_flags is None else _pack(self._clean_flags),
+                 start_flags=np.zeros(0, np.uint8) if self._start_flags is None else _pack(self._start_flags))
+        tmp_path = self._side_path('.tmp')
+        with tmp_path.open('wb') as f:
+            f.write(buffer.getvalue())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
 
     @classmethod
     def from_disk(cls, path: Path) -> "EvaluationState":
-        with path.open("r") as f:
-            d = json.load(f)
-        d["_robust_flags"] = torch.tensor(d["_robust_flags"], dtype=torch.bool)
-        d["path"] = Path(d["path"])
-        if path != d["path"]:
-            warnings.warn(
-                UserWarning(
-                    "The given path is different from the one found in the state file."
-                ))
-        d["_last_saved"] = datetime.fromisoformat(d["_last_saved"])
-        return cls(**d)
+        path = Path(path)
+        with np.load(path) as d:
+            meta = json.loads(d['meta'].tobytes().decode())
+            clean_bits, start_bits = d['clean_flags'], d['start_flags']
+        state = cls(set(meta['attacks_to_run']), path=path)
+        state._run_attacks = set(meta['run_attacks'])
+        state._clean_accuracy = meta['clean_accuracy']
+        state._batch_sizes = meta.get('batch_sizes', {})
+        n = meta['n']
+        if n is None:
+            return state
+        state._clean_flags = _unpack(clean_bits, n)
+        state._start_flags = _unpack(start_bits, n)
+        state._robust_flags = state._start_flags.clone()
+        state._adv = np.load(state._side_path('.adv.npy'), mmap_mode='r+')
+        state._y_adv = np.load(state._side_path('.yadv.npy'), mmap_mode='r+')
+
+        journal_path = state._side_path('.journal')
+        data = journal_path.read_bytes() if journal_path.exists() else b''
+        offset = 0
+        while offset + _RECORD.size <= len(data):
+            attack, batch_idx, count = _RECORD.unpack_from(data, offset)
+            end = offset + _RECORD.size + 16 * count
+            if end > len(data):
+                warnings.warn(UserWarning("Ignoring a truncated record at the end of the journal."))
+                break
+            attack = attack.rstrip(b'\0').decode()
+            if attack not in state._run_attacks:
+                idcs = np.frombuffer(data, dtype=np.int64, count=count, offset=offset + _RECORD.size)
+                state._robust_flags[torch.from_numpy(idcs.copy())] = False
+                state._done_batches.setdefault(attack, set()).add(batch_idx)
+            offset = end
+        return state
+
+    def restore_adv(self, x_orig: torch.Tensor, y_orig: torch.Tensor):
+        # x_adv / y_adv of a restored evaluation, from the memory-mapped files
+        x_adv = x_orig.clone().detach()
+        y_adv = torch.from_numpy(np.array(self._y_adv)).to(y_orig.device)
+        fooled = (self._clean_flags & ~self._robust_flags).nonzero().squeeze(1)
+        if fooled.numel() > 0:
+            x_adv[fooled.to(x_adv.device)] = torch.from_numpy(self._adv[fooled.numpy()]).to(
+                x_adv.device, x_adv.dtype)
+        return x_adv, y_adv
+
+    def delete(self) -> None:
+        self._adv, self._y_adv = None, None
+        if self.path is None:
+            return
+        for p in [self.path, self._side_path('.journal'), self._side_path('.adv.npy'),
+                  self._side_path('.yadv.npy'), self._side_path('.tmp')]:
+            if p.exists():
+                p.unlink()
 
     @property
     def robust_flags(self) -> Optional[torch.Tensor]:
         return self._robust_flags
 
-    @robust_flags.setter
-    def robust_flags(self, robust_flags: torch.Tensor) -> None:
-        self._robust_flags = robust_flags
-        self.to_disk(force=True)
+    @property
+    def start_flags(self) -> Optional[torch.Tensor]:
+        # robust flags at the start of the current attack, on which its batches are defined
+        return self._start_flags
+
+    def done_batches(self, attack: str) -> Set[int]:
+        return self._done_batches.get(attack, set())
+
+    @property
+    def batch_sizes(self) -> dict:
+        # batch sizes of the clean pass and of the attacks, as committed
+        return self._batch_sizes
+
+    @property
+    def n(self) -> Optional[int]:
+        return None if self._clean_flags is None else self._clean_flags.shape[0]
 
     @property
     def run_attacks(self) -> Set[str]:
@@ -61,12 +202,14 @@ class EvaluationState:
 
     def add_run_attack(self, attack: str) -> None:
         self._run_attacks.add(attack)
+        self._start_flags = self._robust_flags.clone()
+        self._done_batches.pop(attack, None)
         self.to_disk()
-        
+
     @property
     def attacks_to_run(self) -> Set[str]:
         return self._attacks_to_run
-    
+
     @attacks_to_run.setter
     def attacks_to_run(self, _: Set[str]) -> None:
         raise ValueError("attacks_to_run cannot be set outside of the constructor")
@@ -75,11 +218,6 @@ class EvaluationState:
     def clean_accuracy(self) -> float:
         return self._clean_accuracy
 
-    @clean_accuracy.setter
-    def clean_accuracy(self, accuracy) -> None:
-        self._clean_accuracy = accuracy
-        self.to_disk(force=True)
-
     @property
     def robust_accuracy(self) -> float:
         if self.robust_flags is None:
@@ -87,4 +225,4 @@ class EvaluationState:
         if self.attacks_to_run - self.run_attacks:
             warnings.warn("You are checking `robust_accuracy` before all the attacks"
                           " have been run.")
-        return self.robust_flags.float().mean().item()
\ No newline at end of file
+        return self.robust_flags.float().mean().item()
@@ -0,0 +1,153 @@
+import threading
+from queue import Queue
+
+import numpy as np
+import torch
+
+
+class RobustBitset():
+    """
+    Robustness flags of n samples, packed 8 per byte.
+    """
+
+    def __init__(self, n):
+        self.n = n
+        self.bits = np.zeros((n + 7) // 8, dtype=np.uint8)
+
+    def update(self, start, flags):
+        flags = np.asarray(torch.as_tensor(flags).cpu(), dtype=np.uint8)
+        end = start + flags.shape[0]
+        assert 0 <= start and end <= self.n
+        b0, b1 = start // 8, (end + 7) // 8
+        bits = np.unpackbits(self.bits[b0:b1])
+        bits[start - 8 * b0:end - 8 * b0] = flags
+        self.bits[b0:b1] = np.packbits(bits)
+
+    def count(self):
+        return int(np.unpackbits(self.bits)[:self.n].sum())
+
+    def to_tensor(self):
+        return torch.from_numpy(np.unpackbits(self.bits)[:self.n].astype(bool))
+
+
+class AdvStore():
+    """
+    Adversarial examples written to an on-disk memory-mapped .npy file instead
+    of being kept in memory.
+    """
+
+    def __init__(self, path, n, sample_shape, dtype=np.float32):
+        self.path = path
+        self.data = np.lib.format.open_memmap(str(path), mode='w+', dtype=dtype,
+            shape=(n, *sample_shape))
+
+    def write(self, start, x_adv):
+        x_adv = x_adv.detach().cpu().numpy()
+        self.data[start:start + x_adv.shape[0]] = x_adv
+
+    def flush(self):
+        self.data.flush()
+
+
+def iterate_chunks(loader, chunk_size, max_inflight=2):
+    """
+    Groups the batches of `loader` into (start, x, y) chunks of `chunk_size`
+    samples kept on the cpu. With max_inflight > 1 the chunks are assembled in a
+    background thread and at most max_inflight - 1 of them wait in the queue.
+    """
+
+    def assemble():
+        xs, ys, n, start = [], [], 0, 0
+        for x, y in loader:
+            xs.append(x.cpu())
+            ys.append(y.cpu())
+            n += x.shape[0]
+            while n >= chunk_size:
+                x_all, y_all = torch.cat(xs, 0), torch.cat(ys, 0)
+                yield start, x_all[:chunk_size], y_all[:chunk_size]
+                xs, ys = [x_all[chunk_size:]], [y_all[chunk_size:]]
+                n -= chunk_size
+                start += chunk_size
+        if n > 0:
+            yield start, torch.cat(xs, 0), torch.cat(ys, 0)
+
+    if max_inflight <= 1:
+        yield from assemble()
+        return
+
+    queue = Queue(maxsize=max_inflight - 1)
+    stop = threading.Event()
+
+    def producer():
+        try:
+            for chunk in assemble():
+                if stop.is_set():
+                    return
+                queue.put(chunk)
+        except Exception as e:
+            queue.put(e)
+        finally:
+            queue.put(None)
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+    try:
+        while True:
+            chunk = queue.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        stop.set()
+        while thread.is_alive():
+            while not queue.empty():
+                queue.get_nowait()
+            thread.join(timeout=0.01)
+
+
+def run_streaming_evaluation(adversary, loader, n_samples=None, chunk_size=1000,
+                             max_inflight=2, bs=250, adv_path=None, adv_store=None):
+    """
+    Runs `adversary.run_standard_evaluation` chunk by chunk over a DataLoader, so
+    that only the chunks in flight are kept in memory. The robust flags are kept
+    in a RobustBitset and, if `adv_path` is given, the adversarial examples are
+    written to a memory-mapped .npy file there. Any other `adv_store` object with
+    a `write(start, x_adv)` method can be given instead.
+
+    The seed of each chunk is derived from the global index of its first sample.
+
+    :return:    (robust accuracy, RobustBitset, AdvStore or None)
+    """
+
+    if n_samples is None:
+        n_samples = len(loader.dataset)
+    flags = RobustBitset(n_samples)
+    store = adv_store
+    base_seed = adversary.seed
+    n_done = 0
+    try:
+        for start, x, y in iterate_chunks(loader, chunk_size, max_inflight):
+            if base_seed is not None:
+                adversary.seed = base_seed + start
+            x_adv, y_adv = adversary.run_standard_evaluation(x, y, bs=bs,
+                return_labels=True)
+            flags.update(start, y_adv.cpu().eq(y))
+            if adv_path is not None or adv_store is not None:
+                if store is None:
+                    store = AdvStore(adv_path, n_samples, x.shape[1:])
+                store.write(start, x_adv)
+            n_done = start + x.shape[0]
+            if adversary.verbose:
+                adversary.logger.log('chunk {}-{}: robust accuracy so far {:.2%}'.format(
+                    start, n_done, flags.count() / n_done))
+            del x, y, x_adv, y_adv
+    finally:
+        adversary.seed = base_seed
+    assert n_done == n_samples, 'the loader yielded {} samples instead of {}'.format(
+        n_done, n_samples)
+    if isinstance(store, AdvStore):
+        store.flush()
+
+    return flags.count() / n_samples, flags, store
@@ -0,0 +1,199 @@
+import argparse
+import time
+
+import torch
+
+import models
+from autoattack.autopgd_base import APGDAttack, L1_projection, L1_projection_fast
+from autoattack.fab_projections import get_projection
+from autoattack.square import SquareAttack
+
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+IMPLEMENTATIONS = ['reference', 'fused', 'compiled']
+
+
+def timed(fn, *args, repeat: int = 10) -> float:
+    # average time of fn(*args) in ms, after a warm-up call (e.g. the compilation)
+    fn(*args)
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    startt = time.time()
+    for _ in range(repeat):
+        fn(*args)
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    return 1000. * (time.time() - startt) / repeat
+
+
+def random_hyperplanes(n: int, dim: int, seed: int = 0):
+    # points in the box, and hyperplanes through another point of the box, some of
+    # the coordinates of w being zero as for the gradients of FAB
+    gen = torch.Generator().manual_seed(seed)
+    t = torch.rand(n, dim, generator=gen)
+    w = torch.randn(n, dim, generator=gen)
+    w[torch.rand(n, dim, generator=gen) < .05] = 0.
+    b = (w * torch.rand(n, dim, generator=gen)).sum(1)
+    return t.to(device), w.to(device), b.to(device)
+
+
+def check_projections(dims, batch_sizes, seeds=range(5), atol=1e-4) -> bool:
+    """
+    Compares the fused and compiled projections to the reference ones on random
+    hyperplanes, and checks that the projected points stay in the box.
+    """
+    ok = True
+    for norm in ['Linf', 'L2', 'L1']:
+        reference = get_projection(norm, 'reference')
+        for dim in dims:
+            for n in batch_sizes:
+                for seed in seeds:
+                    t, w, b = random_hyperplanes(n, dim, seed)
+                    d_ref = reference(t, w, b)
+                    for implementation in IMPLEMENTATIONS[1:]:
+                        d = get_projection(norm, implementation)(t, w, b)
+                        err = (d - d_ref).abs().max().item()
+                        in_box = ((t + d) >= -atol).all().item() and ((t + d) <= 1 + atol).all().item()
+                        if err > atol * max(1., d_ref.abs().max().item()) or not in_box:
+                            ok = False
+                            print('{} {} dim {} bs {} seed {}: max diff {:.2e}, in box {}'.format(
+                                norm, implementation, dim, n, seed, err, in_box))
+    print('projections: {}'.format('ok' if ok else 'MISMATCH'))
+    return ok
+
+
+def bench_projections(dims, batch_sizes, repeat: int = 10) -> None:
+    print('{:<6}{:>8}{:>6}'.format('norm', 'dim', 'bs') + ''.join('{:>12}'.format(i) for i in IMPLEMENTATIONS))
+    for norm in ['Linf', 'L2', 'L1']:
+        for dim in dims:
+            for n in batch_sizes:
+                t, w, b = random_hyperplanes(n, dim)
+                times = [timed(get_projection(norm, i), t, w, b, repeat=repeat) for i in IMPLEMENTATIONS]
+                print('{:<6}{:>8}{:>6}'.format(norm, dim, n) + ''.join('{:>10.2f}ms'.format(ms) for ms in times))
+
+
+def check_l1_projection(dims, batch_sizes, seeds=range(5), eps=12., atol=1e-4) -> bool:
+    ok = True
+    for dim in dims:
+        for n in batch_sizes:
+            for seed in seeds:
+                gen = torch.Generator().manual_seed(seed)
+                x = torch.rand(n, dim, generator=gen).to(device)
+                y = (torch.randn(n, dim, generator=gen) * torch.rand(n, 1, generator=gen)).to(device)
+                d_ref = L1_projection(x, y, eps)
+                d = L1_projection_fast(x, y, eps)
+                err = (d - d_ref).abs().max().item()
+                l1 = (y + d).abs().sum(1).max().item()
+                if err > atol * max(1., d_ref.abs().max().item()) or l1 > eps * (1 + 1e-4):
+                    ok = False
+                    print('L1 projection dim {} bs {} seed {}: max diff {:.2e}, L1 norm {:.4f}'.format(
+                        dim, n, seed, err, l1))
+    print('L1 projection: {}'.format('ok' if ok else 'MISMATCH'))
+    return ok
+
+
+def bench_l1(dims, batch_sizes, arch: str, bs: int, n_iter: int, eps: float, repeat: int = 10) -> None:
+    print('{:>8}{:>6}{:>12}{:>12}'.format('dim', 'bs', 'reference', 'fast'))
+    for dim in dims:
+        for n in batch_sizes:
+            x = torch.rand(n, dim, device=device)
+            y = torch.randn(n, dim, device=device)
+            times = [timed(fn, x, y, eps, repeat=repeat) for fn in [L1_projection, L1_projection_fast]]
+            print('{:>8}{:>6}'.format(dim, n) + ''.join('{:>10.2f}ms'.format(ms) for ms in times))
+
+    # end to end, L1-APGD on a randomly initialized CIFAR-10 model
+    net = getattr(models, arch)(Num_class=10).to(device).eval()
+    x = torch.rand(bs, 3, 32, 32, device=device)
+    y = net(x).max(1)[1].detach()
+    for fast_l1 in [False, True]:
+        apgd = APGDAttack(net, norm='L1', eps=eps, n_iter=n_iter, n_restarts=1, seed=0, device=device,
+                          fast_l1=fast_l1)
+        startt = time.time()
+        adv = apgd.perturb(x, y)
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        with torch.no_grad():
+            acc = net(adv).max(1)[1].eq(y).float().mean().item()
+        print('L1-APGD {} ({} x {} iterations): {:.2f}s, robust accuracy {:.2%}'.format(
+            'fast' if fast_l1 else 'reference', bs, n_iter, time.time() - startt, acc))
+
+
+def bench_square(arch: str, bs: int, n_queries: int, eps: float, screens) -> bool:
+    """
+    Linf-Square with the full-precision model and with the screened queries: time,
+    queries per path, robust accuracy (which the final check in full precision keeps
+    from being overestimated by the screening) and the number of samples whose
+    status differs from the full-precision run.
+    """
+    net = getattr(models, arch)(Num_class=10).to(device).eval()
+    x = torch.rand(bs, 3, 32, 32, device=device)
+    with torch.no_grad():
+        y = net(x).max(1)[1]
+    flags = {}
+    print('{:<8}{:>10}{:>12}{:>12}{:>12}{:>10}{:>10}'.format('screen', 'time', 'full', 'screened', 'verified',
+                                                            'robust', 'differ'))
+    for screen in [None] + list(screens):
+        square = SquareAttack(net, p_init=.8, n_queries=n_queries, eps=eps, norm='Linf', n_restarts=1,
+                              seed=0, device=device, screen=screen, inference_mode=True)
+        startt = time.time()
+        adv = square.perturb(x, y)
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        elapsed = time.time() - startt
+        with torch.no_grad():
+            flags[screen] = net(adv).max(1)[1].eq(y)
+        q = square.query_counts
+        print('{:<8}{:>9.2f}s{:>12}{:>12}{:>12}{:>10.2%}{:>10}'.format(str(screen), elapsed, q['full'],
+            q['screened'], q['verified'], flags[screen].float().mean().item(),
+            (flags[screen] != flags[None]).sum().item()))
+    ok = all(f.sum() == flags[None].sum() for f in flags.values())
+    print('robust accuracy: {}'.format('unchanged' if ok else 'CHANGED'))
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of the attack kernels')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    proj = subparsers.add_parser('projections', help='FAB projections onto the hyperplanes')
+    # FAB projects 2 * bs points per iteration
+    proj.add_argument('--dims', type=int, nargs='+', default=[3072, 12288, 150528])
+    proj.add_argument('--batch-sizes', type=int, nargs='+', default=[64, 256, 1000])
+    proj.add_argument('--repeat', type=int, default=10)
+    proj.add_argument('--check-only', action='store_true')
+    l1 = subparsers.add_parser('l1', help='L1 projection and L1-APGD')
+    l1.add_argument('--dims', type=int, nargs='+', default=[3072, 150528])
+    l1.add_argument('--batch-sizes', type=int, nargs='+', default=[64, 256])
+    l1.add_argument('--repeat', type=int, default=10)
+    l1.add_argument('--arch', default='ResNet18')
+    l1.add_argument('--bs', type=int, default=256)
+    l1.add_argument('--n-iter', type=int, default=100)
+    l1.add_argument('--eps', type=float, default=12.)
+    l1.add_argument('--check-only', action='store_true')
+    square = subparsers.add_parser('square', help='Linf-Square with screened queries')
+    square.add_argument('--arch', default='ResNet18')
+    square.add_argument('--bs', type=int, default=256)
+    square.add_argument('--n-queries', type=int, default=1000)
+    square.add_argument('--eps', type=float, default=8. / 255.)
+    # int8 only applies to models without convolutions
+    square.add_argument('--screens', nargs='+', default=['bf16'], choices=['bf16', 'int8'])
+    args = parser.parse_args()
+
+    if args.command == 'projections':
+        ok = check_projections(args.dims, [8, 64])
+        if not args.check_only:
+            bench_projections(args.dims, args.batch_sizes, args.repeat)
+        if not ok:
+            raise SystemExit(1)
+    elif args.command == 'l1':
+        ok = check_l1_projection(args.dims, [8, 64], eps=args.eps)
+        if not args.check_only:
+            bench_l1(args.dims, args.batch_sizes, args.arch, args.bs, args.n_iter, args.eps, args.repeat)
+        if not ok:
+            raise SystemExit(1)
+    elif args.command == 'square':
+        if not bench_square(args.arch, args.bs, args.n_queries, args.eps, args.screens):
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+import hashlib
+import json
+import os
+import shutil
+from typing import Optional
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch import Tensor
+
+from autoattack.streaming import RobustBitset
+
+
+def weights_hash(net: nn.Module) -> str:
+    # sha256 of the state_dict, independent of a DataParallel wrapper
+    h = hashlib.sha256()
+    for name, tensor in sorted(net.state_dict().items()):
+        h.update(name.replace('module.', '', 1).encode())
+        h.update(str(tensor.dtype).encode())
+        h.update(tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+    return h.hexdigest()
+
+
+def data_ident(dataset: str, norm: bool, labels: Tensor) -> dict:
+    # what the evaluated set is made of: two sets of the same size differ by their labels
+    h = hashlib.sha256(labels.detach().cpu().long().numpy().tobytes()).hexdigest()
+    return {'dataset': dataset, 'norm': bool(norm), 'labels': h}
+
+
+def quantize(x: Tensor, dtype: str) -> np.ndarray:
+    x = x.detach().cpu()
+    if dtype == 'uint8':
+        return (x * 255.).round_().clamp_(0, 255).to(torch.uint8).numpy()
+    return x.to(torch.float16).numpy()
+
+
+def dequantize(x: np.ndarray) -> Tensor:
+    x = torch.from_numpy(np.ascontiguousarray(x))
+    if x.dtype == torch.uint8:
+        return x.float() / 255.
+    return x.float()
+
+
+class CacheEntry:
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        bits = np.load(os.path.join(path, 'flags.npy'))
+        self.flags = torch.from_numpy(np.unpackbits(bits)[:self.meta['n']].astype(bool))
+        adv_path = os.path.join(path, 'adv.npy')
+        self._adv = np.load(adv_path, mmap_mode='r') if os.path.isfile(adv_path) else None
+
+    def accuracy(self) -> float:
+        return self.flags.float().mean().item()
+
+    @property
+    def has_adv(self) -> bool:
+        return self._adv is not None
+
+    def adv(self, start: int, end: int) -> Tensor:
+        # relative to the cached slice
+        return dequantize(self._adv[start:end])
+
+    def adv_rows(self, idx: Tensor) -> Tensor:
+        return dequantize(self._adv[idx.cpu().numpy()])
+
+
+class CacheEntryWriter:
+    def __init__(self, cache: 'EvalCache', key: str, n: int, meta: dict):
+        self.cache = cache
+        self.key = key
+        self.n = n
+        self.meta = dict(meta, n=n, adv_dtype=cache.adv_dtype)
+        self.tmp_path = os.path.join(cache.root, f'{key}.tmp-{os.getpid()}')
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+        os.makedirs(self.tmp_path)
+        self.flags = RobustBitset(n)
+        self.adv = None
+
+    def write(self, start: int, flags: Tensor, x_adv: Optional[Tensor] = None) -> None:
+        self.flags.update(start, flags)
+        if x_adv is not None:
+            self.write_adv(start, x_adv)
+
+    def _quantize(self, x_adv: Tensor) -> np.ndarray:
+        x_adv = quantize(x_adv, self.cache.adv_dtype)
+        if self.adv is None:
+            self.adv = np.lib.format.open_memmap(os.path.join(self.tmp_path, 'adv.npy'), mode='w+',
+                                                 dtype=x_adv.dtype, shape=(self.n, *x_adv.shape[1:]))
+        return x_adv
+
+    def write_adv(self, start: int, x_adv: Tensor) -> None:
+        if self.cache.adv_dtype is not None:
+            x_adv = self._quantize(x_adv)
+            self.adv[start:start + x_adv.shape[0]] = x_adv
+
+    def write_rows(self, idx: Tensor, x_adv: Tensor) -> None:
+        # adversarial examples of the samples idx only, the other rows are left at 0
+        if self.cache.adv_dtype is not None and idx.numel() > 0:
+            x_adv = self._quantize(x_adv)
+            self.adv[idx.cpu().numpy()] = x_adv
+
+    def commit(self) -> CacheEntry:
+        if self.adv is not None:
+            self.adv.flush()
+            del self.adv
+        np.save(os.path.join(self.tmp_path, 'flags.npy'), self.flags.bits)
+        with open(os.path.join(self.tmp_path, 'meta.json'), 'w') as f:
+            json.dump(self.meta, f, indent=2)
+        final_path = os.path.join(self.cache.root, self.key)
+        shutil.rmtree(final_path, ignore_errors=True)
+        os.replace(self.tmp_path, final_path)
+        return CacheEntry(final_path)
+
+    def abort(self) -> None:
+        if self.adv is not None:
+            del self.adv
+            self.adv = None
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+    def __enter__(self) -> 'CacheEntryWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> bool:
+        # an attack that raises leaves no partial entry behind
+        if exc_type is not None:
+            self.abort()
+        return False
+
+
+class EvalCache:
+    """
+    Content-addressed cache of evaluation results. An entry is keyed by the hash of
+    (model weights, attack name + hyperparameters, dataset (see data_ident) and slice,
+    seed) and holds the per-sample correctness bits and, optionally, the adversarial
+    examples as a memory-mapped uint8 (lossy, 1/255 steps) or float16 array. The stored examples
+    can be evaluated against other checkpoints (see utils_test.evaluate_transfer).
+    """
+
+    def __init__(self, root: str = './cache/eval', adv_dtype: Optional[str] = 'float16'):
+        assert adv_dtype in [None, 'uint8', 'float16']
+        self.root = root
+        self.adv_dtype = adv_dtype
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def key(weights: str, attack: str, params: dict, data: dict, data_slice, seed) -> str:
+        ident = json.dumps({'weights': weights, 'attack': attack, 'params': params, 'data': data,
+                            'slice': list(data_slice), 'seed': seed}, sort_keys=True, default=str)
+        return hashlib.sha256(ident.encode()).hexdigest()
+
+    def load(self, key: str) -> Optional[CacheEntry]:
+        path = os.path.join(self.root, key)
+        if not os.path.isfile(os.path.join(path, 'meta.json')):
+            return None
+        return CacheEntry(path)
+
+    def writer(self, key: str, n: int, **meta) -> CacheEntryWriter:
+        return CacheEntryWriter(self, key, n, meta)
@@ -0,0 +1,118 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Tuple
+
+import torch
+import torch.multiprocessing as mp
+import yaml
+from easydict import EasyDict
+
+import models
+from utils import create_dataloader
+from utils_test import load_test_set, build_attack_suite, evaluate_cascade
+
+logger = logging.getLogger(__name__)
+
+_x_test, _y_test, _config = None, None, None
+
+
+def job_key(job) -> str:
+    # readable prefix + hash of everything that identifies the job
+    ident = '|'.join([job.Arch, os.path.abspath(job.Checkpoint), job.Suite])
+    digest = hashlib.sha1(ident.encode()).hexdigest()[:12]
+    return f'{job.Arch}_{job.Suite}_{digest}'
+
+
+def build_model(arch: str, config) -> torch.nn.Module:
+    # same set-up as test_robust.py
+    net = getattr(models, arch)(Num_class=config.DATA.num_class)
+    net.Num_class = config.DATA.num_class
+    if config.Operation.Method == 'AT':
+        net.Norm = True
+        net.norm_mean = torch.tensor(config.DATA.mean)
+        net.norm_std = torch.tensor(config.DATA.std)
+    else:
+        net.Norm = False
+    return net
+
+
+def load_model(arch: str, path: str, config, device) -> Tuple[torch.nn.Module, dict]:
+    net = build_model(arch, config)
+    checkpoint = torch.load(path, map_location='cpu')
+    net.load_state_dict({k.replace('module.', '', 1): v for k, v in checkpoint['state_dict'].items()})
+    net = net.to(device)
+    if net.Norm:
+        net.norm_mean, net.norm_std = net.norm_mean.to(device), net.norm_std.to(device)
+    net.eval()
+    return net, checkpoint
+
+
+def _init_worker(x_test, y_test, config, n_workers):
+    global _x_test, _y_test, _config
+    _x_test, _y_test, _config = x_test, y_test, config
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // n_workers))
+    if torch.cuda.is_available():
+        worker_id = mp.current_process()._identity[0] - 1
+        torch.cuda.set_device(worker_id % torch.cuda.device_count())
+
+
+def run_job(job) -> dict:
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    start = time.time()
+    suite_config = _config.Suites[job.Suite]
+    net, checkpoint = load_model(job.Arch, job.Checkpoint, _config, device)
+
+    attack_suite = build_attack_suite(suite_config, list(suite_config.Autoattack))
+    results = evaluate_cascade(net, _x_test, _y_test, attack_suite)
+    record = {
+        'arch': job.Arch,
+        'checkpoint': job.Checkpoint,
+        'epoch': checkpoint.get('epoch'),
+        'suite': job.Suite,
+        'results': results,
+        'time': time.time() - start,
+    }
+    path = os.path.join(_config.Operation.Result_path, job_key(job) + '.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(record, f, indent=2)
+    os.replace(path + '.tmp', path)
+    return record
+
+
+def main(config_path='configs_sweep.yml'):
+    with open(config_path) as f:
+        config = EasyDict(yaml.load(f, Loader=yaml.FullLoader))
+    logging.basicConfig(format='[%(asctime)s] - %(message)s', datefmt='%Y/%m/%d %H:%M:%S',
+                        level=logging.INFO)
+    os.makedirs(config.Operation.Result_path, exist_ok=True)
+
+    jobs = [job for job in config.Jobs
+            if not os.path.isfile(os.path.join(config.Operation.Result_path, job_key(job) + '.json'))]
+    logger.info(f'{len(config.Jobs) - len(jobs)} jobs already done, {len(jobs)} to run')
+    if not jobs:
+        return
+
+    # the test set is decoded once and shared with the workers
+    _, test_loader = create_dataloader(config.DATA.Data, Norm=config.Operation.Method != 'AT')
+    x_test, y_test = load_test_set(test_loader)
+    x_test.share_memory_()
+    y_test.share_memory_()
+
+    n_workers = config.Operation.Workers
+    if n_workers <= 0:
+        n_workers = torch.cuda.device_count() if torch.cuda.is_available() else (os.cpu_count() or 1)
+    n_workers = min(n_workers, len(jobs))
+
+    ctx = mp.get_context('spawn')
+    with ctx.Pool(n_workers, initializer=_init_worker, initargs=(x_test, y_test, config, n_workers)) as pool:
+        for record in pool.imap_unordered(run_job, jobs):
+            logger.info(f"{record['arch']} {record['checkpoint']} [{record['suite']}] -> "
+                        f"clean: {record['results']['clean']:.2f} worst_case: {record['results']['worst_case']:.2f} "
+                        f"({record['time']:.0f}s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+from statistics import NormalDist
+from typing import Callable, Tuple
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from scipy.stats import beta
+from torch import Tensor
+from torch.utils.data import DataLoader, Dataset
+from tqdm import tqdm
+
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+def proportion_interval(k: int, n: int, confidence: float = 0.95, method: str = 'wilson') -> Tuple[float, float]:
+    # two-sided interval on a binomial proportion after k successes out of n
+    if n == 0:
+        return 0., 1.
+    if method == 'wilson':
+        z = NormalDist().inv_cdf((1. + confidence) / 2.)
+        p = k / n
+        denom = 1. + z ** 2 / n
+        center = (p + z ** 2 / (2. * n)) / denom
+        half = z / denom * (p * (1. - p) / n + z ** 2 / (4. * n ** 2)) ** 0.5
+        return max(0., center - half), min(1., center + half)
+    elif method == 'clopper-pearson':
+        a = 1. - confidence
+        lower = beta.ppf(a / 2., k, n - k + 1) if k > 0 else 0.
+        upper = beta.ppf(1. - a / 2., k + 1, n - k) if k < n else 1.
+        return float(lower), float(upper)
+    raise ValueError('unknown interval method ' + method)
+
+def _dataset_labels(dataset: Dataset) -> Tensor:
+    if hasattr(dataset, 'targets'):
+        return torch.as_tensor(dataset.targets)
+    return torch.tensor([dataset[i][1] for i in range(len(dataset))])
+
+def stratified_order(labels: Tensor, seed: int = 0) -> Tensor:
+    """
+    Random permutation of the dataset in which every prefix holds the classes in
+    (nearly) the same proportions as the whole set: the i-th of the n_c shuffled
+    samples of class c is placed at (i + u) / n_c, u ~ U(0, 1).
+    """
+    generator = torch.Generator().manual_seed(seed)
+    keys = torch.empty(len(labels))
+    for c in labels.unique():
+        idx = (labels == c).nonzero().squeeze(1)
+        idx = idx[torch.randperm(len(idx), generator=generator)]
+        keys[idx] = (torch.arange(len(idx)) + torch.rand(len(idx), generator=generator)) / len(idx)
+    return keys.argsort()
+
+def estimate_robust_accuracy(net: nn.Module, loader: DataLoader, attack: Callable[[nn.Module, Tensor, Tensor], Tensor],
+                             tol: float = 2., confidence: float = 0.95, method: str = 'wilson',
+                             min_samples: int = 500, seed: int = 0) -> dict:
+    """
+    Clean and robust accuracy of `net` on random stratified mini-batches of
+    loader.dataset, stopping as soon as the half-widths of both confidence intervals
+    are below `tol` (percentage points) or the whole set has been used. The batches
+    only depend on `seed`, so two runs with the same seed see the same prefix of the
+    set. `attack(net, x, y)` returns the adversarial examples.
+
+    :return:    dict with clean / robust accuracy, their intervals (in %), the mean
+                clean loss and the number of samples n used
+    """
+    net.eval()
+    dataset = loader.dataset
+    order = stratified_order(_dataset_labels(dataset), seed).tolist()
+    bs = loader.batch_size
+    batches = [order[i:i + bs] for i in range(0, len(order), bs)]
+    sampled_loader = DataLoader(dataset, batch_sampler=batches,
+                                num_workers=getattr(getattr(loader, 'loader', loader), 'num_workers', 0))
+
+    clean_correct, adv_correct, loss_sum, n = 0, 0, 0., 0
+    progress_bar = tqdm(total=len(batches), desc='Estimate>')
+    for inputs, targets in sampled_loader:
+        inputs, targets = inputs.to(device), targets.to(device)
+        with torch.no_grad():
+            outputs = net(inputs)
+        loss_sum += F.cross_entropy(outputs, targets, reduction='sum').item()
+        clean_correct += outputs.max(1)[1].eq(targets).sum().item()
+        adv = attack(net, inputs, targets)
+        with torch.no_grad():
+            adv_correct += net(adv).max(1)[1].eq(targets).sum().item()
+        n += targets.size(0)
+
+        clean_ci = proportion_interval(clean_correct, n, confidence, method)
+        robust_ci = proportion_interval(adv_correct, n, confidence, method)
+        half_width = 50. * max(clean_ci[1] - clean_ci[0], robust_ci[1] - robust_ci[0])
+        progress_bar.set_postfix(acc=round(100. * clean_correct / n, 2), adv_acc=round(100. * adv_correct / n, 2),
+                                 ci_half_width=round(half_width, 2))
+        progress_bar.update(1)
+        if n >= min_samples and half_width <= tol:
+            break
+    progress_bar.close()
+
+    return {
+        'clean': 100. * clean_correct / n,
+        'clean_ci': [100. * c for c in clean_ci],
+        'robust': 100. * adv_correct / n,
+        'robust_ci': [100. * c for c in robust_ci],
+        'loss': loss_sum / n,
+        'n': n,
+    }
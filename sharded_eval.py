@@ -0,0 +1,155 @@
+import json
+import logging
+import os
+from functools import partial
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+import yaml
+from easydict import EasyDict
+from torch import Tensor
+
+from eval_sweep import load_model
+from utils import create_dataloader
+from utils_test import load_test_set, autoattack_adv, build_attack_suite, resolve_batch_sizes, run_cascade, \
+    cascade_results
+
+logger = logging.getLogger(__name__)
+
+_x_test, _y_test, _config = None, None, None
+
+
+def shard_slices(n: int, n_shards: int, chunk_size: int) -> List[Tuple[int, int]]:
+    # contiguous, disjoint slices made of whole chunks
+    n_chunks = (n + chunk_size - 1) // chunk_size
+    bounds = [min(n, (i * n_chunks // n_shards) * chunk_size) for i in range(n_shards + 1)]
+    return [(bounds[i], bounds[i + 1]) for i in range(n_shards) if bounds[i] < bounds[i + 1]]
+
+
+def _fixed_batch_size(attack) -> bool:
+    # 'auto' would be tuned by each process, on its own timings
+    if isinstance(attack.fn, partial) and attack.fn.func is autoattack_adv:
+        return attack.fn.keywords.get('bs', 'auto') != 'auto'
+    return attack.bs != 'auto'
+
+
+def evaluate_slice(net: torch.nn.Module, x: Tensor, y: Tensor, attacks, offset: int, chunk_size: int,
+                   seed: int = 0, keep_adv: bool = True, verbose: bool = False) -> Tuple[Dict[str, Tensor], Optional[Tensor]]:
+    """
+    run_cascade chunk by chunk on the slice starting at global index `offset`, the RNG
+    being re-seeded with seed + global index of the first sample of each chunk. As long
+    as the slices are made of whole chunks and the batch sizes are fixed (see
+    resolve_batch_sizes), the result of a sample does not depend on the process or the
+    slice it was evaluated in: any number of workers gives the same flags and examples
+    for a given chunk_size and seed. The randomness is drawn per chunk, not per
+    sample, so the results are not the ones of test_robust.py, which runs the whole
+    set as a single chunk.
+    """
+    assert offset % chunk_size == 0, 'slices must start on a chunk boundary'
+    assert all(_fixed_batch_size(attack) for attack in attacks), \
+        'the batch sizes must be fixed, see resolve_batch_sizes'
+    flags, advs = {}, []
+    for start in range(0, x.shape[0], chunk_size):
+        torch.manual_seed(seed + offset + start)
+        chunk_flags, adv = run_cascade(net, x[start:start + chunk_size], y[start:start + chunk_size], attacks,
+                                       keep_adv=keep_adv, verbose=verbose)
+        for name, f in chunk_flags.items():
+            flags.setdefault(name, []).append(f)
+        if keep_adv:
+            advs.append(adv)
+    flags = {name: torch.cat(f) for name, f in flags.items()}
+    return flags, torch.cat(advs) if keep_adv else None
+
+
+def merge_shards(shards: List[tuple], n: int) -> Tuple[Dict[str, Tensor], Optional[Tensor]]:
+    # shards: (start, end, flags, adv) covering [0, n) without overlaps
+    shards = sorted(shards, key=lambda s: s[0])
+    end = 0
+    for start, stop, _, _ in shards:
+        assert start == end, f'samples [{end}, {start}) are missing or evaluated twice'
+        end = stop
+    assert end == n, f'samples [{end}, {n}) are missing'
+    flags = {name: torch.cat([s[2][name] for s in shards]) for name in shards[0][2]}
+    adv = None if shards[0][3] is None else torch.cat([s[3] for s in shards])
+    return flags, adv
+
+
+def _init_worker(x_test, y_test, config, n_workers):
+    global _x_test, _y_test, _config
+    _x_test, _y_test, _config = x_test, y_test, config
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // n_workers))
+    if torch.cuda.is_available():
+        worker_id = mp.current_process()._identity[0] - 1
+        torch.cuda.set_device(worker_id % torch.cuda.device_count())
+
+
+def run_shard(task) -> tuple:
+    # attacks: resolved by the parent, the same batch sizes for every shard
+    checkpoint_path, start, end, attacks = task
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    sharding = _config.Sharding
+    net, _ = load_model(sharding.Arch, checkpoint_path, _config, device)
+    flags, adv = evaluate_slice(net, _x_test[start:end], _y_test[start:end], attacks, start,
+                                sharding.Chunk_size, sharding.Seed, keep_adv=sharding.Save_adv)
+    return start, end, flags, adv
+
+
+def main(config_path='configs_test.yml'):
+    with open(config_path) as f:
+        config = EasyDict(yaml.load(f, Loader=yaml.FullLoader))
+    logging.basicConfig(format='[%(asctime)s] - %(message)s', datefmt='%Y/%m/%d %H:%M:%S',
+                        level=logging.INFO)
+    check_path = os.path.join('./checkpoint', config.DATA.Data, config.Operation.Prefix)
+    checkpoints = []
+    if config.Operation.Validate_Best:
+        checkpoints.append(('Best', 'model_best.pth.tar'))
+    if config.Operation.Validate_Last:
+        checkpoints.append(('Last', 'checkpoint.pth.tar'))
+
+    _, test_loader = create_dataloader(config.DATA.Data, Norm=config.Operation.Method != 'AT')
+    x_test, y_test = load_test_set(test_loader)
+    x_test.share_memory_()
+    y_test.share_memory_()
+    n = x_test.shape[0]
+
+    n_workers = config.Sharding.Workers
+    if n_workers <= 0:
+        n_workers = torch.cuda.device_count() if torch.cuda.is_available() else max(1, (os.cpu_count() or 1) // 8)
+    slices = shard_slices(n, n_workers, config.Sharding.Chunk_size)
+    logger.info(f'{len(slices)} shards: {slices}')
+
+    ctx = mp.get_context('spawn')
+    with ctx.Pool(len(slices), initializer=_init_worker, initargs=(x_test, y_test, config, len(slices))) as pool:
+        for tag, checkpoint_name in checkpoints:
+            logger.info(f"======={tag}_trained_model Performance (sharded)=======")
+            checkpoint_path = os.path.join(check_path, checkpoint_name)
+            # batch sizes tuned once here rather than in each worker, whose timings depend
+            # on how many workers share the node
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+            net, _ = load_model(config.Sharding.Arch, checkpoint_path, config, device)
+            attacks = resolve_batch_sizes(net, build_attack_suite(config, list(config.Sharding.Autoattack)),
+                                          x_test, y_test)
+            del net
+            batch_sizes = {a.name: a.bs if a.bs is not None else a.fn.keywords.get('bs') for a in attacks}
+            logger.info(f'batch sizes: {batch_sizes}')
+            shards = pool.map(run_shard, [(checkpoint_path, start, end, attacks) for start, end in slices])
+            flags, adv = merge_shards(shards, n)
+            results = cascade_results(flags)
+            for name, acc in results.items():
+                # the attack entries are cumulative, as in test_robust.py
+                label = name if name in ['clean', 'worst_case'] else f'cascade@{name}'
+                logger.info(f"{label}->acc: {acc: .2f}")
+
+            with open(os.path.join(check_path, f'{tag}_sharded.json'), 'w') as f:
+                json.dump({'results': results, 'slices': slices, 'chunk_size': config.Sharding.Chunk_size,
+                           'seed': config.Sharding.Seed, 'batch_sizes': batch_sizes}, f, indent=2)
+            np.savez(os.path.join(check_path, f'{tag}_sharded_flags.npz'),
+                     **{name: np.packbits(f.numpy()) for name, f in flags.items()})
+            if adv is not None:
+                np.save(os.path.join(check_path, f'{tag}_sharded_adv.npy'), adv.numpy())
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,8 @@
 import torch.backends.cudnn as cudnn
 from models import *
-from utils_test import evaluate_normal, evaluate_pgd, evaluate_autoattack, evaluate_cw
+from utils_test import load_test_set, build_attack_suite, evaluate_cascade, evaluate_pgd_budgets, evaluate_eps_curve, \
+    evaluate_min_norm, min_norm_curve
+from eval_cache import EvalCache, data_ident
 from easydict import EasyDict
 import yaml
 import logging
@@ -47,64 +49,59 @@ else:
     logger.info("Natural Training Model Robustness")
 
 _, test_loader = create_dataloader(data_set, Norm=Data_norm)
+if config.Operation.Prefetch > 0:
+    test_loader = BatchPrefetcher(test_loader, depth=config.Operation.Prefetch)
 
 net = net.to(device)
 net = torch.nn.DataParallel(net)  # parallel GPU
 cudnn.benchmark = True
 net.eval()
 
-#TODO: PGD Attack test
-print("==> Loading best model:"+file_name+"\n")
+print("==> Loading test set:"+file_name+"\n")
 assert os.path.isdir(check_path), 'Error: no checkpoint directory found!'
-checkpoint_best = torch.load(os.path.join(check_path, 'model_best.pth.tar'))
-checkpoint_last = torch.load(os.path.join(check_path, 'checkpoint.pth.tar'))
+# read on the host, the prefetcher would only copy the whole set to the device and back
+x_test, y_test = load_test_set(getattr(test_loader, 'loader', test_loader))
 
 # ['apgd-ce', 'apgd-t', 'fab-t', 'square']
 auto_attacks_methods = ['apgd-ce', 'apgd-t', 'fab-t', 'square']
-if config.Operation.Validate_Best == True:
-    logger.info("=======Best_trained_model Performance=======")
-    net.load_state_dict(checkpoint_best['state_dict'])
-    if config.Operation.Validate_Natural:
-        ##----->Clean
-        clean_acc = evaluate_normal(net, test_loader)
-        logger.info(f"Normal Acc: {clean_acc:.2f}")
-    if config.Operation.Validate_PGD:
-        ##----->FGSM
-        fgsm_acc = evaluate_pgd(net, test_loader, config.ADV.clip_eps, config.ADV.fgsm_step, 1)
-        logger.info(f"PGD_attack:[nb_iter:1,eps:{config.ADV.clip_eps},step_size:{config.ADV.fgsm_step}]->pgd_acc: {fgsm_acc: .2f}")
-        ##----->PDG
-        for pgd_param in config.ADV.pgd_test:
-            pgd_acc = evaluate_pgd(net, test_loader, pgd_param[1], pgd_param[2], pgd_param[0])
-            logger.info(f"PGD_attack:[nb_iter:{pgd_param[0]},eps:{pgd_param[1]},step_size:{pgd_param[2]}]->pgd_acc: {pgd_acc: .2f}")
-    if config.Operation.Validate_CW:
-        cw_acc = evaluate_cw(net, test_loader, config.ADV.clip_eps, config.ADV.fgsm_step, 20)
-        logger.info(f"CW_attack:[nb_iter:20,eps:{config.ADV.clip_eps},step_size:{config.ADV.fgsm_step}]->CW_acc: {cw_acc: .2f}")
-    if config.Operation.Validate_Autoattack:
-        ##----->Autoattack
-        auto_acc = evaluate_autoattack(net, test_loader, config.ADV.clip_eps, auto_attacks_methods)
-        logger.info(f"Auto_attack:[eps:{config.ADV.clip_eps}]->AA_acc: {auto_acc: .2f}")
-
+attack_suite = build_attack_suite(config, auto_attacks_methods)
+cache = EvalCache(config.Operation.Cache) if config.Operation.Cache else None
+data = data_ident(data_set, Data_norm, y_test)
 
+checkpoints = []
+if config.Operation.Validate_Best == True:
+    checkpoints.append(('Best', 'model_best.pth.tar'))
 if config.Operation.Validate_Last == True:
-    print("==> Loading last model:"+file_name+"\n")
-    logger.info("=======Last_trained_model Performance=======")
-    net.load_state_dict(checkpoint_last['state_dict'])
+    checkpoints.append(('Last', 'checkpoint.pth.tar'))
+
+for tag, checkpoint_name in checkpoints:
+    print("==> Loading " + tag.lower() + " model:"+file_name+"\n")
+    logger.info(f"======={tag}_trained_model Performance=======")
+    checkpoint = torch.load(os.path.join(check_path, checkpoint_name))
+    net.load_state_dict(checkpoint['state_dict'])
+    # clean logits once, then the attacks by increasing cost on the still robust samples
+    results = evaluate_cascade(net, x_test, y_test, attack_suite, cache=cache, data=data)
     if config.Operation.Validate_Natural:
-        ##----->Clean
-        clean_acc = evaluate_normal(net, test_loader)
-        logger.info(f"Normal Acc: {clean_acc:.2f}")
-    if config.Operation.Validate_PGD:
-        ##----->FGSM
-        fgsm_acc = evaluate_pgd(net, test_loader, config.ADV.clip_eps, config.ADV.fgsm_step, 1)
-        logger.info(f"PGD_attack:[nb_iter:1,eps:{config.ADV.clip_eps},step_size:{config.ADV.fgsm_step}]->pgd_acc: {fgsm_acc: .2f}")
-        ##----->PDG
-        for pgd_param in config.ADV.pgd_test:
-            pgd_acc = evaluate_pgd(net, test_loader, pgd_param[1], pgd_param[2], pgd_param[0])
-            logger.info(f"PGD_attack:[nb_iter:{pgd_param[0]},eps:{pgd_param[1]},step_size:{pgd_param[2]}]->pgd_acc: {pgd_acc: .2f}")
-    if config.Operation.Validate_CW:
-        cw_acc = evaluate_cw(net, test_loader, config.ADV.clip_eps, config.ADV.fgsm_step, 20)
-        logger.info(f"CW_attack:[nb_iter:20,eps:{config.ADV.clip_eps},step_size:{config.ADV.fgsm_step}]->CW_acc: {cw_acc: .2f}")
-    if config.Operation.Validate_Autoattack:
-        ##----->Autoattack
-        auto_acc = evaluate_autoattack(net, test_loader, config.ADV.clip_eps, auto_attacks_methods)
-        logger.info(f"Auto_attack:[eps:{config.ADV.clip_eps}]->AA_acc: {auto_acc: .2f}")
\ No newline at end of file
+        logger.info(f"Normal Acc: {results['clean']:.2f}")
+    # cumulative: accuracy against this attack and all the cheaper ones
+    for attack in sorted(attack_suite, key=lambda a: a.cost):
+        logger.info(f"cascade@{attack.name}->acc: {results[attack.name]: .2f}")
+    logger.info(f"Worst_case_acc: {results['worst_case']: .2f}")
+    if config.Operation.Validate_PGD_Budgets:
+        budget_acc, curve = evaluate_pgd_budgets(net, test_loader, config.ADV.clip_eps, config.ADV.fgsm_step,
+                                                 config.ADV.pgd_budgets)
+        for n_iter, acc in budget_acc.items():
+            logger.info(f"PGD_budget:[nb_iter:{n_iter},eps:{config.ADV.clip_eps},step_size:{config.ADV.fgsm_step}]->pgd_acc: {acc: .2f}")
+        np.savetxt(os.path.join(check_path, f'{tag}_pgd_curve.txt'), curve.numpy(), fmt='%.2f')
+    if config.Operation.Validate_Eps_Curve:
+        eps_acc = evaluate_eps_curve(net, test_loader, config.ADV.eps_curve, attack=config.ADV.eps_curve_attack)
+        for eps, acc in eps_acc.items():
+            logger.info(f"{config.ADV.eps_curve_attack}_eps_curve:[eps:{eps}]->acc: {acc: .2f}")
+        np.savetxt(os.path.join(check_path, f'{tag}_eps_curve.txt'), np.array(list(eps_acc.items())), fmt='%.2f')
+    if config.Operation.Validate_Min_Norm:
+        # Linf radii are given in 1/255 units
+        scale = 255. if config.ADV.min_norm == 'Linf' else 1.
+        norms = evaluate_min_norm(net, test_loader, norm=config.ADV.min_norm, eps=max(config.ADV.min_norm_eps) / scale)
+        np.save(os.path.join(check_path, f"{tag}_fab_min_norm_{config.ADV.min_norm}.npy"), norms.numpy())
+        for eps, acc in min_norm_curve(norms * scale, config.ADV.min_norm_eps).items():
+            logger.info(f"FAB_min_norm:[norm:{config.ADV.min_norm},eps:{eps}]->acc: {acc: .2f}")
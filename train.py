@@ -46,6 +46,9 @@ else:
     logger.info('Natural Training || net: '+config.Operation.Prefix)
 
 train_loader, test_loader = create_dataloader(data_set, Norm=Data_norm)
+if config.Operation.Prefetch > 0:
+    train_loader = BatchPrefetcher(train_loader, depth=config.Operation.Prefetch)
+    test_loader = BatchPrefetcher(test_loader, depth=config.Operation.Prefetch)
 
 net = net.to(device)
 net = torch.nn.DataParallel(net)  # parallel GPU
@@ -76,6 +79,14 @@ for epoch in range(start_epoch + 1, config.Train.Epoch + 1):
     else:
         acc_train, train_loss = train(net, epoch, train_loader, optimizer, config)
     # acc_test, pgd_acc, loss_test, best_prec1 = test_net_normal(net, test_loader, epoch, optimizer, best_prec1, config, save_path=check_path)
-    acc_test, pgd_acc, loss_test, best_prec1 = test_net_robust(net, test_loader, epoch, optimizer, best_prec1, config, save_path=check_path)
+    if config.ADV.robust_estimate:
+        acc_test, pgd_acc, loss_test, best_prec1, n_test = test_net_robust_estimate(net, test_loader, epoch, optimizer, best_prec1, config, save_path=check_path)
+        logger.info('epoch %d: robust accuracy estimated on %d samples', epoch, n_test)
+    else:
+        acc_test, pgd_acc, loss_test, best_prec1 = test_net_robust(net, test_loader, epoch, optimizer, best_prec1, config, save_path=check_path)
+    if config.Operation.Prefetch > 0:
+        logger.info('train %s | test %s', train_loader.summary(), test_loader.summary())
+        train_loader.reset_stats()
+        test_loader.reset_stats()
     logger.info('%-5d\t%-10.2f\t%-9.2f\t%-9.2f\t%-8.2f\t%.2f', epoch, train_loss, acc_train, loss_test,
                 acc_test, pgd_acc) 
\ No newline at end of file
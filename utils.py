@@ -17,6 +17,9 @@ import os
 import scipy.sparse as sp
 import scipy.stats as st
 import random
+import threading
+import time
+from queue import Queue, Empty
 from PIL import Image
 from torch.utils.data import Subset
 from torch.utils.data import TensorDataset, DataLoader, random_split
@@ -331,4 +334,118 @@ def create_loader_with_val_CIFAR_100(val_size=0):
     val_loader = DataLoader(val_dataset, batch_size=128, shuffle=False, num_workers=4)
     test_loader = DataLoader(test_dataset, batch_size=100, shuffle=False, num_workers=4)
 
-    return train_loader, test_loader, val_loader
\ No newline at end of file
+    return train_loader, test_loader, val_loader
+
+
+class BatchPrefetcher:
+    """
+    Wraps a DataLoader (e.g. the ones returned by create_dataloader) and stages the
+    next `depth` batches in a background thread: pinning, host->device copy on a
+    side CUDA stream and, optionally, normalization on the device. The training and
+    evaluation loops keep calling `inputs.to(device)`, which becomes a no-op.
+
+    `hits` counts batches that were already staged when the loop asked for them,
+    `stalls` the ones the loop had to wait for and `stall_time` the total waiting
+    time in seconds. Many stalls mean the input pipeline is the bottleneck.
+    """
+
+    def __init__(self, loader: DataLoader, device=device, depth: int = 2, mean=None, std=None):
+        assert depth >= 1, 'depth must be at least 1'
+        self.loader = loader
+        self.device = torch.device(device)
+        self.depth = depth
+        self.mean = None if mean is None else torch.as_tensor(mean).view(1, -1, 1, 1).to(self.device)
+        self.std = None if std is None else torch.as_tensor(std).view(1, -1, 1, 1).to(self.device)
+        self.use_cuda = self.device.type == 'cuda'
+        self.stream = torch.cuda.Stream(device=self.device) if self.use_cuda else None
+        self.reset_stats()
+
+    def __len__(self):
+        return len(self.loader)
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    @property
+    def batch_size(self):
+        return self.loader.batch_size
+
+    def reset_stats(self):
+        self.hits = 0
+        self.stalls = 0
+        self.stall_time = 0.
+
+    def summary(self) -> str:
+        total = max(self.hits + self.stalls, 1)
+        return 'prefetch hits: {} - stalls: {} ({:.1%}) - stall time: {:.1f}s'.format(
+            self.hits, self.stalls, self.stalls / total, self.stall_time)
+
+    def _stage(self, inputs, targets):
+        if not self.use_cuda:
+            inputs, targets = inputs.to(self.device), targets.to(self.device)
+            if self.mean is not None:
+                inputs = (inputs - self.mean) / self.std
+            return inputs, targets, None
+        if not inputs.is_pinned():
+            inputs, targets = inputs.pin_memory(), targets.pin_memory()
+        with torch.cuda.stream(self.stream):
+            inputs = inputs.to(self.device, non_blocking=True)
+            targets = targets.to(self.device, non_blocking=True)
+            if self.mean is not None:
+                inputs = (inputs - self.mean) / self.std
+            ready = torch.cuda.Event()
+            ready.record(self.stream)
+        return inputs, targets, ready
+
+    def _producer(self, queue: Queue, stop: threading.Event):
+        try:
+            for inputs, targets in self.loader:
+                if stop.is_set():
+                    return
+                queue.put(self._stage(inputs, targets))
+        except Exception as e:
+            queue.put(e)
+        finally:
+            queue.put(None)
+
+    def __iter__(self):
+        queue = Queue(maxsize=self.depth)
+        stop = threading.Event()
+        producer = threading.Thread(target=self._producer, args=(queue, stop), daemon=True)
+        producer.start()
+        try:
+            while True:
+                try:
+                    item = queue.get_nowait()
+                    stalled = False
+                except Empty:
+                    start = time.time()
+                    item = queue.get()
+                    stalled = True
+                    wait = time.time() - start
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                if stalled:
+                    self.stalls += 1
+                    self.stall_time += wait
+                else:
+                    self.hits += 1
+                inputs, targets, ready = item
+                if ready is not None:
+                    current = torch.cuda.current_stream(self.device)
+                    current.wait_event(ready)
+                    # the tensors were allocated on the side stream
+                    inputs.record_stream(current)
+                    targets.record_stream(current)
+                yield inputs, targets
+        finally:
+            stop.set()
+            # unblock the producer if it is waiting on a full queue
+            while producer.is_alive():
+                try:
+                    queue.get_nowait()
+                except Empty:
+                    producer.join(timeout=0.01)
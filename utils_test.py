@@ -1,11 +1,24 @@
+import logging
 import torch
 import torch.nn as nn
+from collections import namedtuple
+from functools import partial
+from contextlib import nullcontext
+from types import SimpleNamespace
+from typing import Dict, List, Optional, Tuple
 from torch.utils.data import DataLoader
 from tqdm import tqdm
 from torch import Tensor
 from autoattack import *
+from autoattack.autopgd_base import APGDAttack
+from autoattack.autotune import get_tuner
+from autoattack.fab_pt import FABAttack_PT
+from autoattack.other_utils import input_grad_only
+from attack_engine import AttackEngine
+from eval_cache import EvalCache, weights_hash
 
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
+logger = logging.getLogger(__name__)
 
 def Normalization(data, mean, std):
     mean = mean.view(1,-1, 1, 1)
@@ -14,21 +27,7 @@ def Normalization(data, mean, std):
 
 # PGD attack
 def pgd_attack(model: nn.Module, x: Tensor, y: Tensor, epsilon: float, alpha: float, iters: int) -> Tensor:
-    x_adv = x.detach() + torch.zeros_like(x).uniform_(-epsilon, epsilon)
-    x_adv = torch.clamp(x_adv, 0, 1)
-    criterion = nn.CrossEntropyLoss()
-
-    for _ in range(iters):
-        x_adv.requires_grad = True
-        logits = model(x_adv)
-        loss = criterion(logits, y)
-        grad = torch.autograd.grad(loss, x_adv)[0]
-
-        x_adv = x_adv.detach() + alpha * torch.sign(grad.detach())
-        x_adv = torch.min(torch.max(x_adv, x - epsilon), x + epsilon)
-        x_adv = torch.clamp(x_adv, 0, 1)
-
-    return x_adv.detach()
+    return AttackEngine(model, epsilon, alpha, iters).perturb(x, y)
 
 def CW_loss(x, y):
     x_sorted, ind_sorted = x.sort(dim=1)
@@ -38,60 +37,216 @@ def CW_loss(x, y):
     return loss_value.mean()
 
 def cw_Linf_attack(model: nn.Module, x: Tensor, y: Tensor, epsilon: float, alpha: float, iters: int) -> Tensor:
-    x_adv = x.detach() + torch.zeros_like(x).uniform_(-epsilon, epsilon)
-    x_adv = torch.clamp(x_adv, 0, 1)
+    return AttackEngine(model, epsilon, alpha, iters, loss='cw').perturb(x, y)
 
-    for _ in range(iters):
-        x_adv.requires_grad = True
-        logits = model(x_adv)
-        loss = CW_loss(logits, y)
-        loss.backward()
-        grad = x_adv.grad.detach()
+def _hash32(h: Tensor) -> Tensor:
+    # integer hash of 32-bit values held in int64, the products staying below 2**63
+    for _ in range(2):
+        h = ((h ^ (h >> 16)) * 0x45d9f3b) & 0xffffffff
+    return h ^ (h >> 16)
 
-        x_adv = x_adv.detach() + alpha * torch.sign(grad)
-        x_adv = torch.min(torch.max(x_adv, x - epsilon), x + epsilon)
-        x_adv = torch.clamp(x_adv, 0, 1)
+def per_sample_uniform(x: Tensor, sample_idx: Tensor, epsilon: float, seed: int = 0) -> Tensor:
+    # the random start of a sample depends only on (seed, global index of the sample),
+    # not on the batch it ends up in: counter-based, each coordinate is the hash of
+    # its global position, for the whole batch at once
+    n_features = x[0].numel()
+    offset = _hash32(torch.tensor(seed, dtype=torch.long, device=x.device))
+    counter = sample_idx.to(x.device).long().view(-1, 1) * n_features + torch.arange(n_features, device=x.device)
+    u = _hash32((counter + offset) & 0xffffffff).double() / 2 ** 32
+    return ((2. * u - 1.) * epsilon).to(x.dtype).view(x.shape)
 
-    return x_adv.detach()
+def pgd_first_success(model: nn.Module, x: Tensor, y: Tensor, epsilon: float, alpha: float, iters: int,
+                      noise: Tensor) -> Tensor:
+    # step (0 = random start) of the first misclassified PGD iterate, iters + 1 if none
+    engine = AttackEngine(model, epsilon, alpha, iters, early_stop=True)
+    return engine.perturb(x, y, noise=noise, return_steps=True)[1]
 
-def evaluate_pgd(net: nn.Module, test_loader: DataLoader, eps, step, iter) -> float:
+def evaluate_pgd_budgets(net: nn.Module, test_loader: DataLoader, eps, step, budgets, seed=0) -> Tuple[Dict[int, float], Tensor]:
+    """
+    A single PGD run of max(budgets) steps that records the first successful step of
+    every sample. Returns the robust accuracy at each budget and the whole curve,
+    curve[t] being the accuracy when any of the first t iterates may fool the model.
+    """
     net.eval()
-    adv_correct = 0
+    n_iter = max(budgets)
+    steps = torch.arange(n_iter + 1, device=device).unsqueeze(1)
+    robust_counts = torch.zeros(n_iter + 1, dtype=torch.long)
     total = 0
-    progress_bar = tqdm(total=len(test_loader), desc='Testing-PGD>>')
+    progress_bar = tqdm(total=len(test_loader), desc='Testing-PGD-budgets>>')
     for batch_idx, (inputs, targets) in enumerate(test_loader):
         inputs, targets = inputs.to(device), targets.to(device)
+        sample_idx = torch.arange(total, total + targets.size(0))
         total += targets.size(0)
-        adv = pgd_attack(net,inputs,targets, eps/255., step/255., iter)
         with torch.no_grad():
-            adv_outputs = net(adv)
-        _, predicted = adv_outputs.max(1)
-        adv_correct += predicted.eq(targets).sum().item()
-        if total % 100 == 0:
-            progress_bar.set_postfix(test_pgd_acc=round(100. * adv_correct / total, 2))
-        progress_bar.update(1)  # update bar
+            clean_correct = net(inputs).max(1)[1].eq(targets)
+        noise = per_sample_uniform(inputs, sample_idx, eps/255., seed)
+        first_success = pgd_first_success(net, inputs, targets, eps/255., step/255., n_iter, noise)
+        first_success[~clean_correct] = -1
+        robust_counts += (first_success.unsqueeze(0) > steps).sum(1).cpu()
+        progress_bar.set_postfix(test_pgd_acc=round(100. * robust_counts[-1].item() / total, 2))
+        progress_bar.update(1)
+    progress_bar.close()
+    curve = 100. * robust_counts.float() / total
+    return {b: curve[b].item() for b in budgets}, curve
+
+def _apgd_ce_stacked(apgd: APGDAttack, x: Tensor, y: Tensor, eps_rows: Tensor) -> Tensor:
+    # attack_single_run with self.eps set to a per-row tensor, restarts only on the robust rows
+    apgd.init_hyperparam(x)
+    robust = torch.ones_like(y, dtype=torch.bool)
+    with input_grad_only(apgd.model):
+        for _ in range(apgd.n_restarts):
+            idx = robust.nonzero().squeeze(1)
+            if idx.numel() == 0:
+                break
+            apgd.eps = eps_rows[idx].view(-1, *[1] * (x.dim() - 1))
+            _, acc, _, _ = apgd.attack_single_run(x[idx], y[idx])
+            robust[idx] = acc
+    return robust
+
+def evaluate_eps_curve(net: nn.Module, test_loader: DataLoader, eps_list, step_ratio=0.25, iter=20,
+                       attack='pgd', n_restarts=1, seed=0) -> Dict[float, float]:
+    """
+    Linf robust accuracy at every eps of eps_list (1/255 units) from a single pass over
+    test_loader. The clean-correct samples of a batch are replicated once per eps and
+    attacked as one batch with a per-row epsilon, the step size being step_ratio * eps
+    for PGD (APGD adapts its own). attack is 'pgd' or 'apgd-ce'.
+    """
+    assert attack in ['pgd', 'apgd-ce']
+    net.eval()
+    torch.manual_seed(seed)
+    eps_all = torch.tensor(eps_list, dtype=torch.float, device=device) / 255.
+    n_eps = len(eps_list)
+    if attack == 'apgd-ce':
+        apgd = APGDAttack(net, norm='Linf', eps=eps_all.max().item(), n_iter=iter, n_restarts=n_restarts,
+                          loss='ce', seed=seed, device=device)
+    robust_counts = torch.zeros(n_eps, dtype=torch.long)
+    total = 0
+    progress_bar = tqdm(total=len(test_loader), desc='Testing-eps-curve>>')
+    for batch_idx, (inputs, targets) in enumerate(test_loader):
+        inputs, targets = inputs.to(device), targets.to(device)
+        total += targets.size(0)
+        with torch.no_grad():
+            clean_idx = net(inputs).max(1)[1].eq(targets).nonzero().squeeze(1)
+        n_clean = clean_idx.numel()
+        if n_clean > 0:
+            # row k * n_clean + i is the i-th clean-correct sample at eps_all[k]
+            x_rep = inputs[clean_idx].repeat(n_eps, *[1] * (inputs.dim() - 1))
+            y_rep = targets[clean_idx].repeat(n_eps)
+            eps_rows = eps_all.repeat_interleave(n_clean)
+            if attack == 'pgd':
+                engine = AttackEngine(net, eps_rows, step_ratio * eps_rows, iter, n_restarts=n_restarts)
+                adv = engine.perturb(x_rep, y_rep)
+                with torch.no_grad():
+                    robust = net(adv).max(1)[1].eq(y_rep)
+            else:
+                robust = _apgd_ce_stacked(apgd, x_rep, y_rep, eps_rows)
+            robust_counts += robust.view(n_eps, n_clean).sum(1).cpu()
+        progress_bar.set_postfix(test_acc_max_eps=round(100. * robust_counts[-1].item() / total, 2))
+        progress_bar.update(1)
+    progress_bar.close()
+    return {eps: 100. * count / total for eps, count in zip(eps_list, robust_counts.tolist())}
+
+def evaluate_min_norm(net: nn.Module, test_loader: DataLoader, norm='Linf', n_iter=100, n_restarts=1,
+                      n_target_classes=9, eps=None, seed=0) -> Tensor:
+    """
+    Per-sample minimal norm of the adversarial perturbations found by FAB, untargeted
+    and targeted, in a single run (see FABAttack.perturb_min_norm). eps is only the
+    radius of the random restarts. The robust accuracy at any radius follows from
+    min_norm_curve.
+    """
+    net.eval()
+    fab = FABAttack_PT(net, norm=norm, n_restarts=n_restarts, n_iter=n_iter, eps=eps, seed=seed,
+                       device=device, n_target_classes=n_target_classes, jacobian='batched')
+    norms = []
+    for batch_idx, (inputs, targets) in tqdm(enumerate(test_loader), total=len(test_loader),
+                                             desc='Testing-FAB-min-norm>>'):
+        inputs, targets = inputs.to(device), targets.to(device)
+        norms.append(fab.perturb_min_norm(inputs, targets)[0].cpu())
+    return torch.cat(norms)
+
+def min_norm_curve(norms: Tensor, eps_list) -> Dict[float, float]:
+    # robust at eps <=> the smallest perturbation found is larger than eps
+    return {eps: 100. * (norms > eps).float().mean().item() for eps in eps_list}
+
+def _cache_lookup(cache: Optional[EvalCache], net: nn.Module, data: Optional[dict], n: int, attack: str,
+                  params: dict, seed, weights: Optional[str] = None):
+    # (cached entry, None) on a hit, (None, writer) on a miss, (None, None) without cache;
+    # data identifies the evaluated set, see eval_cache.data_ident
+    if cache is None:
+        return None, None
+    assert data is not None, 'the cache needs the identity of the evaluated set (eval_cache.data_ident)'
+    key = cache.key(weights or weights_hash(net), attack, params, data, (0, n), seed)
+    entry = cache.load(key)
+    if entry is not None:
+        logger.info(f'{attack} {params}: loaded from cache {key[:12]}')
+        return entry, None
+    logger.info(f'{attack} {params}: not in cache, computed as {key[:12]}')
+    return None, cache.writer(key, n, attack=attack, params=params, data=data, slice=[0, n], seed=seed)
+
+def evaluate_pgd(net: nn.Module, test_loader: DataLoader, eps, step, iter,
+                 cache: Optional[EvalCache] = None, data: Optional[dict] = None, seed=0) -> float:
+    net.eval()
+    entry, writer = _cache_lookup(cache, net, data, len(test_loader.dataset), 'pgd',
+                                  {'eps': eps, 'step': step, 'iter': iter}, seed)
+    if entry is not None:
+        return 100. * entry.accuracy()
+    if writer is not None:
+        torch.manual_seed(seed)
+    adv_correct = 0
+    total = 0
+    progress_bar = tqdm(total=len(test_loader), desc='Testing-PGD>>')
+    with writer or nullcontext():
+        for batch_idx, (inputs, targets) in enumerate(test_loader):
+            inputs, targets = inputs.to(device), targets.to(device)
+            start = total
+            total += targets.size(0)
+            adv = pgd_attack(net,inputs,targets, eps/255., step/255., iter)
+            with torch.no_grad():
+                adv_outputs = net(adv)
+            _, predicted = adv_outputs.max(1)
+            adv_correct += predicted.eq(targets).sum().item()
+            if writer is not None:
+                writer.write(start, predicted.eq(targets), adv)
+            if total % 100 == 0:
+                progress_bar.set_postfix(test_pgd_acc=round(100. * adv_correct / total, 2))
+            progress_bar.update(1)  # update bar
     progress_bar.close()  # close bar
     adv_acc = 100. * adv_correct / total
+    if writer is not None:
+        writer.commit()
     return adv_acc
 
-def evaluate_cw(net: nn.Module, test_loader: DataLoader, eps, step, iter) -> float:
+def evaluate_cw(net: nn.Module, test_loader: DataLoader, eps, step, iter,
+                cache: Optional[EvalCache] = None, data: Optional[dict] = None, seed=0) -> float:
     net.eval()
+    entry, writer = _cache_lookup(cache, net, data, len(test_loader.dataset), 'cw',
+                                  {'eps': eps, 'step': step, 'iter': iter}, seed)
+    if entry is not None:
+        return 100. * entry.accuracy()
+    if writer is not None:
+        torch.manual_seed(seed)
     adv_correct = 0
     total = 0
     progress_bar = tqdm(total=len(test_loader), desc='Testing-PGD>>')
-    for batch_idx, (inputs, targets) in enumerate(test_loader):
-        inputs, targets = inputs.to(device), targets.to(device)
-        total += targets.size(0)
-        adv = cw_Linf_attack(net, inputs, targets, eps/255, step/255, iter)
-        with torch.no_grad():
-            adv_outputs = net(adv)
-        _, predicted = adv_outputs.max(1)
-        adv_correct += predicted.eq(targets).sum().item()
-        if total % 100 == 0:
-            progress_bar.set_postfix(test_pgd_acc=round(100. * adv_correct / total, 2))
-        progress_bar.update(1)  # update bar
+    with writer or nullcontext():
+        for batch_idx, (inputs, targets) in enumerate(test_loader):
+            inputs, targets = inputs.to(device), targets.to(device)
+            start = total
+            total += targets.size(0)
+            adv = cw_Linf_attack(net, inputs, targets, eps/255, step/255, iter)
+            with torch.no_grad():
+                adv_outputs = net(adv)
+            _, predicted = adv_outputs.max(1)
+            adv_correct += predicted.eq(targets).sum().item()
+            if writer is not None:
+                writer.write(start, predicted.eq(targets), adv)
+            if total % 100 == 0:
+                progress_bar.set_postfix(test_pgd_acc=round(100. * adv_correct / total, 2))
+            progress_bar.update(1)  # update bar
     progress_bar.close()  # close bar
     adv_acc = 100. * adv_correct / total
+    if writer is not None:
+        writer.commit()
     return adv_acc
 
 def evaluate_normal(net: nn.Module, test_loader: DataLoader) -> float:
@@ -111,25 +266,227 @@ def evaluate_normal(net: nn.Module, test_loader: DataLoader) -> float:
 
     return test_acc
 
-def evaluate_autoattack(net: nn.Module, test_loader: DataLoader, eps: int, attacks_run: list) -> float:
+def evaluate_autoattack(net: nn.Module, test_loader: DataLoader, eps: int, attacks_run: list,
+                        chunk_size: int = 1000, adv_path=None, cache: Optional[EvalCache] = None,
+                        data: Optional[dict] = None) -> float:
     net.eval()
+    seed = 1
+    entry, writer = _cache_lookup(cache, net, data, len(test_loader.dataset), 'autoattack',
+                                  {'eps': eps, 'attacks': list(attacks_run), 'chunk_size': chunk_size}, seed)
+    if entry is not None:
+        return 100. * entry.accuracy()
 
-    autoattack = AutoAttack(net, norm='Linf', eps=eps/255., seed=1,
-                            attacks_to_run=attacks_run, version='custom')
+    autoattack = AutoAttack(net, norm='Linf', eps=eps/255., seed=seed,
+                            attacks_to_run=attacks_run, version='custom', device=device)
     autoattack.apgd.n_restarts = 2
     autoattack.fab.n_restarts = 2
-    l = [x for (x, y) in test_loader]
-    x_test = torch.cat(l, 0)
-    l = [y for (x, y) in test_loader]
-    y_test = torch.cat(l, 0)
+    autoattack.apgd.shrink_active = True
+    autoattack.apgd.parallel_restarts = True
+    autoattack.fab.parallel_restarts = True
+    autoattack.fab.jacobian = 'batched'
+    autoattack.apgd_targeted.multi_target = True
+    autoattack.apgd_targeted.shrink_active = True
 
-    #TODO: Modify return value of run_standard_evaluation
-    x_adv, robust_accuracy = autoattack.run_standard_evaluation((x_test).to(device), y_test.to(device))
+    # a single pass over test_loader, chunk by chunk
+    adv_store = None if writer is None else SimpleNamespace(write=writer.write_adv)
+    with writer or nullcontext():
+        robust_accuracy, flags, _ = autoattack.run_streaming_evaluation(test_loader, chunk_size=chunk_size,
+                                                                        bs='auto', adv_path=adv_path,
+                                                                        adv_store=adv_store)
+    if writer is not None:
+        writer.flags = flags
+        writer.commit()
 
     print(f"Autoattack have done! Accruracy{robust_accuracy*100.:.2f}")
 
     return robust_accuracy*100.
 
+def evaluate_transfer(net: nn.Module, test_loader: DataLoader, entry) -> float:
+    # accuracy of `net` on the adversarial examples of a cache entry built on another checkpoint
+    assert entry.has_adv, 'the cache entry does not store adversarial examples'
+    net.eval()
+    adv_correct = 0
+    total = 0
+    with torch.no_grad():
+        for batch_idx, (_, targets) in enumerate(test_loader):
+            targets = targets.to(device)
+            adv = entry.adv(total, total + targets.size(0)).to(device)
+            total += targets.size(0)
+            _, predicted = net(adv).max(1)
+            adv_correct += predicted.eq(targets).sum().item()
+    return 100. * adv_correct / total
+
+# An entry of the cascaded evaluation: `fn(net, x, y)` returns the adversarial
+# examples, `cost` orders the cascade and `bs` is the batch size the attack is
+# called with (None passes all the remaining samples at once, 'auto' tunes it, see
+# attack_batch_size).
+Attack = namedtuple('Attack', ['name', 'cost', 'fn', 'bs'])
+
+def load_test_set(test_loader: DataLoader) -> Tuple[Tensor, Tensor]:
+    xs, ys = [], []
+    for inputs, targets in test_loader:
+        xs.append(inputs.cpu())
+        ys.append(targets.cpu())
+    return torch.cat(xs, 0), torch.cat(ys, 0)
+
+def _autoattack(net: nn.Module, eps: float, attacks_run: list) -> AutoAttack:
+    autoattack = AutoAttack(net, norm='Linf', eps=eps, seed=1, attacks_to_run=attacks_run,
+                            version='custom', device=device)
+    autoattack.apgd.n_restarts = 2
+    autoattack.fab.n_restarts = 2
+    autoattack.apgd.shrink_active = True
+    autoattack.apgd.parallel_restarts = True
+    autoattack.fab.parallel_restarts = True
+    autoattack.fab.jacobian = 'batched'
+    autoattack.apgd_targeted.multi_target = True
+    autoattack.apgd_targeted.shrink_active = True
+    return autoattack
+
+def autoattack_adv(net: nn.Module, x: Tensor, y: Tensor, eps: float, attacks_run: list, bs='auto') -> Tensor:
+    # bs: as in run_standard_evaluation, an int, 'auto' or a dict resolved beforehand
+    # (see resolve_batch_sizes)
+    x_adv, _ = _autoattack(net, eps, attacks_run).run_standard_evaluation(x, y.to(x.device), bs=bs)
+    return x_adv
+
+def attack_batch_size(net: nn.Module, attack: Attack, x: Tensor, y: Tensor) -> int:
+    # largest batch that fits the memory budget at the best samples/s, probed with a
+    # single iteration of the attack and cached on disk
+    fn = attack.fn
+    if isinstance(fn, partial) and 'iters' in fn.keywords:
+        fn = partial(fn.func, *fn.args, **{**fn.keywords, 'iters': 1})
+    return get_tuner().batch_size(net, attack.name, lambda inputs, targets: fn(net, inputs, targets),
+                                  x, y, device)
+
+def resolve_batch_sizes(net: nn.Module, attacks: List[Attack], x: Tensor, y: Tensor) -> List[Attack]:
+    # the attacks with their 'auto' batch sizes tuned once on the first correctly
+    # classified samples of x, so that all the processes given them run the same batches
+    net.eval()
+    with torch.no_grad():
+        correct = net(x[:64].to(device)).max(1)[1].eq(y[:64].to(device)).cpu()
+    if correct.any():
+        x, y = x[:64][correct], y[:64][correct]
+    resolved = []
+    for attack in attacks:
+        if attack.bs == 'auto':
+            attack = attack._replace(bs=attack_batch_size(net, attack, x[:16], y[:16]))
+        elif isinstance(attack.fn, partial) and attack.fn.func is autoattack_adv:
+            fn = attack.fn
+            bs = _autoattack(net, fn.keywords['eps'], fn.keywords['attacks_run']).batch_sizes(x, y)
+            attack = attack._replace(fn=partial(fn, bs=bs))
+        resolved.append(attack)
+    return resolved
+
+def build_attack_suite(config, attacks_run: list) -> List[Attack]:
+    eps, step = config.ADV.clip_eps, config.ADV.fgsm_step
+    suite = []
+    if config.Operation.Validate_PGD:
+        suite.append(Attack(f'PGD_attack:[nb_iter:1,eps:{eps},step_size:{step}]', 1,
+                            partial(pgd_attack, epsilon=eps/255., alpha=step/255., iters=1), 'auto'))
+        for n_iter, pgd_eps, pgd_step in config.ADV.pgd_test:
+            suite.append(Attack(f'PGD_attack:[nb_iter:{n_iter},eps:{pgd_eps},step_size:{pgd_step}]', n_iter,
+                                partial(pgd_attack, epsilon=pgd_eps/255., alpha=pgd_step/255., iters=n_iter), 'auto'))
+    if config.Operation.Validate_CW:
+        suite.append(Attack(f'CW_attack:[nb_iter:20,eps:{eps},step_size:{step}]', 20,
+                            partial(cw_Linf_attack, epsilon=eps/255., alpha=step/255., iters=20), 'auto'))
+    if config.Operation.Validate_Autoattack:
+        suite.append(Attack(f'Auto_attack:[eps:{eps}]', float('inf'),
+                            partial(autoattack_adv, eps=eps/255., attacks_run=attacks_run), None))
+    return suite
+
+def run_cascade(net: nn.Module, x_test: Tensor, y_test: Tensor, attacks: List[Attack], bs: int = 100,
+                keep_adv: bool = False, verbose: bool = True, cache: Optional[EvalCache] = None,
+                data: Optional[dict] = None, seed=0) -> Tuple[Dict[str, Tensor], Optional[Tensor]]:
+    """
+    Per-sample version of evaluate_cascade: returns the robustness flags after the clean
+    pass ('clean') and after every attack (cumulative), and with keep_adv the example
+    that fooled each sample (the clean one if none did), on the cpu.
+
+    With a cache, every stage of the cascade is an entry keyed by the attacks run so
+    far (data identifies the set, see eval_cache.data_ident), and the RNG is re-seeded
+    with seed before every attack, so a run that crashed resumes at its first
+    unfinished attack with the results of an uninterrupted one.
+    """
+    net.eval()
+    n = x_test.shape[0]
+    robust = torch.zeros(n, dtype=torch.bool)
+    x_adv = x_test.clone() if keep_adv else None
+    with torch.no_grad():
+        for start in range(0, n, bs):
+            inputs, targets = x_test[start:start + bs].to(device), y_test[start:start + bs].to(device)
+            robust[start:start + bs] = net(inputs).max(1)[1].eq(targets).cpu()
+    flags = {'clean': robust.clone()}
+    weights = weights_hash(net) if cache is not None else None
+
+    for attack in sorted(attacks, key=lambda a: a.cost):
+        # the stage is the attack and the ones before it, which chose the samples it attacks
+        stage = {'attacks': list(flags)[1:] + [attack.name], 'kwargs': getattr(attack.fn, 'keywords', {})}
+        entry, writer = _cache_lookup(cache, net, data, n, 'cascade', stage, seed, weights)
+        if entry is not None and keep_adv and not entry.has_adv:
+            # cached without the adversarial examples, which are needed here: recomputed
+            entry = None
+        if entry is not None:
+            if keep_adv:
+                fooled_idx = (robust & ~entry.flags).nonzero().squeeze(1)
+                x_adv[fooled_idx] = entry.adv_rows(fooled_idx).to(x_adv.dtype)
+            robust = entry.flags.clone()
+            flags[attack.name] = robust.clone()
+            continue
+        if writer is not None:
+            torch.manual_seed(seed)
+        with writer or nullcontext():
+            _cascade_attack(net, x_test, y_test, attack, robust, x_adv, bs, verbose, writer)
+        if writer is not None:
+            writer.flags.update(0, robust)
+            writer.commit()
+        flags[attack.name] = robust.clone()
+    return flags, x_adv
+
+def _cascade_attack(net: nn.Module, x_test: Tensor, y_test: Tensor, attack: Attack, robust: Tensor,
+                    x_adv: Optional[Tensor], bs: int, verbose: bool, writer=None) -> None:
+    # one stage of run_cascade, robust and x_adv are updated in place
+    n = x_test.shape[0]
+    keep_adv = x_adv is not None
+    robust_idx = robust.nonzero().squeeze(1)
+    if attack.bs == 'auto' and robust_idx.numel() > 0:
+        attack_bs = attack_batch_size(net, attack, x_test[robust_idx[:16]], y_test[robust_idx[:16]])
+    else:
+        attack_bs = robust_idx.numel() if attack.bs in [None, 'auto'] else attack.bs
+    progress_bar = tqdm(total=robust_idx.numel(), desc=f'{attack.name}>>', disable=not verbose)
+    for start in range(0, robust_idx.numel(), max(attack_bs, 1)):
+        idx = robust_idx[start:start + attack_bs]
+        inputs, targets = x_test[idx].to(device), y_test[idx].to(device)
+        adv = attack.fn(net, inputs, targets)
+        with torch.no_grad():
+            for b in range(0, idx.numel(), bs):
+                predicted = net(adv[b:b + bs].to(device)).max(1)[1]
+                robust[idx[b:b + bs]] = predicted.eq(targets[b:b + bs]).cpu()
+        fooled = ~robust[idx]
+        if keep_adv:
+            x_adv[idx[fooled]] = adv[fooled.to(adv.device)].cpu()
+        if writer is not None:
+            writer.write_rows(idx[fooled], adv[fooled.to(adv.device)])
+        progress_bar.set_postfix(acc=round(100. * robust.sum().item() / n, 2))
+        progress_bar.update(idx.numel())
+    progress_bar.close()
+
+def cascade_results(flags: Dict[str, Tensor]) -> Dict[str, float]:
+    results = {name: 100. * f.sum().item() / f.numel() for name, f in flags.items()}
+    results['worst_case'] = results[list(flags)[-1]]
+    return results
+
+def evaluate_cascade(net: nn.Module, x_test: Tensor, y_test: Tensor, attacks: List[Attack],
+                     bs: int = 100, cache: Optional[EvalCache] = None, data: Optional[dict] = None,
+                     seed=0) -> Dict[str, float]:
+    """
+    Clean accuracy plus all `attacks` in a single pass over the preloaded test set.
+    The attacks run by increasing cost and each one only sees the samples that are
+    still robust, so the accuracy reported for an attack is the accuracy against it
+    and all the cheaper ones (the worst case so far); 'worst_case' is the final one.
+    The results of every attack are kept in `cache` if given (see run_cascade).
+    """
+    flags, _ = run_cascade(net, x_test, y_test, attacks, bs, cache=cache, data=data, seed=seed)
+    return cascade_results(flags)
+
 def test_adv(net,adversary,test_loader):
     net.eval()
     adv_correct = 0
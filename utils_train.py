@@ -9,10 +9,14 @@ import numpy as np
 from tqdm import tqdm
 import os
 import shutil
+from functools import partial
 from typing import Tuple
 from torch import Tensor
 from torch.autograd import Variable
 
+from attack_engine import AttackEngine
+from robust_estimate import estimate_robust_accuracy
+
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
 def adjust_learning_rate(learning_rate, optimizer, epoch):
@@ -205,23 +209,36 @@ def test_net_robust(net: nn.Module, test_loader: DataLoader, epoch: int, optimiz
     print('Model Saved!')
     return test_acc, adv_acc, benign_loss_test, best_prec_robust
 
+def test_net_robust_estimate(net: nn.Module, test_loader: DataLoader, epoch: int, optimizer: Optimizer,
+         best_prec: float, config: Any, save_path='./checkpoint') -> Tuple[float, float, float, float, int]:
+    # test_net_robust on stratified random batches until the confidence intervals are narrow
+    # enough. The batches are the same at every epoch (fixed seed), so that the epochs are
+    # compared on the same samples, and the loss is scaled to the sum of the per-batch mean
+    # losses over the whole set returned by test_net_robust
+    attack = partial(pgd_attack, epsilon=config.ADV.clip_eps/255., alpha=config.ADV.fgsm_step/255.,
+                     iters=config.ADV.pgd_attack_test)
+    estimate = estimate_robust_accuracy(net, test_loader, attack,
+                                        tol=config.ADV.estimate_tol, confidence=config.ADV.estimate_confidence,
+                                        method=config.ADV.estimate_method, seed=0)
+    test_acc, adv_acc = estimate['clean'], estimate['robust']
+    print(f"Estimated on {estimate['n']} samples: acc {test_acc:.2f} {estimate['clean_ci']} "
+          f"adv_acc {adv_acc:.2f} {estimate['robust_ci']}")
+    is_best = adv_acc > best_prec
+    best_prec_robust = max(adv_acc, best_prec)
+    if not os.path.isdir(save_path):
+        os.mkdir(save_path)
+    save_checkpoint({
+        'epoch': epoch,
+        'state_dict': net.state_dict(),
+        'best_prec1': best_prec_robust,
+        'optimizer': optimizer.state_dict(),
+    }, is_best, os.path.join(save_path))
+    print('Model Saved!')
+    return test_acc, adv_acc, estimate['loss'] * len(test_loader), best_prec_robust, estimate['n']
+
 # PGD attack
 def pgd_attack(model: nn.Module, x: Tensor, y: Tensor, epsilon: float, alpha: float, iters: int) -> Tensor:
-    x_adv = x.detach() + torch.zeros_like(x).uniform_(-epsilon, epsilon)
-    x_adv = torch.clamp(x_adv, 0, 1)
-    criterion = nn.CrossEntropyLoss()
-
-    for _ in range(iters):
-        x_adv.requires_grad = True
-        logits = model(x_adv)
-        loss = criterion(logits, y)
-        grad = torch.autograd.grad(loss, x_adv)[0]
-
-        x_adv = x_adv.detach() + alpha * torch.sign(grad.detach())
-        x_adv = torch.min(torch.max(x_adv, x - epsilon), x + epsilon)
-        x_adv = torch.clamp(x_adv, 0, 1)
-
-    return x_adv.detach()
+    return AttackEngine(model, epsilon, alpha, iters).perturb(x, y)
 
 def test_pgd(net: nn.Module, test_loader: DataLoader, config: Any) -> float:
     net.eval()